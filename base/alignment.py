@@ -0,0 +1,117 @@
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+
+# How a series is completed on the days of the master calendar where it has no price
+#   ffill: the last known price is carried forward, and the days before the first price take the first price
+#   drop: only the days on which every series has a price are kept
+#   raise: any missing price raises an AlignmentError
+gap_policies = ('ffill', 'drop', 'raise')
+
+
+class AlignmentError(ValueError):
+    """
+    Raised when the series cannot be aligned onto the master calendar with the chosen gap policy.
+
+    :param reason: A string describing why the series could not be aligned
+    :param ticker: A string representing the ticker whose series could not be aligned, or None if the error is not
+    specific to one ticker
+    """
+
+    def __init__(self, reason, ticker=None):
+        self.reason = reason
+        self.ticker = ticker
+        super().__init__(f"{ticker}: {reason}" if ticker else reason)
+
+
+def to_trading_days(timestamps):
+    """
+    Converts epoch timestamps into trading days, represented as the number of days since 1970-01-01 (UTC). Yahoo
+    Finance stamps each daily bar with the opening time of the market, so bars of the same session share a day.
+
+    :param timestamps: An array of integers representing the timestamps in epoch form
+    :return: An array of integers representing the trading days
+    """
+    return np.asarray(timestamps, dtype=np.int64) // SECONDS_PER_DAY
+
+
+def build_master_calendar(price_histories, tickers):
+    """
+    Merges the trading days of every series into a single sorted calendar.
+
+    :param price_histories: A dictionary with key value pairs of Ticker:History, as returned by fetch_price_histories
+    :param tickers: A list of strings representing the tickers whose trading days make up the calendar
+    :return: A sorted array of the unique trading days
+    """
+    return np.unique(np.concatenate([to_trading_days(price_histories[ticker]['timestamp']) for ticker in tickers]))
+
+
+def align_series(timestamps, prices, calendar, gap_policy='ffill'):
+    """
+    Places a single price series onto the master calendar with a sorted-array join. Prices that are NaN are treated as
+    missing and completed the same way as days on which the series did not trade.
+
+    :param timestamps: An array of integers representing the timestamps of the series in epoch form, sorted
+    :param prices: An array of prices, one per timestamp
+    :param calendar: A sorted array of trading days, as returned by build_master_calendar
+    :param gap_policy: One of gap_policies. With 'drop', the days without a price are left as NaN for the caller
+    :return aligned: An array of prices with one entry per day of the calendar
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    valid = ~np.isnan(prices)
+    days = to_trading_days(timestamps)[valid]
+    prices = prices[valid]
+
+    if not len(prices):
+        raise AlignmentError('The series does not contain any prices')
+
+    # Index of the last price at or before each calendar day. A series may hold several bars on the same day (e.g. a
+    # live bar next to the daily bar), in which case the last one is used
+    positions = np.searchsorted(days, calendar, side='right') - 1
+    traded = (positions >= 0) & (days[np.clip(positions, 0, None)] == calendar)
+
+    if gap_policy == 'ffill':
+        return prices[np.clip(positions, 0, None)]
+
+    if gap_policy == 'raise' and not traded.all():
+        raise AlignmentError(f"The series has no price on {np.count_nonzero(~traded)} day(s) of the calendar")
+
+    aligned = np.full(len(calendar), np.nan)
+    aligned[traded] = prices[positions[traded]]
+    return aligned
+
+
+def align_price_histories(price_histories, tickers, gap_policy='ffill'):
+    """
+    Aligns the closing prices of several tickers onto one master trading calendar, so the portfolio can be valued in a
+    single vectorized pass.
+
+    :param price_histories: A dictionary with key value pairs of Ticker:History, as returned by fetch_price_histories
+    :param tickers: A list of strings representing the tickers, in the order of the columns of the matrix
+    :param gap_policy: One of gap_policies, deciding how the days on which a ticker has no price are handled
+    :return: A tuple of the array of trading days and the (days x tickers) price matrix
+    """
+    if gap_policy not in gap_policies:
+        raise ValueError(f"Unknown gap policy {gap_policy!r}, expected one of {', '.join(gap_policies)}")
+
+    calendar = build_master_calendar(price_histories, tickers)
+
+    columns = []
+    for ticker in tickers:
+        try:
+            columns.append(align_series(price_histories[ticker]['timestamp'], price_histories[ticker]['close'],
+                                        calendar, gap_policy))
+        except AlignmentError as error:
+            raise AlignmentError(error.reason, ticker=ticker) from None
+
+    price_matrix = np.column_stack(columns)
+
+    if gap_policy == 'drop':
+        complete_days = ~np.isnan(price_matrix).any(axis=1)
+        calendar = calendar[complete_days]
+        price_matrix = price_matrix[complete_days]
+
+        if not len(calendar):
+            raise AlignmentError('The series do not share any trading day')
+
+    return calendar, price_matrix
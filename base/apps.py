@@ -1,6 +1,30 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.migrations.loader import MigrationLoader
+from django.db.models.signals import post_migrate
+
+
+def import_tickers(sender, using, plan=None, **kwargs):
+    """
+    Imports the tickers of the stocks.csv file once the tables of the app exist. The import is skipped when the file
+    has not changed since the last one, when migrations were unapplied, and when the app is not migrated to its latest
+    migration, since the import writes the current models.
+    """
+    from .utils import add_tickers_to_db
+
+    if not plan or any(backwards for _, backwards in plan):
+        return
+
+    loader = MigrationLoader(connections[using])
+    if not set(loader.graph.leaf_nodes(sender.label)) <= set(loader.applied_migrations):
+        return
+
+    add_tickers_to_db(using=using)
 
 
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        post_migrate.connect(import_tickers, sender=self)
@@ -0,0 +1,247 @@
+import datetime
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import django
+import matplotlib
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import Client, override_settings
+
+from .alignment import align_price_histories
+from .charts import render_charts
+from .index_cache import IndexHistoryCache
+from .indices import index_ticker_hash
+from .models import DailyPrice, PriceCoverage
+from .price_store import fetch_price_histories
+from .replay import FIXTURE_SUFFIX, ReplayServer, save_fixture, synthesize_fixture
+from .utils import assemble_plotting_df, calculate_investment_fluctuations, simulation_epochs
+
+# The stages of the simulation that are measured, in the order they run
+stages = ('fetch_cold', 'fetch_warm', 'assemble', 'fluctuations', 'render', 'results_view')
+
+# The date ranges that can be swept, as a number of days before BENCHMARK_END_DATE
+date_ranges = {'1m': 31, '1y': 365, '10y': 3652, '40y': 14610}
+
+# A fixed end date keeps the number of trading days of every range the same between runs
+BENCHMARK_END_DATE = datetime.date(2025, 1, 2)
+
+BENCHMARK_INDEX = 'S&P 500'
+
+# Differences below these are noise rather than regressions
+MIN_COMPARED_WALL_TIME = 0.001
+MIN_COMPARED_PEAK_MEMORY = 64 * 1024
+
+
+def measure(function, repeat, setup=None):
+    """
+    Measures a stage. The wall time is measured over repeat runs without tracing, after a warm-up run, then the memory
+    is measured over one more run under tracemalloc.
+
+    :param function: A callable running the stage
+    :param repeat: An integer representing the number of timed runs
+    :param setup: A callable run before every run, outside of the measurement
+    :return: A dictionary with the minimum and median wall time in seconds, the peak memory allocated by the stage in
+    bytes, and the number of memory blocks the stage left allocated
+    """
+    setup = setup or (lambda: None)
+
+    setup()
+    function()
+
+    wall_times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        function()
+        wall_times.append(time.perf_counter() - start)
+
+    setup()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        before = tracemalloc.take_snapshot()
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        'wall_time_min': min(wall_times),
+        'wall_time_median': statistics.median(wall_times),
+        'peak_memory': peak - baseline,
+        'allocated_blocks': sum(stat.count_diff for stat in after.compare_to(before, 'filename')),
+    }
+
+
+def write_fixtures(directory, tickers, start_epoch, end_epoch):
+    """
+    Generates the synthetic price histories served to the benchmark.
+    """
+    for ticker in tickers:
+        save_fixture(directory, ticker, synthesize_fixture(ticker, start_epoch, end_epoch))
+
+
+def recorded_stock_tickers(directory):
+    """
+    :return: A sorted list of the tickers of the recorded fixtures in a directory, apart from the indices
+    """
+    tickers = (name[:-len(FIXTURE_SUFFIX)] for name in os.listdir(directory) if name.endswith(FIXTURE_SUFFIX))
+    return sorted(ticker for ticker in tickers if ticker not in index_ticker_hash.values())
+
+
+def benchmark_case(client, stock_tickers, ticker_count, range_name, repeat, log):
+    """
+    Measures every stage of a simulation of the first ticker_count stock_tickers over the given date range.
+
+    :return: A list of dictionaries, one per stage, as returned by measure with the stage and the case added
+    """
+    tickers = stock_tickers[:ticker_count]
+    index_ticker = index_ticker_hash[BENCHMARK_INDEX]
+    stock_portfolio = {ticker: 1000 for ticker in tickers}
+
+    start_date = (BENCHMARK_END_DATE - datetime.timedelta(days=date_ranges[range_name])).isoformat()
+    end_date = BENCHMARK_END_DATE.isoformat()
+    start_epoch, end_epoch = simulation_epochs(start_date, end_date)
+    all_tickers = tickers + [index_ticker]
+
+    def fetch():
+        return fetch_price_histories(all_tickers, start_epoch, end_epoch, use_index_cache=False)
+
+    def clear_price_store():
+        DailyPrice.objects.filter(ticker__in=all_tickers).delete()
+        PriceCoverage.objects.filter(ticker__in=all_tickers).delete()
+
+    price_histories = fetch()
+    plotting_df = assemble_plotting_df(price_histories, stock_portfolio, index_ticker)
+    _, price_matrix = align_price_histories(price_histories, all_tickers, gap_policy=settings.PRICE_GAP_POLICY)
+
+    session = client.session
+    session.update({'start_date': start_date, 'end_date': end_date, 'index': BENCHMARK_INDEX,
+                    'portfolio': stock_portfolio})
+    session.save()
+
+    def request_results():
+        response = client.get('/results/?mode=sync')
+        assert response.status_code == 200, f"The Results page answered {response.status_code}"
+
+    stage_functions = {
+        'fetch_cold': (fetch, clear_price_store),
+        'fetch_warm': (fetch, None),
+        'assemble': (lambda: assemble_plotting_df(price_histories, stock_portfolio, index_ticker), None),
+        'fluctuations': (lambda: [calculate_investment_fluctuations(price_matrix[:, column], 1000)
+                                  for column in range(price_matrix.shape[1])], None),
+        'render': (lambda: render_charts(plotting_df, BENCHMARK_INDEX, [(False, False), (True, False)], 0), None),
+        'results_view': (request_results, caches[settings.RESULTS_CACHE_ALIAS].clear),
+    }
+
+    results = []
+    for stage in stages:
+        function, setup = stage_functions[stage]
+        result = {'stage': stage, 'tickers': ticker_count, 'range': range_name, 'days': len(plotting_df)}
+        result.update(measure(function, repeat, setup))
+        log(format_result(result))
+        results.append(result)
+    return results
+
+
+def run_benchmarks(ticker_counts, range_names, repeat, fixture_dir=None, log=print):
+    """
+    Runs every stage of the simulation for every combination of portfolio size and date range, against price histories
+    served by a local ReplayServer. The database must be a disposable one, such as a test database. The benchmark
+    index is read through the price store, like the other tickers, rather than from the index history cache.
+
+    :param ticker_counts: A list of integers representing the portfolio sizes
+    :param range_names: A list of keys of date_ranges
+    :param repeat: An integer representing the number of timed runs of each stage
+    :param fixture_dir: A string representing a directory of recorded fixtures, or None to generate synthetic ones.
+    Recorded fixtures must include the index and at least as many stocks as the largest portfolio size
+    :param log: A callable taking a progress message
+    :return report: A JSON serializable dictionary with the environment and the results
+    """
+    user, _ = User.objects.get_or_create(username='benchmark')
+    client = Client()
+    client.force_login(user)
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        if fixture_dir is None:
+            fixture_dir = synthetic_dir
+            stock_tickers = [f"B{number:03d}" for number in range(max(ticker_counts))]
+            first_date = BENCHMARK_END_DATE - datetime.timedelta(days=max(date_ranges[name] for name in range_names))
+            start_epoch, end_epoch = simulation_epochs(first_date.isoformat(), BENCHMARK_END_DATE.isoformat())
+            write_fixtures(fixture_dir, stock_tickers + [index_ticker_hash[BENCHMARK_INDEX]], start_epoch, end_epoch)
+        else:
+            stock_tickers = recorded_stock_tickers(fixture_dir)
+            if len(stock_tickers) < max(ticker_counts):
+                raise ValueError(f"{fixture_dir} only holds {len(stock_tickers)} recorded stocks")
+
+        # The indices are not loaded into the index history cache in the background, since a refresh could outlive the
+        # replay server and the test database, and reconnect to the development database once it is torn down
+        results = []
+        with ReplayServer(fixture_dir).start() as server, \
+                override_settings(UPSTREAM_CLIENT={**settings.UPSTREAM_CLIENT, 'BASE_URL': server.url}), \
+                mock.patch('base.price_store.index_cache', IndexHistoryCache([])):
+            for ticker_count in ticker_counts:
+                for range_name in range_names:
+                    results.extend(benchmark_case(client, stock_tickers, ticker_count, range_name, repeat, log))
+
+    return {
+        'environment': {
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'django': django.get_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'matplotlib': matplotlib.__version__,
+            'repeat': repeat,
+            'data': 'synthetic' if fixture_dir == synthetic_dir else 'recorded',
+        },
+        'results': results,
+    }
+
+
+def format_result(result):
+    return (f"{result['stage']:<13} {result['tickers']:>4} tickers {result['range']:>4} ({result['days']:>5} days) "
+            f"{result['wall_time_median'] * 1000:>10.1f} ms {result['peak_memory'] / 2 ** 20:>9.2f} MiB "
+            f"{result['allocated_blocks']:>8} blocks")
+
+
+def find_regressions(report, baseline, threshold):
+    """
+    Compares a report with a baseline report. A stage regressed when its median wall time or its peak memory grew by
+    more than threshold, relative to the baseline. Measurements too small to be told apart from noise are ignored.
+
+    :param report: A dictionary, as returned by run_benchmarks
+    :param baseline: A dictionary, as returned by run_benchmarks
+    :param threshold: A number representing the tolerated relative growth, e.g. 0.2 for 20%
+    :return regressions: A list of strings describing every regression
+    """
+    baseline_results = {(result['stage'], result['tickers'], result['range']): result
+                        for result in baseline['results']}
+
+    regressions = []
+    for result in report['results']:
+        case = (result['stage'], result['tickers'], result['range'])
+        previous = baseline_results.get(case)
+        if previous is None:
+            continue
+
+        for metric, floor in (('wall_time_median', MIN_COMPARED_WALL_TIME), ('peak_memory', MIN_COMPARED_PEAK_MEMORY)):
+            if max(result[metric], previous[metric]) < floor:
+                continue
+            if result[metric] > previous[metric] * (1 + threshold):
+                growth = result[metric] / previous[metric] - 1 if previous[metric] else float('inf')
+                regressions.append(f"{case[0]} with {case[1]} tickers over {case[2]}: {metric} grew by "
+                                   f"{growth:.0%} ({previous[metric]:.4g} -> {result[metric]:.4g})")
+    return regressions
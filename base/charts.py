@@ -0,0 +1,189 @@
+import base64
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .downsampling import downsample_plotting_df
+from .indices import index_name_hash
+from .profiling import is_profiling
+
+# This module does not depend on Django, so the processes of the pool can import it without setting Django up
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+# The size of the graphs in inches and their resolution. The width in pixels is also the number of points a line can
+# show, so it is used as the point budget when the series are downsampled
+FIGURE_SIZE = (10, 4)
+FIGURE_DPI = 100
+POINT_BUDGET = int(FIGURE_SIZE[0] * FIGURE_DPI)
+
+
+def plot_stock_data(portfolio_and_index_tracker, index, portfolio_only=False, percentage=False):
+    """
+    Creates a plot for the data and returns a string of decoded bytes that represent the plotted graph as
+    a PNG image. The figure is drawn on its own Agg canvas instead of the global pyplot state, so graphs can be
+    rendered from several threads at once and nothing is left behind once the image is returned.
+
+    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
+    :param index: A string representing the index that is chosen by the user
+    :param portfolio_only: A boolean value to determine whether only the portfolio should be graphed or not. If False,
+    the graph will include both the portfolio and the index
+    :param percentage: A boolean value to determine whether the percentage should be graphed or not. If False,
+    the graph is plotted with regards to the dollar
+    :return graph: A string of decoded bytes that represent the graph as a PNG image
+    """
+    index_name = index_name_hash[index]
+
+    portfolio_tracker = portfolio_and_index_tracker.iloc[:, 4:]
+
+    figure = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.ticklabel_format(style='plain')
+
+    # Portfolio vs Index in dollars
+    if not portfolio_only and not percentage:
+        axes.plot(portfolio_and_index_tracker['Portfolio Value'], label="Portfolio")
+        axes.plot(portfolio_and_index_tracker['Index Value'], label=index_name)
+
+    # Portfolio vs Index in percentage
+    elif not portfolio_only and percentage:
+        axes.plot(portfolio_and_index_tracker['Portfolio Growth'], label="Portfolio")
+        axes.plot(portfolio_and_index_tracker['Index Growth'], label=index_name)
+
+    # Constituents of Portfolio in dollars
+    elif portfolio_only and not percentage:
+        for column in portfolio_tracker:
+            axes.plot(portfolio_tracker[column], label=column)
+
+    # Constituents of Portfolio in percentage
+    else:
+        for column in portfolio_tracker:
+            axes.plot(portfolio_tracker[column].divide(portfolio_tracker[column].iloc[0]) * 100, label=column)
+
+    axes.legend()
+
+    try:
+        with BytesIO() as buffer:
+            figure.savefig(buffer, format='png')
+            image_png = buffer.getvalue()
+    finally:
+        # Break the references between the figure and its artists so the memory is released right away
+        figure.clear()
+
+    graph = base64.b64encode(image_png)
+    graph = graph.decode('utf-8')
+    return graph
+
+
+def plotted_columns(portfolio_and_index_tracker, portfolio_only):
+    """
+    Returns the dollar columns drawn by a variant of the graphs. The percentage variants are proportional to them, so
+    they keep the same points when downsampled.
+
+    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
+    :param portfolio_only: A boolean value, as taken by the plot_stock_data function
+    :return: A list of strings representing the columns
+    """
+    if portfolio_only:
+        return list(portfolio_and_index_tracker.columns[4:])
+    return ['Portfolio Value', 'Index Value']
+
+
+def get_render_executor(max_workers):
+    """
+    Returns the process pool used to render the graphs, creating it on first use. The processes are spawned rather
+    than forked, since forking a multi-threaded server process is unsafe.
+
+    :param max_workers: An integer representing the number of processes of the pool
+    :return: A ProcessPoolExecutor
+    """
+    global _render_executor
+    if _render_executor is None:
+        with _render_executor_lock:
+            if _render_executor is None:
+                _render_executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                       mp_context=multiprocessing.get_context('spawn'))
+    return _render_executor
+
+
+def discard_render_executor(executor):
+    """
+    Discards a process pool that stopped working, so the next call to get_render_executor starts a new one. Nothing is
+    done if another thread already replaced it.
+
+    :param executor: The ProcessPoolExecutor returned by get_render_executor
+    """
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is executor:
+            _render_executor = None
+    executor.shutdown(wait=False)
+
+
+def render_charts(portfolio_and_index_tracker, index, variants, max_workers, point_budget=POINT_BUDGET):
+    """
+    Renders several variants of the graphs in parallel, one process per variant. If max_workers is lower than 2, the
+    pool stops working or the request is being profiled, the graphs are rendered one after the other in the current
+    process instead.
+
+    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
+    :param index: A string representing the index that is chosen by the user
+    :param variants: A list of (portfolio_only, percentage) tuples, as taken by the plot_stock_data function
+    :param max_workers: An integer representing the number of processes used to render the graphs
+    :param point_budget: An integer representing the number of points each graph is downsampled to
+    :return graphs: A list of strings of decoded bytes that represent the graphs as PNG images, in the order of the
+    variants
+    """
+    # Downsampling before handing the dataframes to the pool also reduces the data sent to its processes
+    charts = [(downsample_plotting_df(portfolio_and_index_tracker,
+                                      plotted_columns(portfolio_and_index_tracker, portfolio_only), point_budget),
+               index, portfolio_only, percentage)
+              for portfolio_only, percentage in variants]
+
+    if max_workers >= 2 and len(charts) > 1 and not is_profiling():
+        executor = get_render_executor(max_workers)
+        try:
+            futures = [executor.submit(plot_stock_data, *chart) for chart in charts]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A process of the pool died, so start a new pool on the next call and render in this process for now
+            discard_render_executor(executor)
+
+    return [plot_stock_data(*chart) for chart in charts]
+
+
+def serialize_plotting_df(portfolio_and_index_tracker, index, point_budget=POINT_BUDGET):
+    """
+    Converts the dataframe returned by the create_plotting_df function into compact columns that can be sent to the
+    browser and plotted there. Only the dollar values are sent, since the percentages can be derived from them. The
+    trading days are sent as the number of days since 1970-01-01 and the values are rounded to the cent.
+
+    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
+    :param index: A string representing the index that is chosen by the user
+    :param point_budget: An integer representing the number of points the graphs are downsampled to
+    :return chart_data: A dictionary of lists that can be serialized to JSON
+    """
+    portfolio_and_index_tracker = downsample_plotting_df(
+        portfolio_and_index_tracker,
+        plotted_columns(portfolio_and_index_tracker, False) + plotted_columns(portfolio_and_index_tracker, True),
+        point_budget
+    )
+    trading_days = pd.to_datetime(portfolio_and_index_tracker.index).values.astype('datetime64[D]').astype(np.int64)
+    portfolio_tracker = portfolio_and_index_tracker.iloc[:, 4:]
+
+    chart_data = {
+        'index_name': index_name_hash[index],
+        'days': trading_days.tolist(),
+        'portfolio': np.round(portfolio_and_index_tracker['Portfolio Value'].values, 2).tolist(),
+        'index': np.round(portfolio_and_index_tracker['Index Value'].values, 2).tolist(),
+        'stocks': {column: np.round(portfolio_tracker[column].values, 2).tolist() for column in portfolio_tracker}
+    }
+    return chart_data
@@ -0,0 +1,197 @@
+import asyncio
+import threading
+
+
+class _Flight:
+    """
+    A fetch of [start, end) for a ticker that is in progress. The threads waiting on it are released by done.
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.done = threading.Event()
+        self.history = None
+        self.error = None
+
+
+def slice_history(history, start, end):
+    """
+    Keeps the rows of a parsed history whose timestamp falls within [start, end).
+
+    :param history: A dictionary of columns, as returned by parse_chart_response
+    :return: A dictionary of columns with the same keys
+    """
+    keep = [position for position, timestamp in enumerate(history['timestamp']) if start <= timestamp < end]
+    return {field: [column[position] for position in keep] for field, column in history.items()}
+
+
+def merge_histories(histories):
+    """
+    Concatenates parsed histories of disjoint ranges into a single history sorted by timestamp. The first field of
+    every history is the timestamp.
+
+    :param histories: A list of dictionaries of columns, as returned by parse_chart_response
+    :return: A dictionary of columns with the same keys
+    """
+    if len(histories) == 1:
+        return histories[0]
+
+    fields = list(histories[0])
+    rows = sorted((row for history in histories for row in zip(*(history[field] for field in fields))),
+                  key=lambda row: row[0])
+    return {field: [row[position] for row in rows] for position, field in enumerate(fields)}
+
+
+class RangeCoalescer:
+    """
+    Coalesces concurrent fetches of the same ticker. A request whose range is covered by a fetch that is already in
+    progress waits for that fetch and is served from its result, and a request that only overlaps one waits for it and
+    then fetches only the parts it did not cover. The coalescing applies to the threads of one process.
+
+    :param fetch: A callable taking (ticker, start, end, timeout) and returning a parsed history of [start, end)
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, ticker, start, end, timeout=None):
+        """
+        Returns the parsed history of a ticker within [start, end), sharing in-flight fetches with other threads.
+
+        :param ticker: A string that represents the specific ticker that is used
+        :param start: An integer representing the start of the range in epoch form (inclusive)
+        :param end: An integer representing the end of the range in epoch form (exclusive)
+        :param timeout: The number of seconds to wait for the upstream and for the fetches of other threads
+        :return history: A dictionary of columns, as returned by parse_chart_response
+        """
+        pending = [(start, end)]
+        pieces = []
+
+        while pending:
+            piece_start, piece_end = pending.pop()
+
+            with self._lock:
+                flights = self._flights.setdefault(ticker, [])
+                overlapping = next((flight for flight in flights
+                                    if flight.start < piece_end and flight.end > piece_start), None)
+                if overlapping is None:
+                    flight = _Flight(piece_start, piece_end)
+                    flights.append(flight)
+
+            if overlapping is None:
+                pieces.append(self._lead(ticker, flight, timeout))
+                continue
+
+            if not overlapping.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for the fetch of {ticker} of another request")
+            if overlapping.error is not None:
+                raise overlapping.error
+
+            # Use the part the other fetch covered, and fetch whatever is left on either side of it
+            pieces.append(slice_history(overlapping.history, piece_start, piece_end))
+            if piece_start < overlapping.start:
+                pending.append((piece_start, overlapping.start))
+            if piece_end > overlapping.end:
+                pending.append((overlapping.end, piece_end))
+
+        return merge_histories(pieces)
+
+    def _lead(self, ticker, flight, timeout):
+        """
+        Runs the fetch of a flight and releases the threads waiting on it.
+        """
+        try:
+            flight.history = self.fetch(ticker, flight.start, flight.end, timeout)
+            return flight.history
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                flights = self._flights[ticker]
+                flights.remove(flight)
+                if not flights:
+                    del self._flights[ticker]
+            flight.done.set()
+
+
+class AsyncRangeCoalescer:
+    """
+    Coalesces concurrent fetches of the same ticker between the coroutines of one event loop, in the same way as
+    RangeCoalescer does between threads.
+
+    :param fetch: A coroutine function taking (ticker, start, end, timeout) and returning a parsed history of
+    [start, end)
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self._flights = {}
+
+    async def get(self, ticker, start, end, timeout=None):
+        """
+        Returns the parsed history of a ticker within [start, end), sharing in-flight fetches with other coroutines.
+
+        :param ticker: A string that represents the specific ticker that is used
+        :param start: An integer representing the start of the range in epoch form (inclusive)
+        :param end: An integer representing the end of the range in epoch form (exclusive)
+        :param timeout: The number of seconds to wait for the upstream and for the fetches of other coroutines
+        :return history: A dictionary of columns, as returned by parse_chart_response
+        """
+        pending = [(start, end)]
+        pieces = []
+
+        while pending:
+            piece_start, piece_end = pending.pop()
+
+            # Nothing is awaited between the lookup and the registration, so no other coroutine can interleave
+            flights = self._flights.setdefault((asyncio.get_running_loop(), ticker), [])
+            overlapping = next((flight for flight in flights
+                                if flight.start < piece_end and flight.end > piece_start), None)
+            if overlapping is None:
+                flight = _Flight(piece_start, piece_end)
+                flight.done = asyncio.Event()
+                flights.append(flight)
+                pieces.append(await self._lead(ticker, flight, timeout))
+                continue
+
+            try:
+                await asyncio.wait_for(overlapping.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Timed out waiting for the fetch of {ticker} of another request")
+            if overlapping.error is not None:
+                raise overlapping.error
+
+            # Use the part the other fetch covered, and fetch whatever is left on either side of it
+            pieces.append(slice_history(overlapping.history, piece_start, piece_end))
+            if piece_start < overlapping.start:
+                pending.append((piece_start, overlapping.start))
+            if piece_end > overlapping.end:
+                pending.append((overlapping.end, piece_end))
+
+        return merge_histories(pieces)
+
+    async def _lead(self, ticker, flight, timeout):
+        """
+        Runs the fetch of a flight and releases the coroutines waiting on it.
+        """
+        key = (asyncio.get_running_loop(), ticker)
+        try:
+            flight.history = await self.fetch(ticker, flight.start, flight.end, timeout)
+            return flight.history
+        except asyncio.CancelledError:
+            # A cancelled fetch releases its waiters too, which then fail instead of waiting for the timeout
+            flight.error = TimeoutError(f"The fetch of {ticker} of another request was cancelled")
+            raise
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            flights = self._flights[key]
+            flights.remove(flight)
+            if not flights:
+                del self._flights[key]
+            flight.done.set()
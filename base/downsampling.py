@@ -0,0 +1,68 @@
+import numpy as np
+
+# The fewest points kept for each line, so that a graph with many holdings still shows the shape of every line
+MIN_POINTS_PER_SERIES = 64
+
+
+def lttb_indices(values, threshold):
+    """
+    Selects the points that best preserve the shape of a series with the Largest-Triangle-Three-Buckets algorithm. The
+    first and last points are always kept, and the points in between are split into threshold - 2 buckets, from which
+    the point forming the largest triangle with the previously selected point and the average of the next bucket is
+    kept. The trading days are treated as evenly spaced.
+
+    :param values: An array of the values of the series
+    :param threshold: An integer representing the number of points to keep
+    :return selected: A sorted array of the positions of the points that are kept
+    """
+    values = np.asarray(values, dtype=np.float64)
+    length = len(values)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    positions = np.arange(length, dtype=np.float64)
+    bucket_edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = bucket_edges[bucket], bucket_edges[bucket + 1]
+
+        # The last bucket is followed by the last point only
+        if bucket == threshold - 3:
+            next_position, next_value = positions[-1], values[-1]
+        else:
+            next_end = bucket_edges[bucket + 2]
+            next_position, next_value = positions[end:next_end].mean(), values[end:next_end].mean()
+
+        # Twice the area of the triangle formed by the previous point, each point of the bucket, and the next average
+        areas = np.abs((positions[previous] - next_position) * (values[start:end] - values[previous]) -
+                       (positions[previous] - positions[start:end]) * (next_value - values[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return selected
+
+
+def downsample_plotting_df(portfolio_and_index_tracker, columns, point_budget):
+    """
+    Reduces the rows of the dataframe to the points needed to draw the given columns within the point budget. The
+    budget is shared by the columns, each column keeps the points selected by LTTB, and the rows kept are the union of
+    those points, so every column still shares the same trading days.
+
+    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
+    :param columns: A list of strings representing the columns that are plotted
+    :param point_budget: An integer representing the number of points a line can usefully show, usually the width of
+    the graph in pixels
+    :return: A pandas dataframe with the same columns and a subset of the rows
+    """
+    if not columns or len(portfolio_and_index_tracker) <= point_budget:
+        return portfolio_and_index_tracker
+
+    threshold = max(point_budget // len(columns), MIN_POINTS_PER_SERIES)
+    selected = np.unique(np.concatenate([lttb_indices(portfolio_and_index_tracker[column].values, threshold)
+                                         for column in columns]))
+    return portfolio_and_index_tracker.iloc[selected]
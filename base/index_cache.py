@@ -0,0 +1,125 @@
+import calendar
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from django.db import connection
+
+from .indices import index_ticker_hash
+
+logger = logging.getLogger(__name__)
+
+# The earliest start date accepted by the Stock Market Parameters form
+HISTORY_START_EPOCH = calendar.timegm((1985, 9, 30, 0, 0, 0))
+
+SECONDS_PER_DAY = 86400
+
+# The seconds to wait before retrying a refresh that failed, doubled after every consecutive failure up to the maximum
+REFRESH_RETRY_DELAY = 30
+REFRESH_RETRY_MAX_DELAY = 60 * 15
+
+
+class IndexHistoryCache:
+    """
+    Keeps the full daily history of every benchmark index in memory, so that the index series of a simulation is
+    sliced out of it without any I/O. The histories are loaded in the background the first time they are looked up in
+    a process, and refreshed the first time they are used on a new day. A refresh that fails is retried with a backoff.
+    Refreshing goes through the price store, so only the days since the last refresh are requested from the upstream.
+    """
+
+    def __init__(self, tickers):
+        self.tickers = tickers
+        self._histories = {}
+        self._covered_until = None
+        self._refreshing = False
+        self._failures = 0
+        self._retry_at = None
+        self._lock = threading.Lock()
+
+        # A forked worker does not inherit the refresh thread of its parent, so it must be able to start its own
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self, ticker, start_epoch, end_epoch):
+        """
+        Slices the history of an index within [start_epoch, end_epoch) with two binary searches.
+
+        :param ticker: A string representing the ticker of the index
+        :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+        :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+        :return: A dictionary with one NumPy array per price field, or None if the range is not in memory
+        """
+        if ticker not in self.tickers:
+            return None
+
+        history = self._histories.get(ticker)
+        if history is None or self._covered_until < today_epoch():
+            self.refresh_in_background()
+        if history is None:
+            return None
+
+        if start_epoch < HISTORY_START_EPOCH or end_epoch > self._covered_until:
+            return None
+
+        low, high = np.searchsorted(history['timestamp'], [start_epoch, end_epoch], side='left')
+        return {field: column[low:high] for field, column in history.items()}
+
+    def refresh(self):
+        """
+        Loads the history of every index up to the start of the current day (UTC) and swaps it in.
+        """
+        # Imported here since the price store looks the indices up in this cache
+        from .price_store import fetch_price_histories
+
+        covered_until = today_epoch()
+        histories = fetch_price_histories(self.tickers, HISTORY_START_EPOCH, covered_until, use_index_cache=False)
+
+        with self._lock:
+            self._histories = histories
+            self._covered_until = covered_until
+
+    def refresh_in_background(self):
+        """
+        Starts a refresh in a daemon thread, unless one is already running or the last one failed too recently.
+        """
+        with self._lock:
+            if self._refreshing or (self._retry_at is not None and time.monotonic() < self._retry_at):
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._run_refresh, name='index-cache-refresh', daemon=True).start()
+
+    def _run_refresh(self):
+        failed = False
+        try:
+            self.refresh()
+        except Exception:
+            failed = True
+            logger.exception('Could not refresh the index history cache')
+        finally:
+            # The refresh runs in its own thread, which must not keep a database connection open
+            connection.close()
+            with self._lock:
+                self._refreshing = False
+                if failed:
+                    self._failures += 1
+                    delay = min(REFRESH_RETRY_DELAY * 2 ** (self._failures - 1), REFRESH_RETRY_MAX_DELAY)
+                    self._retry_at = time.monotonic() + delay
+                else:
+                    self._failures = 0
+                    self._retry_at = None
+
+
+def today_epoch():
+    """
+    :return: An integer representing the start of the current day (UTC) in epoch form
+    """
+    return int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+
+
+index_cache = IndexHistoryCache(list(index_ticker_hash.values()))
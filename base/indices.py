@@ -0,0 +1,13 @@
+# The benchmark indices that can be chosen in the Stock Market Parameters page
+
+index_ticker_hash = {
+    'S&P 500': '^GSPC',
+    'DJIA': '^DJI',
+    'NASDAQ-100': '^NDX'
+}
+
+index_name_hash = {
+    'S&P 500': 'Standard & Poor\'s 500',
+    'DJIA': 'Dow Jones Industrial Average',
+    'NASDAQ-100': 'Nasdaq-100'
+}
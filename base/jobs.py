@@ -0,0 +1,103 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from .results import error_messages, get_results, results_cache_key
+
+# The simulations running in this process, keyed by the cache key of their results. A job is removed once it is done,
+# since its results or its errors are then in the results cache
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_executor = None
+
+
+def get_job_executor():
+    """
+    Returns the thread pool running the simulations in the background, creating it on first use.
+
+    :return: A ThreadPoolExecutor with RESULTS_JOB_WORKERS threads
+    """
+    global _job_executor
+    if _job_executor is None:
+        _job_executor = ThreadPoolExecutor(max_workers=settings.RESULTS_JOB_WORKERS, thread_name_prefix='results-job')
+    return _job_executor
+
+
+def job_failure_key(job_id):
+    return f"{job_id}:failed"
+
+
+def _run_results_job(job_id, start_date, end_date, stock_portfolio, index, chart_mode):
+    """
+    Computes the results of a simulation into the results cache. The errors of a failed simulation are cached instead,
+    for RESULTS_JOB_FAILURE_TIMEOUT seconds or until they are reported.
+    """
+    try:
+        get_results(start_date, end_date, stock_portfolio, index, chart_mode)
+    except Exception as error:
+        caches[settings.RESULTS_CACHE_ALIAS].set(job_failure_key(job_id), error_messages(error),
+                                                 settings.RESULTS_JOB_FAILURE_TIMEOUT)
+        raise
+    finally:
+        connection.close()
+
+
+def _forget_job(job_id, job):
+    with _jobs_lock:
+        # The same simulation may have been submitted again since
+        if _jobs.get(job_id) is job:
+            del _jobs[job_id]
+
+
+def submit_results_job(start_date, end_date, stock_portfolio, index, chart_mode):
+    """
+    Starts computing the results of a simulation in the background, unless the same simulation is already running.
+
+    :param start_date: A string that represents the start date set by the user in the format YYYY-MM-DD
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes
+    :return job_id: A string identifying the job, which is the cache key its results are stored under
+    """
+    job_id = results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode)
+
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None and not job.done():
+            return job_id
+        caches[settings.RESULTS_CACHE_ALIAS].delete(job_failure_key(job_id))
+        job = _jobs[job_id] = get_job_executor().submit(_run_results_job, job_id, start_date, end_date,
+                                                        dict(stock_portfolio), index, chart_mode)
+
+    # Added outside the lock, since the callback runs right away in this thread if the job is already done
+    job.add_done_callback(functools.partial(_forget_job, job_id))
+    return job_id
+
+
+def get_job_status(job_id):
+    """
+    Returns the state of a job. A job that is no longer running is reported from the results cache, which also holds
+    the jobs of the other worker processes when the cache is shared. The errors of a failed job are only reported once.
+
+    :param job_id: A string identifying the job, as returned by submit_results_job
+    :return status: A dictionary with a 'status' of 'pending', 'done', 'failed' or 'unknown'. Failed jobs also carry the
+    'errors' that occurred, as a dictionary of Ticker:Error message
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+
+    if job is not None and not job.done():
+        return {'status': 'pending'}
+
+    cache = caches[settings.RESULTS_CACHE_ALIAS]
+    errors = cache.get(job_failure_key(job_id))
+    if errors is not None:
+        cache.delete(job_failure_key(job_id))
+        return {'status': 'failed', 'errors': errors}
+
+    return {'status': 'done' if job_id in cache else 'unknown'}
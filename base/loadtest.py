@@ -0,0 +1,337 @@
+import datetime
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import requests
+
+from .models import stock_indices
+
+# The requests of the flow of a virtual user, in the order they are sent. The report is grouped by these endpoints
+endpoints = ('login', 'form', 'form_post', 'select', 'autocomplete', 'select_post', 'results', 'results_status')
+
+CSRF_TOKEN_PATTERN = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+JOB_STATUS_PATTERN = re.compile(r'var statusUrl = "([^"]+)"')
+
+# The message of the error SQLite raises when a write could not take the lock of the database in time
+LOCKED_MESSAGE = 'database is locked'
+
+# The amount invested in each stock picked by a virtual user
+INVESTMENT_AMOUNT = 1000
+
+
+class FlowError(Exception):
+    """
+    Raised when a request of the flow fails, which ends the current iteration of the virtual user.
+    """
+
+
+def latency_percentiles(latencies):
+    """
+    :param latencies: A list of numbers representing durations in seconds
+    :return: A dictionary with the p50, p95, p99 and max of the durations in milliseconds, or None if there are none
+    """
+    if not latencies:
+        return None
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'p50': p50, 'p95': p95, 'p99': p99, 'max': max(latencies) * 1000}
+
+
+class LoadStats:
+    """
+    Collects the latency and the outcome of every request of the virtual users, grouped by endpoint.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.locked = defaultdict(int)
+        self.completed_flows = 0
+        self.failed_flows = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, failed=False, locked=False):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.errors[endpoint] += failed
+            self.locked[endpoint] += locked
+
+    def record_flow(self, completed):
+        with self._lock:
+            if completed:
+                self.completed_flows += 1
+            else:
+                self.failed_flows += 1
+
+    def summary(self, duration):
+        """
+        :param duration: A number representing the seconds the load test ran for
+        :return: A dictionary with the throughput and the latency percentiles of every endpoint
+        """
+        with self._lock:
+            summary = {}
+            for endpoint in endpoints:
+                latencies = self.latencies.get(endpoint)
+                if not latencies:
+                    continue
+                summary[endpoint] = {'requests': len(latencies), 'errors': self.errors[endpoint],
+                                     'locked': self.locked[endpoint], 'throughput': len(latencies) / duration,
+                                     'latency': latency_percentiles(latencies)}
+            return summary
+
+
+class SQLiteLockProbe(threading.Thread):
+    """
+    Measures the lock contention of a SQLite database. Every interval, the probe runs a small read-only query on a
+    read-only connection and records how long it had to wait, which is how long the writes of the server were holding
+    the database. Unlike a write, the read never takes the write lock, so the probe does not add to the contention it
+    measures. The writes that gave up waiting are counted by endpoint from the "database is locked" errors.
+
+    :param database_path: A string representing the path of the SQLite database file
+    :param interval: A number representing the seconds between two probes
+    :param timeout: A number representing the seconds a probe waits for the lock before giving up
+    """
+
+    def __init__(self, database_path, interval=0.1, timeout=5):
+        super().__init__(name='sqlite-lock-probe', daemon=True)
+        self.database_path = database_path
+        self.interval = interval
+        self.timeout = timeout
+        self.waits = []
+        self.timeouts = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        connection = sqlite3.connect(f"file:{self.database_path}?mode=ro", timeout=self.timeout, uri=True,
+                                     check_same_thread=False)
+        try:
+            while not self._stopped.wait(self.interval):
+                start = time.perf_counter()
+                try:
+                    connection.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                    self.waits.append(time.perf_counter() - start)
+                except sqlite3.OperationalError:
+                    self.timeouts += 1
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def summary(self):
+        """
+        :return: A dictionary with the number of probes, the number of probes that timed out and the percentiles of
+        the time waited for the lock
+        """
+        return {'probes': len(self.waits) + self.timeouts, 'timeouts': self.timeouts,
+                'wait': latency_percentiles(self.waits)}
+
+
+class VirtualUser:
+    """
+    A user going through the Stock Market Parameters, Stock Selection and Results pages, as a browser would. Every
+    iteration submits new parameters, picks stocks through the autocomplete and loads the Results page.
+
+    :param base_url: A string representing the url of the server
+    :param username: A string representing the username of an existing user
+    :param password: A string representing the password of the user
+    :param stats: A LoadStats instance recording the requests
+    :param picks: An integer representing the number of stocks picked per iteration
+    :param think_time: A number representing the maximum seconds waited between two requests
+    :param results_mode: A string representing the mode of the Results page, as taken by its ?mode= parameter
+    :param seed: The seed of the generator drawing the inputs of the user
+    :param timeout: A number representing the seconds a request may take
+    :param session: The requests.Session the requests are sent with, or anything with the same request method
+    """
+
+    def __init__(self, base_url, username, password, stats, picks=3, think_time=0, results_mode='sync', seed=None,
+                 timeout=120, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.picks = picks
+        self.think_time = think_time
+        self.results_mode = results_mode
+        self.random = random.Random(seed)
+        self.timeout = timeout
+        self.session = session if session is not None else requests.Session()
+
+    def request(self, endpoint, method, path, expected_status=(200,), **kwargs):
+        """
+        Sends a request and records its latency under endpoint. Redirects are not followed, so each request of the
+        flow is measured on its own.
+
+        :return: The response
+        :raise FlowError: If the request failed or answered with an unexpected status code
+        """
+        if self.think_time:
+            time.sleep(self.random.uniform(0, self.think_time))
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", allow_redirects=False,
+                                            timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.stats.record(endpoint, time.perf_counter() - start, failed=True)
+            raise FlowError(f"{method} {path}: {e.__class__.__name__}")
+        seconds = time.perf_counter() - start
+
+        failed = response.status_code not in expected_status
+        locked = response.status_code >= 500 and LOCKED_MESSAGE in response.text
+        self.stats.record(endpoint, seconds, failed=failed, locked=locked)
+        if failed:
+            raise FlowError(f"{method} {path}: {response.status_code}")
+        return response
+
+    def post_form(self, endpoint, path, page, data):
+        """
+        Submits a form of page, along with its CSRF token.
+        """
+        token = CSRF_TOKEN_PATTERN.search(page.text)
+        if token is None:
+            raise FlowError(f"No CSRF token in {path}")
+        return self.request(endpoint, 'POST', path, expected_status=(302,),
+                            data={**data, 'csrfmiddlewaretoken': token.group(1)})
+
+    def login(self):
+        page = self.request('login', 'GET', '/login/')
+        self.post_form('login', '/login/', page, {'username': self.username, 'password': self.password})
+
+    def draw_parameters(self):
+        """
+        :return: A tuple of a start date, an end date and an index
+        """
+        latest_end_date = datetime.date.today() - datetime.timedelta(days=1)
+        start_date = datetime.date(1990, 1, 1) + datetime.timedelta(days=self.random.randrange(30 * 365))
+        end_date = min(start_date + datetime.timedelta(days=self.random.randrange(30, 10 * 365)), latest_end_date)
+        return start_date.isoformat(), end_date.isoformat(), self.random.choice(stock_indices)[0]
+
+    def pick_stock(self):
+        """
+        Types the beginning of a ticker in the autocomplete of the Stock Selection page, one letter after the other.
+
+        :return: The suggestion that was picked, e.g. "AAPL: Apple Inc."
+        """
+        letter = self.random.choice('ABCDEFGHIJKLMNOPRSTW')
+        suggestions = self.request('autocomplete', 'GET', '/filtered_tickers/', params={'term': letter}).json()
+        if not suggestions:
+            raise FlowError(f"No suggestions for {letter}")
+
+        chosen_stock = self.random.choice(suggestions)
+        ticker = chosen_stock.split(':')[0]
+        for length in range(2, min(len(ticker), 3) + 1):
+            self.request('autocomplete', 'GET', '/filtered_tickers/', params={'term': ticker[:length]})
+        return chosen_stock
+
+    def get_results(self):
+        """
+        Loads the Results page. In the job mode, the status of the simulation is polled until its results are ready.
+        """
+        page = self.request('results', 'GET', f"/results/?mode={self.results_mode}")
+
+        status_url = JOB_STATUS_PATTERN.search(page.text)
+        if status_url is None:
+            return
+
+        while True:
+            time.sleep(0.5)
+            status = self.request('results_status', 'GET', status_url.group(1)).json()['status']
+            if status != 'pending':
+                break
+        if status != 'done':
+            raise FlowError(f"The simulation ended as {status}")
+        self.request('results', 'GET', f"/results/?mode={self.results_mode}")
+
+    def run_flow(self):
+        """
+        Goes once through the Stock Market Parameters, Stock Selection and Results pages.
+        """
+        start_date, end_date, index = self.draw_parameters()
+
+        page = self.request('form', 'GET', '/')
+        self.post_form('form_post', '/', page, {'money': self.picks * INVESTMENT_AMOUNT, 'start_date': start_date,
+                                                'end_date': end_date, 'index': index})
+
+        for _ in range(self.picks):
+            page = self.request('select', 'GET', '/select/')
+            chosen_stock = self.pick_stock()
+            self.post_form('select_post', '/select/', page, {'chosen_stock': chosen_stock,
+                                                             'investment_amount': INVESTMENT_AMOUNT})
+
+        self.get_results()
+
+    def run(self, iterations):
+        try:
+            self.login()
+        except FlowError:
+            self.stats.record_flow(False)
+            return
+
+        for _ in range(iterations):
+            try:
+                self.run_flow()
+                self.stats.record_flow(True)
+            except FlowError:
+                self.stats.record_flow(False)
+
+
+def run_load_test(base_url, credentials, iterations, picks=3, think_time=0, ramp_up=0, results_mode='sync',
+                  database_path=None, seed=0):
+    """
+    Runs one thread per virtual user through the flow of the application against a running server.
+
+    :param base_url: A string representing the url of the server
+    :param credentials: A list of (username, password) tuples of existing users, one per virtual user
+    :param iterations: An integer representing the number of times each virtual user goes through the flow
+    :param picks: An integer representing the number of stocks picked per iteration
+    :param think_time: A number representing the maximum seconds a virtual user waits between two requests
+    :param ramp_up: A number representing the seconds over which the start of the virtual users is spread
+    :param results_mode: A string representing the mode of the Results page, as taken by its ?mode= parameter
+    :param database_path: A string representing the path of the SQLite database of the server, to measure its lock
+    contention, or None
+    :param seed: The seed of the generators drawing the inputs of the virtual users
+    :return report: A JSON serializable dictionary with the throughput, the latencies of every endpoint and the lock
+    contention of the database
+    """
+    stats = LoadStats()
+    probe = SQLiteLockProbe(database_path) if database_path else None
+
+    users = [VirtualUser(base_url, username, password, stats, picks, think_time, results_mode,
+                         seed=f"{seed}-{number}")
+             for number, (username, password) in enumerate(credentials)]
+    threads = [threading.Thread(target=user.run, args=(iterations,), name=f"virtual-user-{number}", daemon=True)
+               for number, user in enumerate(users)]
+
+    if probe is not None:
+        probe.start()
+    start = time.perf_counter()
+    for number, thread in enumerate(threads):
+        if ramp_up and number:
+            time.sleep(ramp_up / len(threads))
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    if probe is not None:
+        probe.stop()
+
+    requests_sent = sum(len(latencies) for latencies in stats.latencies.values())
+    return {
+        'users': len(users),
+        'iterations': iterations,
+        'picks': picks,
+        'results_mode': results_mode,
+        'duration': duration,
+        'completed_flows': stats.completed_flows,
+        'failed_flows': stats.failed_flows,
+        'flow_throughput': stats.completed_flows / duration,
+        'request_throughput': requests_sent / duration,
+        'endpoints': stats.summary(duration),
+        'sqlite': probe.summary() if probe is not None else None,
+    }
@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+
+from base.benchmarks import date_ranges, find_regressions, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Measures the wall time, peak memory and allocations of every stage of a simulation, for several portfolio '
+            'sizes and date ranges. The simulations run on a temporary test database against a local replay of the '
+            'upstream, so the development database is left untouched')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickers', type=int, nargs='+', default=[1, 10, 50, 200],
+                            help='The portfolio sizes to sweep')
+        parser.add_argument('--ranges', nargs='+', choices=list(date_ranges), default=list(date_ranges),
+                            help='The date ranges to sweep')
+        parser.add_argument('--repeat', type=int, default=3, help='The number of timed runs of each stage')
+        parser.add_argument('--fixtures', default=None,
+                            help='A directory of recorded fixtures to replay, instead of synthetic price histories')
+        parser.add_argument('--output', help='The file the results are written to, as JSON')
+        parser.add_argument('--baseline', help='A file written by an earlier run with --output to compare against')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='The tolerated growth of a stage relative to the baseline, 0.2 being 20%%')
+
+    def handle(self, *args, **options):
+        if min(options['tickers']) < 1 or options['repeat'] < 1:
+            raise CommandError('--tickers and --repeat must be positive')
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            report = run_benchmarks(options['tickers'], options['ranges'], options['repeat'], options['fixtures'],
+                                    log=self.stdout.write)
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = find_regressions(report, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions beyond the threshold:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions beyond the threshold'))
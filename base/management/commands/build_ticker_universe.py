@@ -0,0 +1,51 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base.universe_builder import Checkpoint, UniverseBuildError, build_ticker_universe, refresh_ticker_universe
+from base.utils import add_tickers_to_db
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the stocks.csv file by scraping the NYSE and NASDAQ listings and requesting the first trade date '
+            'of every ticker, or only of the new ones with --incremental. An interrupted build resumes where it '
+            'stopped when it is run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.UNIVERSE_BUILD_WORKERS,
+                            help='The number of concurrent requests')
+        parser.add_argument('--rate-limit', type=float, default=settings.UNIVERSE_BUILD_RATE_LIMIT,
+                            help='The maximum number of requests per second sent to each site, 0 for no limit')
+        parser.add_argument('--checkpoint-dir', default=settings.UNIVERSE_BUILD_CHECKPOINT_DIR,
+                            help='The directory where the progress of the build is kept')
+        parser.add_argument('--output', default=os.path.join(settings.BASE_DIR, 'base', 'stocks.csv'),
+                            help='The csv file that is written')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only request the tickers that are new or changed, and mark the missing ones as '
+                                 'delisted')
+        parser.add_argument('--restart', action='store_true', help='Discard the progress of a previous build')
+        parser.add_argument('--import', action='store_true', dest='import_tickers',
+                            help='Import the tickers into the database once the file is written')
+
+    def handle(self, *args, **options):
+        checkpoint = Checkpoint(str(options['checkpoint_dir']))
+        if options['restart']:
+            checkpoint.clear()
+
+        build = refresh_ticker_universe if options['incremental'] else build_ticker_universe
+        try:
+            result = build(options['output'], checkpoint, options['workers'], options['rate_limit'],
+                           log=self.stdout.write)
+        except UniverseBuildError as error:
+            for key, message in sorted(error.failures.items()):
+                self.stderr.write(f"{key}: {message}")
+            raise CommandError(f"{error}. Run the command again to retry them, the rest of the progress is kept")
+
+        if options['incremental']:
+            self.stdout.write(self.style.SUCCESS(', '.join(f"{count} {change}" for change, count in result.items())))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{result} tickers were written to {options['output']}"))
+
+        if options['import_tickers'] and add_tickers_to_db():
+            self.stdout.write(self.style.SUCCESS('The tickers were imported'))
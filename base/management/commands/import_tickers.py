@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from base.utils import add_tickers_to_db
+
+
+class Command(BaseCommand):
+    help = 'Imports the tickers of the stocks.csv file into the database, skipping the import if the file is unchanged'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Import the tickers even if the file is unchanged')
+
+    def handle(self, *args, **options):
+        if add_tickers_to_db(force=options['force']):
+            self.stdout.write(self.style.SUCCESS('The tickers were imported'))
+        else:
+            self.stdout.write('The tickers are already up to date')
@@ -0,0 +1,125 @@
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from base.loadtest import endpoints, run_load_test
+from base.replay import ReplayServer
+
+# The password of the users created for the virtual users
+LOAD_TEST_PASSWORD = 'load-test-password'
+
+
+def get_load_test_credentials(count):
+    """
+    Creates the users of the virtual users, unless they already exist.
+
+    :return: A list of (username, password) tuples
+    """
+    credentials = []
+    for number in range(count):
+        username = f"load-test-{number}"
+        if not User.objects.filter(username=username).exists():
+            User.objects.create_user(username, password=LOAD_TEST_PASSWORD)
+        credentials.append((username, LOAD_TEST_PASSWORD))
+    return credentials
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{url}/login/", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise CommandError(f"The server at {url} did not start within {timeout} seconds")
+
+
+class Command(BaseCommand):
+    help = ('Sends concurrent virtual users through the Stock Market Parameters, Stock Selection and Results pages of '
+            'a local server, and reports the throughput, the latency percentiles of every endpoint and the lock '
+            'contention of the SQLite database. With --serve, the server is started along with a synthetic upstream')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help='The url of a running server, whose upstream should be a replay_upstream server')
+        parser.add_argument('--serve', action='store_true',
+                            help='Start runserver on the port of --url, with a synthetic upstream, for the load test')
+        parser.add_argument('--users', type=int, default=10, help='The number of concurrent virtual users')
+        parser.add_argument('--iterations', type=int, default=3,
+                            help='The number of times each virtual user goes through the flow')
+        parser.add_argument('--picks', type=int, default=3, help='The number of stocks picked per iteration')
+        parser.add_argument('--think-time', type=float, default=0,
+                            help='The maximum seconds a virtual user waits between two requests')
+        parser.add_argument('--ramp-up', type=float, default=0,
+                            help='The seconds over which the start of the virtual users is spread')
+        parser.add_argument('--results-mode', choices=['sync', 'async'], default='sync',
+                            help='The mode of the Results page')
+        parser.add_argument('--seed', type=int, default=0, help='The seed of the inputs of the virtual users')
+        parser.add_argument('--output', help='The file the report is written to, as JSON')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['iterations'] < 1 or options['picks'] < 1:
+            raise CommandError('--users, --iterations and --picks must be positive')
+
+        url = options['url'].rstrip('/')
+        database = settings.DATABASES['default']
+        database_path = str(database['NAME']) if database['ENGINE'] == 'django.db.backends.sqlite3' else None
+        credentials = get_load_test_credentials(options['users'])
+
+        with contextlib.ExitStack() as stack:
+            if options['serve']:
+                self.start_server(stack, url)
+            report = run_load_test(url, credentials, options['iterations'], options['picks'], options['think_time'],
+                                   options['ramp_up'], options['results_mode'], database_path, options['seed'])
+
+        self.write_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def start_server(self, stack, url):
+        """
+        Starts runserver on the address of url, with a local upstream answering every ticker with a synthetic history.
+        Both are stopped when stack is closed.
+        """
+        fixture_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        upstream = stack.enter_context(ReplayServer(fixture_dir, synthesize=True).start())
+
+        server = subprocess.Popen([sys.executable, 'manage.py', 'runserver', url.split('://', 1)[-1], '--noreload'],
+                                  cwd=settings.BASE_DIR, env={**os.environ, 'UPSTREAM_BASE_URL': upstream.url},
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        stack.callback(server.wait)
+        stack.callback(server.terminate)
+        wait_for_server(url)
+
+    def write_report(self, report):
+        self.stdout.write(f"{report['users']} users, {report['completed_flows']} flows completed and "
+                          f"{report['failed_flows']} failed in {report['duration']:.1f} s: "
+                          f"{report['flow_throughput']:.2f} flows/s, {report['request_throughput']:.1f} requests/s")
+        self.stdout.write(f"{'endpoint':<15}{'requests':>9}{'errors':>8}{'locked':>8}{'req/s':>8}"
+                          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for endpoint in endpoints:
+            stats = report['endpoints'].get(endpoint)
+            if stats is None:
+                continue
+            latency = stats['latency']
+            self.stdout.write(f"{endpoint:<15}{stats['requests']:>9}{stats['errors']:>8}{stats['locked']:>8}"
+                              f"{stats['throughput']:>8.2f}{latency['p50']:>10.1f}{latency['p95']:>10.1f}"
+                              f"{latency['p99']:>10.1f}")
+
+        sqlite = report['sqlite']
+        if sqlite is not None and sqlite['wait'] is not None:
+            self.stdout.write(f"SQLite read waits: {sqlite['probes']} probes, {sqlite['timeouts']} timed out, waited "
+                              f"p50 {sqlite['wait']['p50']:.1f} ms, p95 {sqlite['wait']['p95']:.1f} ms, "
+                              f"p99 {sqlite['wait']['p99']:.1f} ms, max {sqlite['wait']['max']:.1f} ms")
@@ -0,0 +1,68 @@
+import calendar
+import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base.index_cache import HISTORY_START_EPOCH
+from base.indices import index_ticker_hash
+from base.models import StockTicker
+from base.replay import record_fixture, save_fixture, synthesize_fixture
+
+
+def parse_date(value):
+    return calendar.timegm(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple())
+
+
+class Command(BaseCommand):
+    help = ('Saves the Yahoo Finance chart responses of tickers as fixtures that the replay_upstream command serves, '
+            'or generates synthetic ones with --synthetic')
+
+    def add_arguments(self, parser):
+        parser.add_argument('tickers', nargs='*', help='The tickers to record')
+        parser.add_argument('--indices', action='store_true', help='Also record the benchmark indices')
+        parser.add_argument('--all', action='store_true', help='Record every listed ticker of the database')
+        parser.add_argument('--start', type=parse_date, default=HISTORY_START_EPOCH,
+                            help='The first day to record, as YYYY-MM-DD')
+        parser.add_argument('--end', type=parse_date, default=None, help='The day after the last day to record')
+        parser.add_argument('--output', default=settings.UPSTREAM_FIXTURE_DIR,
+                            help='The directory where the fixtures are saved')
+        parser.add_argument('--synthetic', action='store_true',
+                            help='Generate random walk prices instead of requesting the upstream')
+        parser.add_argument('--seed', type=int, default=0, help='The seed of the synthetic prices')
+
+    def handle(self, *args, **options):
+        tickers = list(options['tickers'])
+        if options['indices']:
+            tickers += index_ticker_hash.values()
+        if options['all']:
+            tickers += StockTicker.objects.filter(delisted_date__isnull=True).values_list('ticker', flat=True)
+        if not tickers:
+            raise CommandError('No tickers to record, pass some tickers, --indices or --all')
+
+        output = str(options['output'])
+        start_epoch = options['start']
+        end_epoch = options['end'] or int(time.time())
+
+        if options['synthetic']:
+            for ticker in tickers:
+                save_fixture(output, ticker, synthesize_fixture(ticker, start_epoch, end_epoch, options['seed']))
+            self.stdout.write(self.style.SUCCESS(f"{len(tickers)} synthetic fixtures were written to {output}"))
+            return
+
+        failures = {}
+        with ThreadPoolExecutor(max_workers=settings.PRICE_FETCH_MAX_WORKERS) as executor:
+            futures = {ticker: executor.submit(record_fixture, output, ticker, start_epoch, end_epoch)
+                       for ticker in tickers}
+            for ticker, future in futures.items():
+                try:
+                    self.stdout.write(f"{ticker}: {future.result()} bars")
+                except Exception as error:
+                    failures[ticker] = str(error) or error.__class__.__name__
+                    self.stderr.write(f"{ticker}: {failures[ticker]}")
+
+        if failures:
+            raise CommandError(f"{len(failures)} of {len(tickers)} tickers could not be recorded")
+        self.stdout.write(self.style.SUCCESS(f"{len(tickers)} fixtures were written to {output}"))
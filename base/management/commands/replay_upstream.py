@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from base.replay import ReplayServer
+
+
+class Command(BaseCommand):
+    help = ('Serves the recorded fixtures as a local stand-in for the Yahoo Finance chart endpoint. Point the '
+            'application at it by setting the UPSTREAM_BASE_URL environment variable to the printed url')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixtures', default=settings.UPSTREAM_FIXTURE_DIR,
+                            help='The directory of the fixtures')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0, help='The seconds every response is delayed by')
+        parser.add_argument('--jitter', type=float, default=0,
+                            help='The seconds of random delay added on top of the latency')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='The share of requests answered with a 5xx error, between 0 and 1')
+        parser.add_argument('--seed', type=int, default=None, help='The seed of the injected delays and errors')
+        parser.add_argument('--synthesize', action='store_true',
+                            help='Answer tickers without a fixture with a synthetic history instead of a 404')
+
+    def handle(self, *args, **options):
+        server = ReplayServer(str(options['fixtures']), (options['host'], options['port']), options['latency'],
+                              options['jitter'], options['error_rate'], seed=options['seed'],
+                              synthesize=options['synthesize'])
+        self.stdout.write(f"Serving {options['fixtures']} at {server.url}, press CONTROL-C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,211 @@
+import contextlib
+import contextvars
+import math
+import threading
+import time
+
+# The upper bounds, in seconds, of the buckets of the duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The spans of the request being answered, collected by the ServerTimingMiddleware. The list is shared with the
+# copies of the context made by sync_to_async, so the spans of the threads it runs in are collected as well
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+
+def format_labels(labels):
+    """
+    :param labels: A tuple of (name, value) pairs
+    :return: A string of the labels of a sample, e.g. {stage="fetch"}, with the values escaped
+    """
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A value that only goes up, such as a number of requests, with one series per combination of labels.
+
+    :param name: A string representing the name of the metric, e.g. simulator_upstream_requests_total
+    :param documentation: A string describing the metric
+    :param labelnames: A tuple of the names of the labels of the metric
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def label_values(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self.label_values(labels), 0)
+
+    def samples(self):
+        """
+        :return: A list of (name, labels, value) tuples, where labels is a tuple of (name, value) pairs
+        """
+        with self._lock:
+            return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(Counter):
+    """
+    The distribution of a value, such as a duration, counted into cumulative buckets.
+
+    :param buckets: A tuple of the upper bounds of the buckets, in increasing order
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*buckets, math.inf)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            series = self._values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][position] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def get(self, **labels):
+        """
+        :return: A tuple of the number of observations and their sum
+        """
+        with self._lock:
+            series = self._values.get(self.label_values(labels))
+            return (series['count'], series['sum']) if series else (0, 0)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                labels = tuple(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, series['buckets']):
+                    samples.append((f"{self.name}_bucket", labels + (('le', format_value(bound)),), count))
+                samples.append((f"{self.name}_sum", labels, series['sum']))
+                samples.append((f"{self.name}_count", labels, series['count']))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process, rendered in the Prometheus text format by the metrics endpoint.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: A string of every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    'simulator_stage_seconds', 'Time spent in each stage of the simulation and of the requests', ('stage',)))
+request_seconds = registry.register(Histogram(
+    'simulator_request_seconds', 'Time spent answering requests, by view', ('view', 'status')))
+upstream_requests = registry.register(Counter(
+    'simulator_upstream_requests_total', 'Requests sent to the upstream, by client and status code',
+    ('client', 'status')))
+upstream_bytes_received = registry.register(Counter(
+    'simulator_upstream_bytes_received_total', 'Bytes of the bodies received from the upstream', ('client',)))
+cache_lookups = registry.register(Counter(
+    'simulator_cache_lookups_total', 'Lookups of the caches, by cache and result', ('cache', 'result')))
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Measures the time spent in a block of code as a stage. The duration is observed by the simulator_stage_seconds
+    histogram and added to the Server-Timing header of the request being answered, if any.
+
+    :param stage: A string representing the name of the stage, which must be a token, e.g. fetch or session_load
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, seconds))
+
+
+def record_cache_lookup(cache, hit):
+    cache_lookups.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def record_upstream_response(client, response):
+    """
+    Counts a request sent to the upstream and the bytes of its response.
+
+    :param client: A string representing the client that sent the request, either sync or async
+    :param response: A requests or httpx response, or None if the request failed without a response
+    """
+    if response is None:
+        upstream_requests.inc(client=client, status='error')
+        return
+    upstream_requests.inc(client=client, status=response.status_code)
+    upstream_bytes_received.inc(len(response.content), client=client)
+
+
+def start_request_spans():
+    """
+    Starts collecting the spans of a request in the current context.
+
+    :return: The list the spans are appended to, as (stage, seconds) tuples
+    """
+    spans = []
+    _request_spans.set(spans)
+    return spans
+
+
+def server_timing_header(spans, total_seconds):
+    """
+    Builds the value of a Server-Timing header, in milliseconds. The spans of the same stage are added up.
+
+    :param spans: A list of (stage, seconds) tuples
+    :param total_seconds: A number representing the seconds spent answering the whole request
+    :return: A string, e.g. "fetch;dur=120.5, assemble;dur=3.2, total;dur=130.1"
+    """
+    durations = {}
+    for stage, seconds in spans:
+        durations[stage] = durations.get(stage, 0) + seconds
+    durations['total'] = total_seconds
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items())
@@ -0,0 +1,134 @@
+import asyncio
+import cProfile
+import datetime
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+
+from .metrics import request_seconds, server_timing_header, start_request_spans
+from .profiling import StackSampler, save_profile, simulation_input_keys, start_profiling, stop_profiling
+
+
+class ServerTimingMiddleware:
+    """
+    Adds a Server-Timing header with the duration of every stage of the request to the response, so the browser's
+    developer tools show where the time went, and observes the duration of the request by view. It should come first
+    in MIDDLEWARE so the session and the other middleware are included in the total.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark the instance as a coroutine function, so Django awaits it
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        spans = start_request_spans()
+        start = time.perf_counter()
+        response = self.get_response(request)
+        return self.add_timing(request, response, spans, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        spans = start_request_spans()
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        return self.add_timing(request, response, spans, time.perf_counter() - start)
+
+    def add_timing(self, request, response, spans, seconds):
+        match = request.resolver_match
+        request_seconds.observe(seconds, view=match.view_name if match else 'unresolved', status=response.status_code)
+        response['Server-Timing'] = server_timing_header(spans, seconds)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a single request when a staff member asks for it with ?profile=1 or an X-Profile: 1 header. The request
+    runs under cProfile, which records every call of the thread answering it, while a StackSampler samples the stacks
+    of every thread. Both are saved in PROFILE_DIR with the simulation inputs of the session, and the response carries
+    the url of the profile in an X-Profile-Url header. It must come after the AuthenticationMiddleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Mark the instance as a coroutine function, so Django awaits it
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    @staticmethod
+    def profile_requested(request):
+        return request.GET.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        if not (self.profile_requested(request) and request.user.is_staff and start_profiling()):
+            return self.get_response(request)
+
+        try:
+            sampler, profile, start = self.start_profilers()
+            try:
+                response = self.get_response(request)
+            finally:
+                profile.disable()
+                sampler.stop()
+            return self.save(request, response, sampler, profile, time.perf_counter() - start)
+        finally:
+            stop_profiling()
+
+    async def __acall__(self, request):
+        if not self.profile_requested(request):
+            return await self.get_response(request)
+
+        # The user is loaded from the database, so this is run in a thread
+        if not (await sync_to_async(lambda: request.user.is_staff)() and start_profiling()):
+            return await self.get_response(request)
+
+        try:
+            sampler, profile, start = self.start_profilers()
+            try:
+                response = await self.get_response(request)
+            finally:
+                profile.disable()
+                sampler.stop()
+            return await sync_to_async(self.save)(request, response, sampler, profile, time.perf_counter() - start)
+        finally:
+            stop_profiling()
+
+    @staticmethod
+    def start_profilers():
+        sampler = StackSampler(settings.PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+        profile = cProfile.Profile()
+        profile.enable()
+        return sampler, profile, time.perf_counter()
+
+    def save(self, request, response, sampler, profile, seconds):
+        """
+        Saves the profile of a request, tagged with the request and the simulation inputs of the session.
+        """
+        session = request.session
+        metadata = {
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'user': request.user.get_username(),
+            'duration': seconds,
+            'simulation_inputs': {key: session[key] for key in simulation_input_keys if key in session},
+        }
+        profile_id = save_profile(settings.PROFILE_DIR, profile, sampler, metadata)
+
+        response['X-Profile-Id'] = profile_id
+        response['X-Profile-Url'] = reverse('profile_detail', args=[profile_id])
+        return response
@@ -0,0 +1,51 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:17
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_rename_first_trade_year_stockticker_first_trade_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=10)),
+                ('timestamp', models.IntegerField()),
+                ('open', models.FloatField(null=True)),
+                ('high', models.FloatField(null=True)),
+                ('low', models.FloatField(null=True)),
+                ('close', models.FloatField(null=True)),
+                ('adj_close', models.FloatField(null=True)),
+                ('volume', models.BigIntegerField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PriceCoverage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=10, unique=True)),
+                ('start_epoch', models.IntegerField()),
+                ('end_epoch', models.IntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='stockparameters',
+            name='index',
+            field=models.CharField(choices=[('S&P 500', 'S&P 500'), ('DJIA', 'DJIA'), ('NASDAQ-100', 'NASDAQ')], default='s&p', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='stockparameters',
+            name='money',
+            field=models.IntegerField(validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyprice',
+            constraint=models.UniqueConstraint(fields=('ticker', 'timestamp'), name='unique_daily_price'),
+        ),
+    ]
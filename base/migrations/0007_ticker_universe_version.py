@@ -0,0 +1,34 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("base", "0006_daily_price_store"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TickerUniverseVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("checksum", models.CharField(max_length=64)),
+                ("imported_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="stockticker",
+            name="ticker",
+            field=models.CharField(max_length=5, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("base", "0007_ticker_universe_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="stockticker",
+            name="first_trade_date",
+            field=models.IntegerField(db_index=True),
+        ),
+    ]
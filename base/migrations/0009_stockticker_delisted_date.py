@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("base", "0008_stockticker_first_trade_date_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stockticker",
+            name="delisted_date",
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -21,9 +21,44 @@ class StockParameters(models.Model):
         return f"Money: {self.money}, Date Range: {self.start_date}-{self.end_date}, Index: {self.index}"
 
 class StockTicker(models.Model):
-    ticker = models.CharField(max_length=5)
-    first_trade_date = models.IntegerField()
+    ticker = models.CharField(max_length=5, unique=True)
+    first_trade_date = models.IntegerField(db_index=True)
     company_name = models.CharField(max_length=255, default=None)
+    # The day (in epoch form) on which the ticker was first found missing from the exchange listings
+    delisted_date = models.IntegerField(null=True, blank=True, default=None)
 
     def __str__(self):
         return f"Symbol: {self.ticker}, First Trade Date: {self.first_trade_date}, Company Name: {self.company_name}"
+
+class TickerUniverseVersion(models.Model):
+    checksum = models.CharField(max_length=64)
+    imported_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Checksum: {self.checksum}, Imported At: {self.imported_at}"
+
+class DailyPrice(models.Model):
+    ticker = models.CharField(max_length=10)
+    timestamp = models.IntegerField()
+    open = models.FloatField(null=True)
+    high = models.FloatField(null=True)
+    low = models.FloatField(null=True)
+    close = models.FloatField(null=True)
+    adj_close = models.FloatField(null=True)
+    volume = models.BigIntegerField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ticker', 'timestamp'], name='unique_daily_price')
+        ]
+
+    def __str__(self):
+        return f"Symbol: {self.ticker}, Timestamp: {self.timestamp}, Close: {self.close}"
+
+class PriceCoverage(models.Model):
+    ticker = models.CharField(max_length=10, unique=True)
+    start_epoch = models.IntegerField()
+    end_epoch = models.IntegerField()
+
+    def __str__(self):
+        return f"Symbol: {self.ticker}, Covered Range: {self.start_epoch}-{self.end_epoch}"
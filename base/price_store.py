@@ -0,0 +1,423 @@
+import asyncio
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .coalescing import AsyncRangeCoalescer, RangeCoalescer
+from .index_cache import index_cache
+from .metrics import record_cache_lookup
+from .models import DailyPrice, PriceCoverage
+
+# The columns kept for every trading day, in the order they are returned by load_price_history
+price_fields = ('timestamp', 'open', 'high', 'low', 'close', 'adj_close', 'volume')
+
+# Rows are written in batches to keep the size of each INSERT statement reasonable
+BULK_BATCH_SIZE = 1000
+
+SECONDS_PER_DAY = 86400
+
+
+# Shared by every request so that the number of concurrent upstream requests stays bounded per worker
+_fetch_executor = None
+
+
+class PriceDataUnavailable(Exception):
+    """
+    Raised when the upstream response does not contain any historical data for the requested ticker.
+    """
+
+
+class PriceFetchError(Exception):
+    """
+    Raised when the historical data of one or more tickers could not be fetched.
+
+    :param failures: A dictionary with key value pairs of Ticker:Error message for every ticker that failed
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(', '.join(f"{ticker}: {message}" for ticker, message in failures.items()))
+
+
+def parse_chart_response(data):
+    """
+    Converts the JSON payload returned by the Yahoo Finance chart endpoint into a dictionary of columns.
+
+    :param data: A dictionary containing the server's response, as returned by query_historical_stock_data
+    :return history: A dictionary with one list per entry of price_fields. A day without a value holds None
+    """
+    chart = data.get('chart') or {}
+    result = chart.get('result')
+    if not result:
+        raise PriceDataUnavailable(chart.get('error') or 'The response does not contain any results')
+
+    result = result[0]
+    timestamps = result.get('timestamp') or []
+    quote = (result.get('indicators', {}).get('quote') or [{}])[0]
+    adjclose = (result.get('indicators', {}).get('adjclose') or [{}])[0]
+
+    empty_column = [None] * len(timestamps)
+    history = {
+        'timestamp': timestamps,
+        'open': quote.get('open') or empty_column,
+        'high': quote.get('high') or empty_column,
+        'low': quote.get('low') or empty_column,
+        'close': quote.get('close') or empty_column,
+        'adj_close': adjclose.get('adjclose') or empty_column,
+        'volume': quote.get('volume') or empty_column,
+    }
+    return history
+
+
+def missing_ranges(ticker, start_epoch, end_epoch):
+    """
+    Finds the ranges that have to be requested from the upstream so that [start_epoch, end_epoch) is fully stored.
+    The stored range of a ticker is always kept contiguous, so a request that does not overlap it is widened until it
+    touches the stored range.
+
+    :param ticker: A string that represents the specific ticker that is used
+    :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+    :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+    :return ranges: A list of (start, end) tuples in epoch form. Empty if the range is already stored
+    """
+    coverage = PriceCoverage.objects.filter(ticker=ticker).first()
+    if coverage is None:
+        return [(start_epoch, end_epoch)]
+
+    ranges = []
+    if start_epoch < coverage.start_epoch:
+        ranges.append((start_epoch, coverage.start_epoch))
+    if end_epoch > coverage.end_epoch:
+        ranges.append((coverage.end_epoch, end_epoch))
+    return ranges
+
+
+def save_price_history(ticker, history, start_epoch, end_epoch):
+    """
+    Saves the rows of a parsed upstream response and extends the stored range of the ticker to include
+    [start_epoch, end_epoch). Rows that are already stored are left untouched. The stored range is only extended when
+    the fetched range overlaps or touches it, since merging disjoint ranges would mark the days between them as stored.
+    Otherwise, the larger of the two ranges is kept.
+
+    :param ticker: A string that represents the specific ticker that is used
+    :param history: A dictionary of columns, as returned by parse_chart_response
+    :param start_epoch: An integer representing the start of the fetched range in epoch form
+    :param end_epoch: An integer representing the end of the fetched range in epoch form
+    :return: None
+    """
+    # The bar of the current day is still changing, so it is never considered final
+    today_epoch = int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    end_epoch = min(end_epoch, today_epoch)
+
+    rows = [
+        DailyPrice(ticker=ticker, timestamp=timestamp, open=open_price, high=high, low=low, close=close,
+                   adj_close=adj_close, volume=volume)
+        for timestamp, open_price, high, low, close, adj_close, volume in zip(*(history[f] for f in price_fields))
+        if timestamp < end_epoch
+    ]
+
+    with transaction.atomic():
+        DailyPrice.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+
+        if end_epoch <= start_epoch:
+            return
+
+        coverage, created = PriceCoverage.objects.select_for_update().get_or_create(
+            ticker=ticker,
+            defaults={'start_epoch': start_epoch, 'end_epoch': end_epoch}
+        )
+        if created:
+            return
+
+        if start_epoch <= coverage.end_epoch and end_epoch >= coverage.start_epoch:
+            coverage.start_epoch = min(coverage.start_epoch, start_epoch)
+            coverage.end_epoch = max(coverage.end_epoch, end_epoch)
+        elif end_epoch - start_epoch > coverage.end_epoch - coverage.start_epoch:
+            coverage.start_epoch, coverage.end_epoch = start_epoch, end_epoch
+        else:
+            return
+        coverage.save(update_fields=['start_epoch', 'end_epoch'])
+
+
+def load_price_history(ticker, start_epoch, end_epoch):
+    """
+    Reads the stored trading days of a ticker that fall within [start_epoch, end_epoch).
+
+    :param ticker: A string that represents the specific ticker that is used
+    :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+    :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+    :return history: A dictionary with one NumPy array per entry of price_fields, sorted by timestamp. Missing prices
+    are NaN
+    """
+    rows = DailyPrice.objects.filter(
+        ticker=ticker,
+        timestamp__gte=start_epoch,
+        timestamp__lt=end_epoch
+    ).order_by('timestamp').values_list(*price_fields)
+
+    columns = list(zip(*rows)) or [()] * len(price_fields)
+    history = {'timestamp': np.array(columns[0], dtype=np.int64)}
+    for field, column in zip(price_fields[1:], columns[1:]):
+        history[field] = np.array(column, dtype=np.float64)
+    return history
+
+
+def get_fetch_executor():
+    """
+    Returns the thread pool used to send the upstream requests, creating it on first use.
+
+    :return: A ThreadPoolExecutor with PRICE_FETCH_MAX_WORKERS threads
+    """
+    global _fetch_executor
+    if _fetch_executor is None:
+        _fetch_executor = ThreadPoolExecutor(max_workers=settings.PRICE_FETCH_MAX_WORKERS,
+                                             thread_name_prefix='price-fetch')
+    return _fetch_executor
+
+
+def _query_range(ticker, start_epoch, end_epoch, timeout):
+    """
+    Requests a single range of a ticker from the upstream and parses the response.
+    """
+    # Imported here since utils imports this module to read the stored prices
+    from .utils import query_historical_stock_data
+
+    return parse_chart_response(query_historical_stock_data(ticker, start_epoch, end_epoch, timeout=timeout))
+
+
+# Concurrent requests of the same ticker from different users share a single upstream fetch
+_coalescer = RangeCoalescer(_query_range)
+
+
+def _fetch_missing_ranges(ticker, ranges, timeout):
+    """
+    Requests every missing range of a ticker from the upstream. Runs inside the fetch thread pool, so it must not
+    touch the database.
+
+    :return fetched: A list of (start, end, history) tuples, one per range
+    """
+    return [(range_start, range_end, _coalescer.get(ticker, range_start, range_end, timeout))
+            for range_start, range_end in ranges]
+
+
+async def _aquery_range(ticker, start_epoch, end_epoch, timeout):
+    """
+    Requests a single range of a ticker from the upstream without blocking the event loop, and parses the response.
+    """
+    from .utils import aquery_historical_stock_data
+
+    return parse_chart_response(await aquery_historical_stock_data(ticker, start_epoch, end_epoch, timeout=timeout))
+
+
+_async_coalescer = AsyncRangeCoalescer(_aquery_range)
+
+
+async def _afetch_missing_ranges(ticker, ranges, timeout):
+    """
+    Requests every missing range of a ticker from the upstream, one after the other. Must not touch the database.
+
+    :return fetched: A list of (start, end, history) tuples, one per range
+    """
+    return [(range_start, range_end, await _async_coalescer.get(ticker, range_start, range_end, timeout))
+            for range_start, range_end in ranges]
+
+
+def plan_price_fetches(tickers, start_epoch, end_epoch, use_index_cache=True):
+    """
+    Finds what has to be requested from the upstream so that the daily prices of several tickers within
+    [start_epoch, end_epoch) are available. The benchmark indices are sliced from the in-memory index cache when it
+    holds the range.
+
+    :return: A tuple of the histories that are already available, as a dictionary of Ticker:History, the tickers that
+    have to be read from the database, and a dictionary of Ticker:Missing ranges for the tickers that have to be
+    requested first
+    """
+    tickers = list(dict.fromkeys(tickers))
+
+    histories = {}
+    if use_index_cache:
+        for ticker in tickers:
+            cached_history = index_cache.get(ticker, start_epoch, end_epoch)
+            if cached_history is not None:
+                histories[ticker] = cached_history
+            if ticker in index_cache.tickers:
+                record_cache_lookup('index', cached_history is not None)
+        tickers = [ticker for ticker in tickers if ticker not in histories]
+
+    fetches = {}
+    for ticker in tickers:
+        ranges = missing_ranges(ticker, start_epoch, end_epoch)
+        record_cache_lookup('price_store', not ranges)
+        if ranges:
+            fetches[ticker] = ranges
+    return histories, tickers, fetches
+
+
+def _load_fetched_history(ticker, fetched, failures, start_epoch, end_epoch):
+    """
+    Saves the ranges of a ticker that were requested from the upstream and reads its stored slice.
+
+    :return history: The dictionary returned by load_price_history, or None if the ticker has no data in the range, in
+    which case it is added to failures
+    """
+    for range_start, range_end, history in fetched:
+        save_price_history(ticker, history, range_start, range_end)
+
+    history = load_price_history(ticker, start_epoch, end_epoch)
+    if not len(history['timestamp']):
+        failures[ticker] = 'No historical data in the selected date range'
+        return None
+    return history
+
+
+def store_price_fetches(histories, tickers, fetched, failures, start_epoch, end_epoch):
+    """
+    Saves the ranges that were requested from the upstream, then reads the stored slice of every ticker.
+
+    :param histories: A dictionary of Ticker:History, as returned by plan_price_fetches. It is completed in place
+    :param tickers: A list of the tickers that have to be read from the database
+    :param fetched: A dictionary of Ticker:List of (start, end, history) tuples for the tickers that were requested
+    :param failures: A dictionary of Ticker:Error message for the tickers that could not be requested
+    :return histories: A dictionary with key value pairs of Ticker:History
+    :raises PriceFetchError: If any of the tickers failed
+    """
+    for ticker in tickers:
+        if ticker not in failures:
+            history = _load_fetched_history(ticker, fetched.get(ticker, []), failures, start_epoch, end_epoch)
+            if history is not None:
+                histories[ticker] = history
+
+    if failures:
+        raise PriceFetchError(failures)
+
+    return histories
+
+
+def fetch_price_histories(tickers, start_epoch, end_epoch, use_index_cache=True):
+    """
+    Returns the daily prices of several tickers within [start_epoch, end_epoch). The benchmark indices are sliced from
+    the in-memory index cache when it holds the range. The missing ranges of every other ticker are requested from the
+    upstream concurrently.
+
+    :param tickers: An iterable of strings representing the tickers that are used
+    :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+    :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+    :param use_index_cache: A boolean value to determine whether the index cache should be looked up
+    :return histories: A dictionary with key value pairs of Ticker:History, where each history is the dictionary
+    returned by load_price_history
+    :raises PriceFetchError: If any of the tickers could not be fetched, after all the other requests have finished
+    """
+    return dict(iter_price_histories(tickers, start_epoch, end_epoch, use_index_cache))
+
+
+def iter_price_histories(tickers, start_epoch, end_epoch, use_index_cache=True):
+    """
+    Yields the daily prices of several tickers within [start_epoch, end_epoch) as soon as each of them is available.
+    The tickers that do not need any upstream request come first, and the others follow in the order their requests
+    finish. The failures are only raised once every ticker has been yielded or has failed.
+
+    :param tickers: An iterable of strings representing the tickers that are used
+    :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+    :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+    :param use_index_cache: A boolean value to determine whether the index cache should be looked up
+    :return: A generator of (ticker, history) tuples, where each history is the dictionary returned by
+    load_price_history
+    :raises PriceFetchError: If any of the tickers could not be fetched
+    """
+    timeout = settings.PRICE_FETCH_TIMEOUT
+    # Each ticker may need up to two ranges, so give each of them room for two requests
+    time_limit = timeout * 2
+    failures = {}
+
+    # The time each fetch started running in the pool, so a ticker waiting for a thread is not timed out by the
+    # others
+    started = {}
+
+    def fetch(ticker, ranges):
+        started[ticker] = time.monotonic()
+        return _fetch_missing_ranges(ticker, ranges, timeout)
+
+    # The database is only accessed from this thread, the pool threads only talk to the upstream
+    histories, tickers, fetches = plan_price_fetches(tickers, start_epoch, end_epoch, use_index_cache)
+    submitted = time.monotonic()
+    futures = {get_fetch_executor().submit(fetch, ticker, ranges): ticker for ticker, ranges in fetches.items()}
+
+    yield from histories.items()
+    for ticker in tickers:
+        if ticker not in fetches:
+            history = _load_fetched_history(ticker, [], failures, start_epoch, end_epoch)
+            if history is not None:
+                yield ticker, history
+
+    # A fetch times out once it has run for time_limit seconds, or if it could not start within time_limit seconds
+    def deadline(future):
+        return started.get(futures[future], submitted) + time_limit
+
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=max(min(map(deadline, pending)) - time.monotonic(), 0),
+                             return_when=FIRST_COMPLETED)
+
+        for future in done:
+            ticker = futures[future]
+            try:
+                fetched = future.result()
+            except Exception as error:
+                failures[ticker] = str(error) or error.__class__.__name__
+                continue
+
+            history = _load_fetched_history(ticker, fetched, failures, start_epoch, end_epoch)
+            if history is not None:
+                yield ticker, history
+
+        now = time.monotonic()
+        for future in [future for future in pending if deadline(future) <= now]:
+            future.cancel()
+            pending.discard(future)
+            failures[futures[future]] = f"Timed out after {time_limit} seconds"
+
+    if failures:
+        raise PriceFetchError(failures)
+
+
+async def afetch_price_histories(tickers, start_epoch, end_epoch, use_index_cache=True):
+    """
+    Returns the daily prices of several tickers within [start_epoch, end_epoch), like fetch_price_histories, but the
+    upstream is requested from the running event loop instead of a thread pool. Only the database access runs in a
+    thread.
+
+    :param tickers: An iterable of strings representing the tickers that are used
+    :param start_epoch: An integer representing the start of the range in epoch form (inclusive)
+    :param end_epoch: An integer representing the end of the range in epoch form (exclusive)
+    :param use_index_cache: A boolean value to determine whether the index cache should be looked up
+    :return histories: A dictionary with key value pairs of Ticker:History, where each history is the dictionary
+    returned by load_price_history
+    :raises PriceFetchError: If any of the tickers could not be fetched, after all the other requests have finished
+    """
+    timeout = settings.PRICE_FETCH_TIMEOUT
+    time_limit = timeout * 2
+
+    histories, tickers, fetches = await sync_to_async(plan_price_fetches)(tickers, start_epoch, end_epoch,
+                                                                          use_index_cache)
+    # Every ticker has its own time limit, so a slow ticker does not fail the others
+    tasks = {asyncio.create_task(asyncio.wait_for(_afetch_missing_ranges(ticker, ranges, timeout), time_limit)): ticker
+             for ticker, ranges in fetches.items()}
+
+    if tasks:
+        await asyncio.wait(tasks)
+
+    fetched = {}
+    failures = {}
+    for task, ticker in tasks.items():
+        try:
+            fetched[ticker] = task.result()
+        except asyncio.TimeoutError:
+            failures[ticker] = f"Timed out after {time_limit} seconds"
+        except Exception as error:
+            failures[ticker] = str(error) or error.__class__.__name__
+
+    return await sync_to_async(store_price_fetches)(histories, tickers, fetched, failures, start_epoch, end_epoch)
@@ -0,0 +1,142 @@
+import contextvars
+import datetime
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+from collections import Counter
+
+# Whether the request being answered is profiled. Work that would leave the process, such as rendering the graphs in
+# a process pool, stays in it while this is set, so the profilers see it
+_profiling = contextvars.ContextVar('profiling', default=False)
+
+# The files stored for every profile, by kind
+profile_kinds = {
+    'pstats': '.pstats',
+    'collapsed': '.collapsed',
+    'meta': '.json',
+}
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+
+# The session variables saved along with a profile, which are the inputs of the simulation
+simulation_input_keys = ('money', 'start_date', 'end_date', 'index', 'portfolio')
+
+# Only one request is profiled at a time, since the sampler sees every thread of the process
+_profile_lock = threading.Lock()
+
+
+def is_profiling():
+    return _profiling.get()
+
+
+def start_profiling():
+    """
+    Marks the current context as profiled, unless another request is already being profiled.
+
+    :return: A boolean value that is True if the request can be profiled, in which case stop_profiling must be called
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return False
+    _profiling.set(True)
+    return True
+
+
+def stop_profiling():
+    _profiling.set(False)
+    _profile_lock.release()
+
+
+class StackSampler(threading.Thread):
+    """
+    A sampling profiler that records the stack of every thread of the process every interval seconds. Unlike cProfile,
+    which only follows the thread it was enabled in, the sampler also sees the event loop, the thread pools and the
+    threads of sync_to_async. The stacks are counted in the collapsed format of flame graphs, with the name of the
+    thread as their root.
+
+    :param interval: A number representing the seconds between two samples
+    """
+
+    def __init__(self, interval):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join([thread_names.get(thread_id, str(thread_id)), *reversed(frames)])] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed_stacks(self):
+        """
+        :return: A string with one line per distinct stack, its frames separated by semicolons and followed by the
+        number of samples it was seen in, as read by flamegraph.pl or speedscope
+        """
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def new_profile_id():
+    return f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}-{secrets.token_hex(4)}"
+
+
+def profile_path(directory, profile_id, kind):
+    """
+    :return: The path of a file of a profile, or None if the identifier or the kind are not valid
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id) or kind not in profile_kinds:
+        return None
+    return os.path.join(directory, f"{profile_id}{profile_kinds[kind]}")
+
+
+def save_profile(directory, profile, sampler, metadata):
+    """
+    Writes the deterministic profile, the sampled stacks and the metadata of a profiled request.
+
+    :param directory: A string representing the directory the profiles are kept in
+    :param profile: A cProfile.Profile that was enabled while the request was answered
+    :param sampler: A StackSampler that ran while the request was answered
+    :param metadata: A JSON serializable dictionary describing the request, such as its simulation inputs
+    :return profile_id: A string identifying the profile
+    """
+    os.makedirs(directory, exist_ok=True)
+    profile_id = new_profile_id()
+
+    profile.dump_stats(profile_path(directory, profile_id, 'pstats'))
+    with open(profile_path(directory, profile_id, 'collapsed'), 'w', encoding='utf-8') as f:
+        f.write(sampler.collapsed_stacks())
+    with open(profile_path(directory, profile_id, 'meta'), 'w', encoding='utf-8') as f:
+        json.dump({'id': profile_id, 'samples': sampler.samples, **metadata}, f, indent=2, default=str)
+    return profile_id
+
+
+def list_profiles(directory):
+    """
+    :return: A list of the metadata of the profiles in a directory, the most recent first
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if name.endswith(profile_kinds['meta']):
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                profiles.append(json.load(f))
+    return profiles
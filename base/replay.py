@@ -0,0 +1,261 @@
+import bisect
+import calendar
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+# The indicators of the chart endpoint kept in a fixture, besides the timestamps and the adjusted closing prices
+quote_fields = ('open', 'high', 'low', 'close', 'volume')
+
+FIXTURE_SUFFIX = '.json.gz'
+
+CHART_PATH_PREFIX = '/v8/finance/chart/'
+
+# Yahoo Finance stamps each daily bar with the opening time of the market, 14:30 UTC
+MARKET_OPEN_SECONDS = 52200
+
+SECONDS_PER_DAY = 86400
+
+# The first day a simulation can start on, from which the fixtures generated on demand begin
+SYNTHETIC_START_EPOCH = calendar.timegm((1985, 9, 30, 0, 0, 0))
+
+
+def fixture_path(directory, ticker):
+    return os.path.join(directory, f"{ticker}{FIXTURE_SUFFIX}")
+
+
+def chart_to_fixture(data):
+    """
+    Converts a response of the chart endpoint into a fixture, which keeps the metadata and one list per column.
+
+    :param data: A dictionary containing the server's response, as returned by query_historical_stock_data
+    :return fixture: A dictionary with the meta, timestamp, adjclose and quote_fields keys
+    """
+    result = data['chart']['result'][0]
+    timestamps = result.get('timestamp') or []
+    quote = (result.get('indicators', {}).get('quote') or [{}])[0]
+    adjclose = (result.get('indicators', {}).get('adjclose') or [{}])[0]
+
+    fixture = {'meta': result.get('meta') or {}, 'timestamp': timestamps,
+               'adjclose': adjclose.get('adjclose') or [None] * len(timestamps)}
+    for field in quote_fields:
+        fixture[field] = quote.get(field) or [None] * len(timestamps)
+    return fixture
+
+
+def fixture_to_chart(fixture, start_epoch=None, end_epoch=None, last_bar_only=False):
+    """
+    Builds a response of the chart endpoint from the bars of a fixture that fall within [start_epoch, end_epoch).
+
+    :param fixture: A dictionary, as returned by chart_to_fixture
+    :param start_epoch: An integer representing the start of the range in epoch form, or None for the first bar
+    :param end_epoch: An integer representing the end of the range in epoch form, or None for the last bar
+    :param last_bar_only: A boolean value to determine whether only the last bar is returned, as for a range=1d request
+    :return: A dictionary with the same structure as the response of the chart endpoint
+    """
+    timestamps = fixture['timestamp']
+    low = 0 if start_epoch is None else bisect.bisect_left(timestamps, start_epoch)
+    high = len(timestamps) if end_epoch is None else bisect.bisect_left(timestamps, end_epoch)
+    if last_bar_only:
+        low = max(high - 1, 0)
+
+    return {
+        'chart': {
+            'result': [{
+                'meta': fixture['meta'],
+                'timestamp': timestamps[low:high],
+                'indicators': {
+                    'quote': [{field: fixture[field][low:high] for field in quote_fields}],
+                    'adjclose': [{'adjclose': fixture['adjclose'][low:high]}]
+                }
+            }],
+            'error': None
+        }
+    }
+
+
+def save_fixture(directory, ticker, fixture):
+    """
+    Writes a fixture as compact, gzipped JSON. The file is replaced at once.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = fixture_path(directory, ticker)
+    with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as f:
+        json.dump(fixture, f, separators=(',', ':'))
+    os.replace(f"{path}.tmp", path)
+
+
+def load_fixture(directory, ticker):
+    """
+    :return: The fixture of a ticker, as returned by chart_to_fixture, or None if it was not recorded
+    """
+    try:
+        with gzip.open(fixture_path(directory, ticker), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def record_fixture(directory, ticker, start_epoch, end_epoch):
+    """
+    Requests the history of a ticker within [start_epoch, end_epoch) from the upstream and saves it as a fixture.
+
+    :return: The number of bars that were recorded
+    """
+    # Imported here since utils is only needed when recording
+    from .utils import query_historical_stock_data
+
+    fixture = chart_to_fixture(query_historical_stock_data(ticker, start_epoch, end_epoch))
+    save_fixture(directory, ticker, fixture)
+    return len(fixture['timestamp'])
+
+
+def synthesize_fixture(ticker, start_epoch, end_epoch, seed=0):
+    """
+    Generates a fixture with one bar per weekday within [start_epoch, end_epoch), following a random walk. The same
+    ticker and seed always give the same prices.
+
+    :return fixture: A dictionary, as returned by chart_to_fixture
+    """
+    first_day, last_day = start_epoch // SECONDS_PER_DAY, (end_epoch - 1) // SECONDS_PER_DAY
+    days = np.arange(first_day, last_day + 1)
+    # 1970-01-01 was a Thursday, so the weekends are the days 2 and 3 modulo 7
+    days = days[(days + 3) % 7 < 5]
+    timestamps = days * SECONDS_PER_DAY + MARKET_OPEN_SECONDS
+
+    generator = np.random.default_rng([seed, *ticker.encode('utf-8')])
+    close = np.round(100 * np.exp(np.cumsum(generator.normal(0.0003, 0.02, len(days)))), 4)
+    spread = np.round(close * generator.uniform(0, 0.01, len(days)), 4)
+
+    fixture = {
+        'meta': {'symbol': ticker, 'firstTradeDate': int(timestamps[0]) if len(timestamps) else None},
+        'timestamp': timestamps.tolist(),
+        'adjclose': close.tolist(),
+        'open': close.tolist(),
+        'high': (close + spread).tolist(),
+        'low': (close - spread).tolist(),
+        'close': close.tolist(),
+        'volume': generator.integers(10 ** 5, 10 ** 7, len(days)).tolist(),
+    }
+    return fixture
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests to the chart endpoint from the fixtures of the server, as Yahoo Finance would.
+    """
+    # Keep the connections alive, so the pooled upstream client reuses them
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.startswith(CHART_PATH_PREFIX):
+            return self.send_json(404, {'error': 'Not Found'})
+
+        delay, error_status = self.server.draw_fault()
+        time.sleep(delay)
+        if error_status:
+            return self.send_json(error_status, {'chart': {'result': None, 'error': {
+                'code': 'Injected', 'description': f"Injected {error_status} error"}}})
+
+        ticker = unquote(url.path[len(CHART_PATH_PREFIX):])
+        fixture = self.server.get_fixture(ticker)
+        if fixture is None:
+            return self.send_json(404, {'chart': {'result': None, 'error': {
+                'code': 'Not Found', 'description': 'No data found, symbol may be delisted'}}})
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        start_epoch = int(params['period1']) if 'period1' in params else None
+        end_epoch = int(params['period2']) if 'period2' in params else None
+        self.send_json(200, fixture_to_chart(fixture, start_epoch, end_epoch, last_bar_only='range' in params))
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Yahoo Finance chart endpoint that serves recorded or synthetic fixtures, so the whole
+    pipeline can run without network access. Latency and errors can be injected to reproduce a slow or flaky upstream,
+    drawn from a seeded generator so a run can be repeated.
+
+    :param fixture_dir: A string representing the directory of the fixtures
+    :param address: A (host, port) tuple. Port 0 picks a free port
+    :param latency: A number representing the seconds every response is delayed by
+    :param jitter: A number representing the seconds of random delay added on top of latency
+    :param error_rate: A number between 0 and 1 representing the share of requests answered with an error
+    :param error_statuses: A tuple of the status codes of the injected errors
+    :param seed: The seed of the generator drawing the delays and errors
+    :param synthesize: A boolean value to determine whether tickers without a fixture are answered with a synthetic
+    history up to the current day, rather than as unknown tickers
+    """
+    daemon_threads = True
+
+    def __init__(self, fixture_dir, address=('127.0.0.1', 0), latency=0, jitter=0, error_rate=0,
+                 error_statuses=(500, 502, 503), seed=None, synthesize=False):
+        super().__init__(address, ReplayHandler)
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.random = random.Random(seed)
+        self.synthesize = synthesize
+        self._fixtures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw_fault(self):
+        """
+        :return: A tuple of the seconds to delay the response by and the status code of the error to answer with, or
+        None to answer normally
+        """
+        with self._lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+            return delay, self.random.choice(self.error_statuses) if failed else None
+
+    def get_fixture(self, ticker):
+        """
+        Returns the fixture of a ticker, reading it from disk (or generating it) on first use.
+        """
+        with self._lock:
+            if ticker not in self._fixtures:
+                fixture = load_fixture(self.fixture_dir, ticker)
+                if fixture is None and self.synthesize:
+                    end_epoch = int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+                    fixture = synthesize_fixture(ticker, SYNTHETIC_START_EPOCH, end_epoch)
+                self._fixtures[ticker] = fixture
+            return self._fixtures[ticker]
+
+    def start(self):
+        """
+        Serves the requests from a daemon thread.
+
+        :return: The server itself, to be used as a context manager
+        """
+        threading.Thread(target=self.serve_forever, name='replay-server', daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        super().__exit__(*args)
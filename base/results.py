@@ -0,0 +1,270 @@
+import hashlib
+import json
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from .alignment import SECONDS_PER_DAY, AlignmentError, align_series, to_trading_days
+from .charts import render_charts, serialize_plotting_df
+from .indices import index_ticker_hash
+from .metrics import record_cache_lookup, timed
+from .profiling import is_profiling
+from .price_store import PriceFetchError, iter_price_histories
+from .utils import (acreate_plotting_df, assemble_plotting_df, create_plotting_df, calculate_overall_stock_change,
+                    simulation_epochs, value_portfolio)
+
+# How the graphs of the Results page are drawn
+#   server: rendered into PNG images with matplotlib
+#   client: the series are sent as JSON and plotted by the browser
+chart_modes = ('server', 'client')
+
+
+def results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Builds the cache key of a simulation from a canonical hash of its inputs, so the same portfolio always maps to the
+    same key regardless of the order in which the stocks were picked.
+
+    :param start_date: A string that represents the start date set by the user in the format YYYY-MM-DD
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes, since each mode caches a different representation of the graphs
+    :return: A string representing the cache key
+    """
+    simulation_inputs = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'portfolio': {ticker: int(amount) for ticker, amount in stock_portfolio.items()},
+        'index': index,
+    }
+    canonical_inputs = json.dumps(simulation_inputs, sort_keys=True, separators=(',', ':'))
+    return f"results:{chart_mode}:" + hashlib.sha256(canonical_inputs.encode('utf-8')).hexdigest()
+
+
+def error_messages(error):
+    """
+    Describes why a simulation failed, as shown by the Results page.
+
+    :param error: The exception raised by the simulation, usually a PriceFetchError or an AlignmentError
+    :return: A dictionary of Ticker:Error message, where the ticker is empty for errors that are not specific to one
+    """
+    if isinstance(error, PriceFetchError):
+        return error.failures
+    if isinstance(error, AlignmentError):
+        return {error.ticker or '': error.reason}
+    return {'': str(error) or error.__class__.__name__}
+
+
+def results_cache_timeout(end_date):
+    """
+    Returns the number of seconds the results of a simulation are cached. The prices of past days do not change, but
+    while the simulation runs up to today or later, the bar of the current day is still changing and new days are
+    added, so its results are only kept for RESULTS_OPEN_WINDOW_TIMEOUT seconds.
+
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :return: A number of seconds, or DEFAULT_TIMEOUT to use the TIMEOUT of the results cache
+    """
+    _, end_date_epoch = simulation_epochs(end_date, end_date)
+    today_epoch = int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    if end_date_epoch >= today_epoch:
+        return settings.RESULTS_OPEN_WINDOW_TIMEOUT
+    return DEFAULT_TIMEOUT
+
+
+def compute_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Runs the whole simulation and returns everything that is displayed in the Results page.
+
+    :param start_date: A string that represents the start date set by the user in the format YYYY-MM-DD
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes. With 'server', the graphs are PNG images encoded in base64. With 'client',
+    the series to plot are returned under chart_data instead
+    :return results: A dictionary containing the graphs and the rows of the tables
+    """
+    plotting_df = create_plotting_df(start_date, end_date, stock_portfolio, index)
+    return summarize_plotting_df(plotting_df, index, chart_mode)
+
+
+async def acompute_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Runs the whole simulation like compute_results, waiting on the upstream without blocking the event loop. The
+    graphs are drawn in a thread, since rendering them blocks. While the request is profiled, that thread is the one
+    answering the request under WSGI, which is the thread cProfile follows.
+
+    :return results: A dictionary, as returned by compute_results
+    """
+    plotting_df = await acreate_plotting_df(start_date, end_date, stock_portfolio, index)
+    return await sync_to_async(summarize_plotting_df, thread_sensitive=is_profiling())(plotting_df, index, chart_mode)
+
+
+def summarize_plotting_df(plotting_df, index, chart_mode='server'):
+    """
+    Computes the rows of the tables and draws the graphs of the Results page from the dataframe of a simulation.
+
+    :param plotting_df: A pandas dataframe returned by the create_plotting_df function
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes
+    :return results: A dictionary, as returned by compute_results
+    """
+    portfolio_historical_data = plotting_df['Portfolio Value'].values.tolist()
+    index_historical_data = plotting_df['Index Value'].values.tolist()
+
+    portfolio_result = calculate_overall_stock_change(portfolio_historical_data)
+    index_result = calculate_overall_stock_change(index_historical_data)
+
+    portfolio_df = plotting_df.iloc[:, 4:]
+    individual_stocks = [stock_row(ticker, portfolio_df[ticker].values) for ticker in portfolio_df]
+
+    results = {
+        # The data to be displayed
+        'portfolio_change': portfolio_result,
+        'portfolio_value': round(portfolio_historical_data[-1], 2),
+        'index_change': index_result,
+        'index_value': round(index_historical_data[-1], 2),
+        'individual_stocks': individual_stocks,
+    }
+
+    # The graphs
+    if chart_mode == 'client':
+        with timed('serialize'):
+            results['chart_data'] = serialize_plotting_df(plotting_df, index)
+    else:
+        with timed('render'):
+            results['portfolio_vs_index_raw'], results['portfolio_raw'] = render_charts(
+                plotting_df, index, [(False, False), (True, False)], settings.CHART_RENDER_WORKERS
+            )
+
+    return results
+
+
+def stock_row(ticker, holding_values):
+    """
+    Builds the row of a stock in the table of the Results page.
+
+    :param ticker: A string that represents the specific ticker that is used
+    :param holding_values: An array of the value of the holding in dollars on every trading day
+    :return: A list of the ticker, the final value, the change in dollars and the change in percentages
+    """
+    stock_result = calculate_overall_stock_change(holding_values)
+    return [ticker, round(float(holding_values[-1]), 2), stock_result[1], stock_result[0]]
+
+
+def holding_row(ticker, history, amount_invested):
+    """
+    Builds the row of a stock from its own prices only. With the ffill gap policy, this is the same row as the one
+    built from the whole simulation, since a holding is worth its amount times its last price over its first price.
+
+    :param ticker: A string that represents the specific ticker that is used
+    :param history: A dictionary of columns, as returned by load_price_history
+    :param amount_invested: A number representing the amount invested in the stock
+    :return: A list, as returned by stock_row
+    """
+    trading_days = np.unique(to_trading_days(history['timestamp']))
+    try:
+        prices = align_series(history['timestamp'], history['close'], trading_days, 'ffill')
+    except AlignmentError as error:
+        raise AlignmentError(error.reason, ticker=ticker) from None
+    holdings_value, _ = value_portfolio(prices[:, np.newaxis], [amount_invested])
+    return stock_row(ticker, holdings_value[:, 0])
+
+
+def iter_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Runs a simulation like get_results, but yields the row of each stock as soon as it can be shown, so the Results
+    page can be sent progressively. With the ffill gap policy, a row is yielded as soon as the prices of its stock
+    arrive. Otherwise, the rows follow once every price has arrived.
+
+    :param start_date: A string that represents the start date set by the user in the format YYYY-MM-DD
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes
+    :return: A generator of ('stock', row) tuples, one per stock, followed by a single ('results', results) tuple,
+    where results is the dictionary returned by compute_results
+    :raises PriceFetchError: If any of the tickers could not be fetched, after the rows of the others were yielded
+    """
+    results = get_cached_results(start_date, end_date, stock_portfolio, index, chart_mode)
+    rows_yielded = False
+
+    if results is None:
+        index_ticker = index_ticker_hash[index]
+        start_date_epoch, end_date_epoch = simulation_epochs(start_date, end_date)
+        rows_yielded = settings.PRICE_GAP_POLICY == 'ffill'
+
+        price_histories = {}
+        for ticker, history in iter_price_histories(list(stock_portfolio) + [index_ticker], start_date_epoch,
+                                                    end_date_epoch):
+            price_histories[ticker] = history
+            if rows_yielded and ticker in stock_portfolio:
+                yield 'stock', holding_row(ticker, history, stock_portfolio[ticker])
+
+        with timed('assemble'):
+            plotting_df = assemble_plotting_df(price_histories, stock_portfolio, index_ticker)
+        results = summarize_plotting_df(plotting_df, index, chart_mode)
+
+        cache = caches[settings.RESULTS_CACHE_ALIAS]
+        cache.set(results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode), results,
+                  results_cache_timeout(end_date))
+
+    if not rows_yielded:
+        for row in results['individual_stocks']:
+            yield 'stock', row
+
+    yield 'results', results
+
+
+def get_cached_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Returns the results of a simulation if they are in the results cache, without computing them.
+
+    :return results: A dictionary, as returned by compute_results, or None on a miss
+    """
+    cache = caches[settings.RESULTS_CACHE_ALIAS]
+    results = cache.get(results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode))
+    record_cache_lookup('results', results is not None)
+    return results
+
+
+def get_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Returns the results of a simulation from the results cache, computing and caching them on a miss. Historical prices
+    do not change, so the results of the same inputs can be reused until they expire from the cache, which is sooner
+    when the simulation runs up to today (see results_cache_timeout).
+
+    :param start_date: A string that represents the start date set by the user in the format YYYY-MM-DD
+    :param end_date: A string that represents the end date set by the user in the format YYYY-MM-DD
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index: A string representing the index that is chosen by the user
+    :param chart_mode: One of chart_modes
+    :return results: A dictionary, as returned by compute_results
+    """
+    results = get_cached_results(start_date, end_date, stock_portfolio, index, chart_mode)
+    if results is None:
+        results = compute_results(start_date, end_date, stock_portfolio, index, chart_mode)
+        cache = caches[settings.RESULTS_CACHE_ALIAS]
+        cache.set(results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode), results,
+                  results_cache_timeout(end_date))
+    return results
+
+
+async def aget_results(start_date, end_date, stock_portfolio, index, chart_mode='server'):
+    """
+    Returns the results of a simulation like get_results, computing them with acompute_results on a miss.
+
+    :return results: A dictionary, as returned by compute_results
+    """
+    cache = caches[settings.RESULTS_CACHE_ALIAS]
+    cache_key = results_cache_key(start_date, end_date, stock_portfolio, index, chart_mode)
+
+    results = await cache.aget(cache_key)
+    record_cache_lookup('results', results is not None)
+    if results is None:
+        results = await acompute_results(start_date, end_date, stock_portfolio, index, chart_mode)
+        await cache.aset(cache_key, results, results_cache_timeout(end_date))
+    return results
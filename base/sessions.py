@@ -0,0 +1,21 @@
+from django.contrib.sessions.backends import db
+
+from .metrics import timed
+
+
+class SessionStore(db.SessionStore):
+    """
+    The database session store, with the reads and writes of the sessions timed as the session_load and session_save
+    stages. Used by setting SESSION_ENGINE to base.sessions.
+    """
+
+    def load(self):
+        with timed('session_load'):
+            return super().load()
+
+    def save(self, must_create=False):
+        # A new session is saved by create, which calls save again once it has drawn a key
+        if self.session_key is None:
+            return super().save(must_create)
+        with timed('session_save'):
+            return super().save(must_create)
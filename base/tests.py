@@ -1,3 +1,1007 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import charts, jobs
+from .alignment import AlignmentError, align_price_histories
+from .benchmarks import find_regressions
+from .coalescing import RangeCoalescer
+from .downsampling import lttb_indices
+from .index_cache import HISTORY_START_EPOCH, REFRESH_RETRY_DELAY, IndexHistoryCache
+from .jobs import get_job_status, submit_results_job
+from .loadtest import INVESTMENT_AMOUNT, LoadStats, VirtualUser, latency_percentiles
+from .metrics import stage_seconds
+from .models import StockTicker
+from .universe import TickerUniverse, get_ticker_universe
+from .universe_builder import (EXCHANGE_PAGE_URLS, Checkpoint, UniverseBuildError, build_ticker_universe,
+                               refresh_ticker_universe)
+from .upstream import CircuitOpenError, UpstreamError, get_async_upstream_client, get_upstream_client
+from .price_store import (PriceFetchError, fetch_price_histories, iter_price_histories, missing_ranges,
+                          parse_chart_response, save_price_history)
+from .replay import ReplayServer, save_fixture, synthesize_fixture
+from .results import (compute_results, get_cached_results, get_results, holding_row, results_cache_key,
+                      results_cache_timeout, summarize_plotting_df)
+from .views import results_stream
+from .utils import (add_tickers_to_db, assemble_plotting_df, calculate_overall_stock_change, create_plotting_df,
+                    query_historical_stock_data, read_stocks_csv)
+
+
+def setUpModule():
+    # The tests do not load the histories of the benchmark indices in the background, unless they use their own cache
+    index_cache = mock.patch('base.price_store.index_cache', IndexHistoryCache([]))
+    index_cache.start()
+    unittest.addModuleCleanup(index_cache.stop)
+
+
+def make_chart_response(timestamps, closes):
+    """
+    Builds a minimal Yahoo Finance chart payload containing the given timestamps and closing prices.
+    """
+    return {
+        'chart': {
+            'result': [{
+                'timestamp': list(timestamps),
+                'indicators': {
+                    'quote': [{
+                        'open': list(closes),
+                        'high': list(closes),
+                        'low': list(closes),
+                        'close': list(closes),
+                        'volume': [100] * len(closes)
+                    }],
+                    'adjclose': [{'adjclose': list(closes)}]
+                }
+            }],
+            'error': None
+        }
+    }
+
+
+def fake_upstream(ticker, start_date, end_date, timeout=None):
+    """
+    Stands in for query_historical_stock_data by returning one bar per day at 14:30 UTC within the requested range.
+    """
+    first_day = start_date // 86400
+    timestamps = [day * 86400 + 52200 for day in range(first_day, end_date // 86400 + 1)
+                  if start_date <= day * 86400 + 52200 < end_date]
+    closes = [float(timestamp // 86400 % 97 + 1) for timestamp in timestamps]
+    return make_chart_response(timestamps, closes)
+
+
+class PriceStoreTests(TestCase):
+    start = 86400 * 10000
+    end = 86400 * 10010
+
+    def test_only_missing_ranges_are_fetched(self):
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream) as upstream:
+            first = fetch_price_histories(['AAPL'], self.start, self.end)['AAPL']
+            second = fetch_price_histories(['AAPL'], self.start + 86400 * 2, self.end - 86400 * 2)['AAPL']
+            self.assertEqual(upstream.call_count, 1)
+
+            fetch_price_histories(['AAPL'], self.start - 86400 * 3, self.end + 86400 * 3)
+            self.assertEqual(upstream.call_count, 3)
+
+        self.assertEqual(len(first['timestamp']), 10)
+        self.assertEqual(list(second['close']), list(first['close'][2:-2]))
+        self.assertEqual(missing_ranges('AAPL', self.start - 86400 * 3, self.end + 86400 * 3), [])
+
+    def test_disjoint_ranges_are_not_merged(self):
+        gap_start, gap_end = self.end, self.end + 86400 * 5
+        save_price_history('AAPL', parse_chart_response(fake_upstream('AAPL', self.start, self.end)), self.start,
+                           self.end)
+        save_price_history('AAPL', parse_chart_response(fake_upstream('AAPL', gap_end, gap_end + 86400 * 3)), gap_end,
+                           gap_end + 86400 * 3)
+
+        self.assertEqual(missing_ranges('AAPL', self.start, gap_end), [(gap_start, gap_end)])
+
+    @override_settings(PRICE_FETCH_TIMEOUT=0.1)
+    def test_failing_and_stalled_tickers_do_not_fail_the_others(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def upstream(ticker, start_date, end_date, timeout=None):
+            if ticker == 'FAIL':
+                raise UpstreamError('The upstream answered 404: Not Found', status_code=404)
+            if ticker == 'STALL':
+                release.wait(5)
+            return fake_upstream(ticker, start_date, end_date, timeout)
+
+        histories = {}
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=upstream):
+            with self.assertRaises(PriceFetchError) as raised:
+                for ticker, history in iter_price_histories(['STALL', 'AAPL', 'FAIL', 'MSFT'], self.start, self.end):
+                    histories[ticker] = history
+
+        self.assertEqual(sorted(histories), ['AAPL', 'MSFT'])
+        self.assertEqual(len(histories['MSFT']['timestamp']), 10)
+        self.assertEqual(raised.exception.failures, {'FAIL': 'The upstream answered 404: Not Found',
+                                                     'STALL': 'Timed out after 0.2 seconds'})
+
+
+class CreatePlottingDfTests(SimpleTestCase):
+    timestamps = np.array([1000000000 + 86400 * i for i in range(6)])
+    closes = {
+        'AAPL': [10.0, 10.5, 9.8, 11.2, 12.0, 11.7],
+        'MSFT': [200.0, 198.5, 205.25, 210.0, 207.5, 215.75],
+        'KO': [40.0, 40.4, 40.2, 39.9, 41.3, 42.0],
+        '^GSPC': [1000.0, 1012.5, 995.0, 1021.0, 1030.25, 1041.5],
+    }
+
+    # The output of the per-element implementation for the prices above, kept to guard the vectorized engine
+    expected_rows = [
+        [4000.0, 4000.0, 100.0, 100.0, 1000.0, 2500.0, 500.0],
+        [4036.25, 4050.0, 100.90625, 101.25, 1050.0, 2481.25, 505.0],
+        [4048.1250000000005, 3980.0, 101.20312500000001, 99.5, 980.0000000000001, 2565.6250000000005,
+         502.50000000000006],
+        [4243.75, 4084.0, 106.09375000000001, 102.1, 1119.9999999999998, 2625.0, 498.75],
+        [4310.0, 4121.0, 107.74999999999999, 103.025, 1200.0, 2593.7500000000005, 516.25],
+        [4391.875, 4166.0, 109.796875, 104.15, 1170.0, 2696.8750000000005, 525.0],
+    ]
+
+    def create_df(self):
+        histories = {ticker: {'timestamp': self.timestamps, 'close': np.array(closes)}
+                     for ticker, closes in self.closes.items()}
+        with mock.patch('base.utils.fetch_price_histories', return_value=histories):
+            return create_plotting_df('2001-09-09', '2001-09-15', {'AAPL': 1000, 'MSFT': 2500, 'KO': 500}, 'S&P 500')
+
+    def test_matches_per_element_implementation(self):
+        plotting_df = self.create_df()
+
+        self.assertEqual(list(plotting_df.columns), ['Portfolio Value', 'Index Value', 'Portfolio Growth',
+                                                     'Index Growth', 'AAPL', 'MSFT', 'KO'])
+        self.assertEqual(plotting_df.index[0], datetime.date(2001, 9, 9))
+        np.testing.assert_allclose(plotting_df.values, self.expected_rows, rtol=1e-12)
+        self.assertEqual(calculate_overall_stock_change(plotting_df['Portfolio Value'].values.tolist()),
+                         ('+9.80%', '+$391.88'))
+
+
+class AlignmentTests(SimpleTestCase):
+    histories = {
+        # Trades every day, but has no close on the fourth one
+        'AAPL': {'timestamp': np.array([86400 * d + 52200 for d in range(10, 16)]),
+                 'close': np.array([1.0, 2.0, 3.0, np.nan, 5.0, 6.0])},
+        # Listed late and halted on the fifth day
+        'NEW': {'timestamp': np.array([86400 * d + 52200 for d in (12, 13, 15)]),
+                'close': np.array([30.0, 31.0, 33.0])},
+        '^GSPC': {'timestamp': np.array([86400 * d + 52200 for d in range(10, 16)]),
+                  'close': np.array([100.0, 101.0, 102.0, 103.0, 104.0, 105.0])},
+    }
+
+    def test_forward_fill(self):
+        calendar, price_matrix = align_price_histories(self.histories, ['AAPL', 'NEW', '^GSPC'])
+
+        self.assertEqual(list(calendar), list(range(10, 16)))
+        np.testing.assert_array_equal(price_matrix[:, 0], [1.0, 2.0, 3.0, 3.0, 5.0, 6.0])
+        np.testing.assert_array_equal(price_matrix[:, 1], [30.0, 30.0, 30.0, 31.0, 31.0, 33.0])
+
+    def test_drop_and_raise(self):
+        calendar, price_matrix = align_price_histories(self.histories, ['AAPL', 'NEW', '^GSPC'], gap_policy='drop')
+
+        self.assertEqual(list(calendar), [12, 15])
+        np.testing.assert_array_equal(price_matrix, [[3.0, 30.0, 102.0], [6.0, 33.0, 105.0]])
+
+        with self.assertRaises(AlignmentError):
+            align_price_histories(self.histories, ['AAPL', '^GSPC'], gap_policy='raise')
+
+
+class TickerUniverseTests(TestCase):
+
+    def test_filter_matches_table_and_follows_imports(self):
+        start_date = 946684800
+
+        expected = set(StockTicker.objects.filter(first_trade_date__lt=start_date)
+                       .values_list('ticker', 'company_name'))
+        self.assertTrue(expected)
+        self.assertEqual(set(get_ticker_universe().eligible(start_date)), expected)
+
+        StockTicker.objects.create(ticker='ZZZZ', first_trade_date=0, company_name='Test Company')
+        add_tickers_to_db(force=True)
+        self.assertNotIn(('ZZZZ', 'Test Company'), get_ticker_universe().eligible(start_date))
+
+
+class TickerSearchTests(SimpleTestCase):
+    universe = TickerUniverse(1, ['AAPL', 'A', 'AA', 'APLE', 'MSFT'],
+                              ['Apple Inc', 'Agilent Technologies', 'Alcoa Corp', 'Apple Hospitality REIT',
+                               'Microsoft Corp'],
+                              [100, 200, 300, 400, 500])
+
+    def test_ranks_tickers_before_names_and_limits_results(self):
+        self.assertEqual(self.universe.search('a', 1000, 3), [('A', 'Agilent Technologies'), ('AA', 'Alcoa Corp'),
+                                                             ('AAPL', 'Apple Inc')])
+        self.assertEqual(self.universe.search(' micro', 1000, 10), [('MSFT', 'Microsoft Corp')])
+
+    def test_only_returns_eligible_stocks(self):
+        self.assertEqual(self.universe.search('apple', 400, 10), [('AAPL', 'Apple Inc')])
+        self.assertEqual(self.universe.search('ms', 500, 10), [])
+
+
+class StockSelectionTests(TestCase):
+
+    def test_eligible_stocks_are_resolved_without_the_session(self):
+        self.client.force_login(User.objects.create_user('investor', password='investor-password'))
+        session = self.client.session
+        session.update({'money': '1000', 'start_date': '2000-01-03', 'end_date': '2001-01-03', 'index': 'DJIA',
+                        'portfolio': {}, 'filtered_stocks': [['AAPL', 'Apple Inc']] * 1000})
+        session.save()
+
+        self.assertEqual(self.client.get('/select/').status_code, 200)
+        self.assertEqual(set(self.client.session.keys()), {'_auth_user_id', '_auth_user_backend', '_auth_user_hash',
+                                                           'money', 'start_date', 'end_date', 'index', 'portfolio'})
+
+        # The autocomplete derives the eligible stocks from get_ticker_universe() and the start date, and returns the
+        # ones that matched the term
+        eligible_stocks = StockTicker.objects.filter(
+            first_trade_date__lt=time.mktime(datetime.datetime(2000, 1, 3).timetuple())
+        ).values_list('ticker', 'company_name')
+        expected = [f"{ticker}: {company_name}" for ticker, company_name in eligible_stocks
+                    if ticker.startswith('MSF') or company_name.lower().startswith('msf')]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(self.client.get('/filtered_tickers/', {'term': 'msf'}).json()), sorted(expected))
+
+
+class UniverseBuilderTests(SimpleTestCase):
+
+    def test_interrupted_build_resumes(self):
+        pages = {url: [] for url in EXCHANGE_PAGE_URLS}
+        pages[EXCHANGE_PAGE_URLS[0]] = [['Agilent Technologies', 'A'], ['Alcoa Corp', 'AA']]
+        pages[EXCHANGE_PAGE_URLS[1]] = [['Barnes Group', 'B']]
+        first_trade_dates = {'A': 100, 'AA': UpstreamError('The upstream answered 503', status_code=503), 'B': None}
+
+        def query_first_trade_date(ticker):
+            if isinstance(first_trade_dates[ticker], Exception):
+                raise first_trade_dates[ticker]
+            return first_trade_dates[ticker]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('base.universe_builder.scrape_listing_page', side_effect=lambda _, url: pages[url]), \
+                mock.patch('base.universe_builder.query_first_trade_date',
+                           side_effect=query_first_trade_date) as query:
+            path = os.path.join(directory, 'stocks.csv')
+            checkpoint = Checkpoint(os.path.join(directory, 'checkpoint'))
+
+            with self.assertRaises(UniverseBuildError) as error:
+                build_ticker_universe(path, checkpoint, 4, 0, log=lambda message: None)
+            self.assertEqual(list(error.exception.failures), ['AA'])
+            self.assertFalse(os.path.exists(path))
+
+            first_trade_dates['AA'] = 200
+            query.reset_mock()
+            self.assertEqual(build_ticker_universe(path, checkpoint, 4, 0, log=lambda message: None), 2)
+
+            query.assert_called_once_with('AA')
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), ['company_name,ticker,first_trade_date,delisted_date',
+                                                         'Agilent Technologies,A,100,', 'Alcoa Corp,AA,200,'])
+
+
+    def test_incremental_refresh_only_queries_new_listings(self):
+        pages = {url: [] for url in EXCHANGE_PAGE_URLS}
+        pages[EXCHANGE_PAGE_URLS[0]] = [['Agilent Technologies', 'A'], ['Apple Inc', 'AAPL'], ['Arconic Corp', 'ARNC']]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('base.universe_builder.scrape_listing_page', side_effect=lambda _, url: pages[url]), \
+                mock.patch('base.universe_builder.query_first_trade_date', return_value=300) as query:
+            path = os.path.join(directory, 'stocks.csv')
+            with open(path, 'w') as f:
+                f.write('company_name,ticker,first_trade_date\n'
+                        'Agilent Technologies,A,100\nAlcoa Corp,AA,200\nArconic Inc,ARNC,150\n')
+
+            changes = refresh_ticker_universe(path, Checkpoint(os.path.join(directory, 'checkpoint')), 4, 0,
+                                              log=lambda message: None)
+
+            self.assertEqual(changes, {'added': 1, 'changed': 1, 'delisted': 1})
+            self.assertEqual(sorted(call.args[0] for call in query.call_args_list), ['AAPL', 'ARNC'])
+            rows = read_stocks_csv(path)
+            self.assertEqual([row[:3] for row in rows], [('Agilent Technologies', 'A', 100), ('Alcoa Corp', 'AA', 200),
+                                                        ('Apple Inc', 'AAPL', 300), ('Arconic Corp', 'ARNC', 300)])
+            self.assertEqual([row[1] for row in rows if row[3] is not None], ['AA'])
+
+
+class ResultsCacheTests(SimpleTestCase):
+
+    def test_same_inputs_are_computed_once(self):
+        self.assertEqual(results_cache_key('2000-01-03', '2001-01-03', {'AAPL': 600, 'MSFT': 400}, 'DJIA'),
+                         results_cache_key('2000-01-03', '2001-01-03', {'MSFT': 400, 'AAPL': 600}, 'DJIA'))
+
+        with mock.patch('base.results.compute_results', return_value={'portfolio_value': 1.0}) as compute_results:
+            get_results('1990-01-02', '1991-01-02', {'KO': 10}, 'DJIA')
+            get_results('1990-01-02', '1991-01-02', {'KO': 10}, 'DJIA')
+            get_results('1990-01-02', '1991-01-02', {'KO': 20}, 'DJIA')
+
+        self.assertEqual(compute_results.call_count, 2)
+
+    def test_open_windows_expire_sooner(self):
+        today = datetime.date.today()
+        self.assertEqual(results_cache_timeout(today.isoformat()), settings.RESULTS_OPEN_WINDOW_TIMEOUT)
+        self.assertEqual(results_cache_timeout((today + datetime.timedelta(days=30)).isoformat()),
+                         settings.RESULTS_OPEN_WINDOW_TIMEOUT)
+        self.assertEqual(results_cache_timeout('1991-01-02'), DEFAULT_TIMEOUT)
+
+
+class StreamedRowsTests(SimpleTestCase):
+
+    def test_holding_rows_match_the_simulation(self):
+        day = 86400
+        price_histories = {
+            'AAPL': {'timestamp': np.array([10 * day, 11 * day, 13 * day]), 'close': np.array([2.0, np.nan, 3.0])},
+            'MSFT': {'timestamp': np.array([12 * day, 14 * day]), 'close': np.array([5.0, 4.0])},
+            '^GSPC': {'timestamp': np.array([10 * day, 14 * day]), 'close': np.array([1.0, 1.1])},
+        }
+        stock_portfolio = {'AAPL': 600, 'MSFT': 400}
+
+        plotting_df = assemble_plotting_df(price_histories, stock_portfolio, '^GSPC')
+        individual_stocks = summarize_plotting_df(plotting_df, 'S&P 500', 'client')['individual_stocks']
+
+        self.assertEqual([holding_row(ticker, price_histories[ticker], amount)
+                          for ticker, amount in stock_portfolio.items()], individual_stocks)
+        self.assertEqual(individual_stocks[0], ['AAPL', 900.0, '+$300.00', '+50.00%'])
+
+
+def wait_for_job(job_id):
+    """
+    Waits until a background job of the results is done and forgotten by the process.
+    """
+    for _ in range(500):
+        with jobs._jobs_lock:
+            if job_id not in jobs._jobs:
+                return
+        time.sleep(0.01)
+    raise AssertionError(f"The job {job_id} is still running")
+
+
+class ResultsJobTests(TestCase):
+
+    def setUp(self):
+        caches['results'].clear()
+
+    def test_jobs_report_their_results_and_failures(self):
+        with mock.patch('base.results.compute_results', return_value={'portfolio_value': 1.0}):
+            job_id = submit_results_job('1992-01-02', '1993-01-04', {'KO': 10}, 'DJIA', 'server')
+            wait_for_job(job_id)
+
+        self.assertEqual(get_job_status(job_id), {'status': 'done'})
+        self.assertEqual(get_cached_results('1992-01-02', '1993-01-04', {'KO': 10}, 'DJIA'), {'portfolio_value': 1.0})
+
+        with mock.patch('base.results.compute_results', side_effect=PriceFetchError({'KO': 'Not Found'})):
+            job_id = submit_results_job('1992-01-02', '1993-01-04', {'KO': 20}, 'DJIA', 'server')
+            wait_for_job(job_id)
+
+        self.assertEqual(get_job_status(job_id), {'status': 'failed', 'errors': {'KO': 'Not Found'}})
+        # A failure is only reported once, so nothing is left behind
+        self.assertEqual(get_job_status(job_id), {'status': 'unknown'})
+        self.assertEqual(get_job_status('results:server:unknown'), {'status': 'unknown'})
+        self.assertEqual(jobs._jobs, {})
+
+    def test_async_mode_polls_the_job(self):
+        self.client.force_login(User.objects.create_user('investor', password='investor-password'))
+        session = self.client.session
+        session.update({'start_date': '1992-01-02', 'end_date': '1993-01-04', 'index': 'DJIA', 'portfolio': {'KO': 10}})
+        session.save()
+
+        release = threading.Event()
+
+        def compute_results(*args):
+            release.wait(5)
+            raise PriceFetchError({'KO': 'Not Found'})
+
+        with mock.patch('base.results.compute_results', side_effect=compute_results):
+            response = self.client.get('/results/', {'mode': 'async'})
+            self.assertTemplateUsed(response, 'base/results_pending.html')
+            status_url = reverse('results_status', args=[response.context['job_id']])
+            self.assertEqual(self.client.get(status_url).json(), {'status': 'pending'})
+
+            release.set()
+            wait_for_job(response.context['job_id'])
+
+        self.assertEqual(self.client.get(status_url).json(), {'status': 'failed', 'errors': {'KO': 'Not Found'}})
+
+        with mock.patch('base.results.compute_results', return_value={'portfolio_value': 1.0}):
+            job_id = self.client.get('/results/', {'mode': 'async'}).context['job_id']
+            wait_for_job(job_id)
+
+        self.assertEqual(self.client.get(status_url).json(), {'status': 'done'})
+
+    def test_async_mode_does_not_block_the_event_loop(self):
+        self.client.force_login(User.objects.create_user('investor', password='investor-password'))
+        session = self.client.session
+        session.update({'start_date': '1992-01-02', 'end_date': '1993-01-04', 'index': 'DJIA', 'portfolio': {'KO': 10}})
+        session.save()
+
+        def outside_event_loop(function):
+            def wrapper(*args):
+                with self.assertRaises(RuntimeError):
+                    asyncio.get_running_loop()
+                return function(*args)
+            return wrapper
+
+        with mock.patch('base.views.get_cached_results', outside_event_loop(get_cached_results)), \
+                mock.patch('base.views.submit_results_job', outside_event_loop(lambda *args: 'job')):
+            response = self.client.get('/results/', {'mode': 'async'})
+        self.assertEqual(response.context['job_id'], 'job')
+
+
+class ResultsViewTests(TestCase):
+
+    def setUp(self):
+        caches['results'].clear()
+
+    def request_results(self, username, portfolio, path='/results/'):
+        self.client.force_login(User.objects.create_user(username, password=f"{username}-password"))
+        session = self.client.session
+        session.update({'start_date': '1992-01-02', 'end_date': '1993-01-04', 'index': 'DJIA', 'portfolio': portfolio})
+        session.save()
+        return self.client.get(path, {'mode': 'sync', 'charts': 'client'})
+
+    def test_wsgi_requests_share_the_blocking_client(self):
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream) as upstream, \
+                mock.patch('base.utils.aquery_historical_stock_data') as async_upstream:
+            first = self.request_results('first-investor', {'KO': 10})
+            second = self.request_results('second-investor', {'KO': 20})
+
+        self.assertEqual(first.context['individual_stocks'][0][0], 'KO')
+        self.assertEqual(second.context['individual_stocks'][0][0], 'KO')
+        # The second request reads the prices stored by the first one, and no event loop was given a client
+        self.assertEqual(sorted(call.args[0] for call in upstream.call_args_list), ['KO', '^DJI'])
+        async_upstream.assert_not_called()
+
+    def test_repeated_request_is_served_from_cache(self):
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream) as upstream, \
+                mock.patch('base.results.compute_results', wraps=compute_results) as compute:
+            self.request_results('investor', {'KO': 10})
+            response = self.client.get('/results/', {'mode': 'sync', 'charts': 'client'})
+
+        self.assertEqual(response.context['individual_stocks'][0][0], 'KO')
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(upstream.call_count, 2)
+
+    @override_settings(CHART_RENDER_WORKERS=0)
+    def test_chart_modes(self):
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream):
+            client_page = self.request_results('first-investor', {'KO': 10}).content.decode()
+            server_page = self.client.get('/results/', {'mode': 'sync', 'charts': 'server'}).content.decode()
+
+        # The browser draws the graphs from the series, instead of the images rendered by the server
+        self.assertIn('<script id="chart-data" type="application/json">', client_page)
+        self.assertNotIn('data:image/png;base64', client_page)
+        self.assertEqual(server_page.count('data:image/png;base64, iVBORw0KGgo'), 2)
+        self.assertNotIn('<script id="chart-data"', server_page)
+
+    def test_streams_rows_before_summary(self):
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream):
+            response = self.request_results('investor', {'KO': 10, 'PEP': 20}, '/results/stream/')
+            chunks = [chunk.decode() for chunk in response.streaming_content]
+
+        page_head, first_row, second_row, page_middle, summary, page_tail = chunks
+        self.assertIn('<tbody>', page_head)
+        # The rows are sent in the order the prices arrive
+        tickers = [row.split('<th scope="row">')[1].split('</th>')[0] for row in (first_row, second_row)]
+        self.assertEqual(sorted(tickers), ['KO', 'PEP'])
+        self.assertIn('</table>', page_middle)
+        self.assertIn('<th scope="row">Your Portfolio</th>', summary)
+        self.assertIn('id="chart-data"', summary)
+        self.assertIn('Go back to the Stock Market Parameters Page', page_tail)
+
+    def test_streams_fetch_errors(self):
+        def upstream(ticker, start_date, end_date, timeout=None):
+            if ticker == 'PEP':
+                raise UpstreamError('The upstream answered 404: Not Found', status_code=404)
+            return fake_upstream(ticker, start_date, end_date, timeout)
+
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=upstream):
+            response = self.request_results('investor', {'KO': 10, 'PEP': 20}, '/results/stream/')
+            chunks = [chunk.decode() for chunk in response.streaming_content]
+
+        self.assertEqual(len(chunks), 5)
+        self.assertIn('<th scope="row">KO</th>', chunks[1])
+        self.assertIn('<li>PEP: The upstream answered 404: Not Found</li>', chunks[3])
+
+    def test_unalignable_history_is_reported(self):
+        def upstream(ticker, start_date, end_date, timeout=None):
+            data = fake_upstream(ticker, start_date, end_date, timeout)
+            if ticker == 'PEP':
+                quote = data['chart']['result'][0]['indicators']['quote'][0]
+                quote['close'] = [float('nan')] * len(quote['close'])
+            return data
+
+        expected_errors = {'PEP': 'The series does not contain any prices'}
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=upstream):
+            response = self.request_results('investor', {'KO': 10, 'PEP': 20})
+            self.assertEqual(response.context['fetch_errors'], expected_errors)
+            self.assertContains(response, '<li>PEP: The series does not contain any prices</li>')
+
+            chunks = [chunk.decode() for chunk in self.client.get('/results/stream/').streaming_content]
+            self.assertIn('<li>PEP: The series does not contain any prices</li>', chunks[-2])
+
+        # The background job runs in another thread, which cannot write to the database of the test
+        with mock.patch('base.results.compute_results',
+                        side_effect=AlignmentError('The series does not contain any prices', ticker='PEP')):
+            job_id = self.client.get('/results/', {'mode': 'async'}).context['job_id']
+            wait_for_job(job_id)
+        self.assertEqual(get_job_status(job_id), {'status': 'failed', 'errors': expected_errors})
+
+    def test_stream_redirects_under_asgi(self):
+        request = AsyncRequestFactory().get('/results/stream/', {'charts': 'client'})
+        request.user = User.objects.create_user('investor', password='investor-password')
+
+        response = results_stream(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], '/results/?mode=sync&charts=client')
+
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_finds_regressions_beyond_threshold(self):
+        def report(wall_time, peak_memory):
+            return {'results': [{'stage': 'assemble', 'tickers': 10, 'range': '1y', 'wall_time_median': wall_time,
+                                 'peak_memory': peak_memory}]}
+
+        baseline = report(0.1, 2 ** 20)
+        self.assertEqual(find_regressions(report(0.11, 2 ** 20), baseline, 0.2), [])
+        self.assertEqual(len(find_regressions(report(0.2, 2 ** 21), baseline, 0.2)), 2)
+        # Measurements below the noise floors are not compared
+        self.assertEqual(find_regressions(report(0.0009, 2 ** 10), report(0.0001, 2 ** 8), 0.2), [])
+
+    def test_leaves_the_development_database_alone(self):
+        database = settings.BASE_DIR / 'db.sqlite3'
+        if database.exists():
+            self.skipTest('The development database already exists')
+
+        process = subprocess.run([sys.executable, 'manage.py', 'benchmark_simulation', '--tickers', '1', '--ranges',
+                                  '1m', '--repeat', '1'], cwd=settings.BASE_DIR, capture_output=True, text=True)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertIn('results_view', process.stdout)
+        self.assertNotIn('Could not refresh the index history cache', process.stderr)
+        self.assertFalse(database.exists())
+
+
+class TestClientSession:
+    """
+    Sends the requests of a VirtualUser through the test client instead of the network.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, allow_redirects=False, timeout=None, params=None, data=None):
+        if method == 'GET':
+            response = self.client.get(url, params)
+        else:
+            response = self.client.post(url, data)
+        response.text = response.content.decode()
+        return response
+
+
+class LoadTestTests(TestCase):
+
+    def test_summarizes_latencies(self):
+        stats = LoadStats()
+        for milliseconds in range(1, 101):
+            stats.record('form', milliseconds / 1000, failed=milliseconds > 98, locked=milliseconds == 100)
+        stats.record('results', 0.5)
+
+        summary = stats.summary(duration=10)
+
+        self.assertEqual(list(summary), ['form', 'results'])
+        self.assertEqual({key: summary['form'][key] for key in ('requests', 'errors', 'locked', 'throughput')},
+                         {'requests': 100, 'errors': 2, 'locked': 1, 'throughput': 10.0})
+        for key, expected in {'p50': 50.5, 'p95': 95.05, 'p99': 99.01, 'max': 100.0}.items():
+            self.assertAlmostEqual(summary['form']['latency'][key], expected)
+        self.assertEqual(summary['results']['latency']['p99'], 500.0)
+        self.assertIsNone(latency_percentiles([]))
+
+    @override_settings(CHART_RENDER_WORKERS=0, RESULTS_CHART_MODE='client')
+    def test_virtual_user_goes_through_the_flow(self):
+        User.objects.create_user('load-test-0', password='load-test-password')
+        stats = LoadStats()
+        user = VirtualUser('', 'load-test-0', 'load-test-password', stats, picks=2, seed='0-0',
+                           session=TestClientSession(self.client))
+
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream):
+            user.run(iterations=1)
+
+        self.assertEqual((stats.completed_flows, stats.failed_flows), (1, 0))
+        self.assertEqual(sum(stats.errors.values()), 0)
+        requests_sent = {endpoint: len(latencies) for endpoint, latencies in stats.latencies.items()}
+        self.assertEqual({endpoint: requests_sent[endpoint] for endpoint in ('login', 'form', 'form_post', 'select',
+                                                                            'select_post', 'results')},
+                         {'login': 2, 'form': 1, 'form_post': 1, 'select': 2, 'select_post': 2, 'results': 1})
+        self.assertGreaterEqual(requests_sent['autocomplete'], 2)
+        self.assertEqual(sum(self.client.session['portfolio'].values()), 2 * INVESTMENT_AMOUNT)
+
+
+class MetricsTests(TestCase):
+
+    def test_times_stages_and_exports_them(self):
+        session = self.client.session
+        session['start_date'] = '2000-01-03'
+        session.save()
+        searches, _ = stage_seconds.get(stage='ticker_search')
+
+        response = self.client.get('/filtered_tickers/', {'term': 'AA'})
+        stages = [span.split(';')[0] for span in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages[-1], 'total')
+        self.assertIn('session_load', stages)
+        self.assertIn('ticker_search', stages)
+        self.assertEqual(stage_seconds.get(stage='ticker_search')[0], searches + 1)
+
+        with override_settings(METRICS_TOKEN='scraper-token'):
+            metrics = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scraper-token').content.decode()
+            self.assertIn('simulator_stage_seconds_count{stage="ticker_search"}', metrics)
+            self.assertIn('simulator_request_seconds_count{view="autocomplete",status="200"}', metrics)
+
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer other-token').status_code, 403)
+            self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+        # Staff members can read the metrics without a token, which is not set by default
+        self.client.force_login(User.objects.create_user('operator', password='operator-password', is_staff=True))
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 200)
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        profile_settings = override_settings(PROFILE_DIR=directory.name, PROFILE_SAMPLE_INTERVAL=0.001)
+        profile_settings.enable()
+        self.addCleanup(profile_settings.disable)
+
+        self.user = User.objects.create_user('analyst', password='analyst-password', is_staff=True)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['start_date'] = '2000-01-03'
+        session.save()
+
+    def test_profiles_staff_requests(self):
+        response = self.client.get('/filtered_tickers/', {'term': 'AA', 'profile': '1'})
+        profile = self.client.get(response['X-Profile-Url']).json()
+        self.assertEqual(profile['id'], response['X-Profile-Id'])
+        self.assertEqual(profile['simulation_inputs'], {'start_date': '2000-01-03'})
+
+        download = self.client.get(profile['files']['pstats'])
+        with tempfile.NamedTemporaryFile(suffix='.pstats') as f:
+            f.write(b''.join(download.streaming_content))
+            f.flush()
+            self.assertTrue(pstats.Stats(f.name).total_calls > 0)
+        self.assertEqual([listed['id'] for listed in self.client.get('/profiles/').json()], [profile['id']])
+
+        self.user.is_staff = False
+        self.user.save()
+        self.assertNotIn('X-Profile-Id', self.client.get('/filtered_tickers/', {'term': 'AA', 'profile': '1'}))
+        self.assertEqual(self.client.get(profile['files']['pstats']).status_code, 302)
+
+
+class DownsamplingTests(SimpleTestCase):
+
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        values = np.sin(np.linspace(0, 20, 10000))
+        values[4321] = 50.0
+
+        selected = lttb_indices(values, 500)
+
+        self.assertEqual(len(selected), 500)
+        self.assertEqual((selected[0], selected[-1]), (0, 9999))
+        self.assertIn(4321, selected)
+        self.assertTrue((np.diff(selected) > 0).all())
+        np.testing.assert_array_equal(lttb_indices(values[:100], 500), np.arange(100))
+
+
+class ChartRenderTests(SimpleTestCase):
+
+    def setUp(self):
+        executor = mock.patch('base.charts._render_executor', None)
+        executor.start()
+        self.addCleanup(executor.stop)
+
+    def test_threads_share_one_pool(self):
+        def create_pool(**kwargs):
+            # Widen the window in which the threads could each create a pool
+            time.sleep(0.01)
+            return mock.Mock()
+
+        barrier = threading.Barrier(8)
+        pools = []
+
+        def get_pool():
+            barrier.wait()
+            pools.append(charts.get_render_executor(2))
+
+        with mock.patch('base.charts.ProcessPoolExecutor', side_effect=create_pool) as process_pool:
+            threads = [threading.Thread(target=get_pool) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(process_pool.call_count, 1)
+        self.assertEqual(len(pools), 8)
+        self.assertTrue(all(pool is pools[0] for pool in pools))
+
+    def test_broken_pool_is_replaced(self):
+        day = 86400
+        price_histories = {
+            'AAPL': {'timestamp': np.array([10 * day, 11 * day]), 'close': np.array([2.0, 3.0])},
+            '^GSPC': {'timestamp': np.array([10 * day, 11 * day]), 'close': np.array([1.0, 1.1])},
+        }
+        plotting_df = assemble_plotting_df(price_histories, {'AAPL': 600}, '^GSPC')
+        broken_pool = mock.Mock()
+        broken_pool.submit.side_effect = BrokenProcessPool()
+
+        with mock.patch('base.charts.ProcessPoolExecutor', return_value=broken_pool):
+            graphs = charts.render_charts(plotting_df, 'S&P 500', [(False, False), (True, False)], 2)
+
+        # The graphs are rendered in this process instead, and the next call starts a new pool
+        self.assertEqual(len(graphs), 2)
+        self.assertTrue(all(graph.startswith('iVBORw0KGgo') for graph in graphs))
+        broken_pool.shutdown.assert_called_once_with(wait=False)
+        self.assertIsNone(charts._render_executor)
+
+    def test_serialized_series_match_the_plotting_df(self):
+        day = 86400
+        price_histories = {
+            'AAPL': {'timestamp': np.array([10 * day, 11 * day, 12 * day]), 'close': np.array([2.0, 3.0, 2.5])},
+            '^GSPC': {'timestamp': np.array([10 * day, 11 * day, 12 * day]), 'close': np.array([1.0, 1.1, 1.2])},
+        }
+        plotting_df = assemble_plotting_df(price_histories, {'AAPL': 600}, '^GSPC')
+
+        chart_data = charts.serialize_plotting_df(plotting_df, 'S&P 500')
+
+        self.assertEqual(chart_data, {
+            'index_name': "Standard & Poor's 500",
+            'days': [10, 11, 12],
+            'portfolio': [600.0, 900.0, 750.0],
+            'index': [600.0, 660.0, 720.0],
+            'stocks': {'AAPL': [600.0, 900.0, 750.0]},
+        })
+
+        # Longer series are downsampled to the point budget, keeping their first and last days
+        timestamps = np.arange(10, 2010) * day
+        price_histories = {
+            'AAPL': {'timestamp': timestamps, 'close': 2 + np.sin(np.arange(2000) / 50)},
+            '^GSPC': {'timestamp': timestamps, 'close': np.linspace(1.0, 2.0, 2000)},
+        }
+        plotting_df = assemble_plotting_df(price_histories, {'AAPL': 600}, '^GSPC')
+
+        days = charts.serialize_plotting_df(plotting_df, 'S&P 500', point_budget=300)['days']
+        self.assertLessEqual(len(days), 300)
+        self.assertEqual((days[0], days[-1]), (10, 2009))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the status codes queued in the server's responses, then with a chart payload.
+    """
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status = self.server.responses.pop(0) if self.server.responses else 200
+        body = json.dumps(make_chart_response([86400 * 10000 + 52200], [1.0])).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpstreamClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.paths = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        upstream_settings = override_settings(UPSTREAM_CLIENT={
+            'BASE_URL': f"http://127.0.0.1:{self.server.server_port}",
+            'CONNECT_TIMEOUT': 1,
+            'READ_TIMEOUT': 1,
+            'MAX_RETRIES': 2,
+            'BACKOFF_FACTOR': 0,
+            'POOL_SIZE': 2,
+            'CIRCUIT_FAILURE_THRESHOLD': 1,
+            'CIRCUIT_RESET_TIMEOUT': 60,
+        })
+        upstream_settings.enable()
+        self.addCleanup(upstream_settings.disable)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retries_server_errors(self):
+        self.server.responses = [503, 429]
+
+        data = get_upstream_client().chart('AAPL', params={'interval': '1d'})
+
+        self.assertEqual(data['chart']['result'][0]['indicators']['quote'][0]['close'], [1.0])
+        self.assertEqual(self.server.paths, ['/v8/finance/chart/AAPL?interval=1d'] * 3)
+
+    def test_circuit_opens_after_failures(self):
+        self.server.responses = [500, 500, 500]
+
+        with self.assertRaises(UpstreamError):
+            get_upstream_client().chart('AAPL')
+        with self.assertRaises(CircuitOpenError):
+            get_upstream_client().chart('AAPL')
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_async_client_retries_and_shares_the_circuit(self):
+        async def chart(ticker):
+            return await get_async_upstream_client().chart(ticker, params={'interval': '1d'})
+
+        self.server.responses = [503]
+        data = asyncio.run(chart('AAPL'))
+
+        self.assertEqual(data['chart']['result'][0]['timestamp'], [86400 * 10000 + 52200])
+        self.assertEqual(self.server.paths, ['/v8/finance/chart/AAPL?interval=1d'] * 2)
+
+        self.server.responses = [500, 500, 500]
+        with self.assertRaises(UpstreamError):
+            asyncio.run(chart('MSFT'))
+        with self.assertRaises(CircuitOpenError):
+            get_upstream_client().chart('MSFT')
+
+    def test_failed_trial_request_is_recorded(self):
+        client = get_upstream_client()
+        client.circuit_breaker.record_failure()
+        client.circuit_breaker.opened_at -= 60
+
+        with mock.patch.object(client.session, 'get', side_effect=requests.TooManyRedirects()):
+            with self.assertRaises(UpstreamError):
+                client.chart('AAPL')
+
+        # The trial failed, so the circuit stays open until the next trial instead of for good
+        self.assertFalse(client.circuit_breaker.trial_in_progress)
+        client.circuit_breaker.opened_at -= 60
+        self.assertEqual(client.chart('AAPL')['chart']['result'][0]['indicators']['quote'][0]['close'], [1.0])
+
+
+class ReplayServerTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.fixture = synthesize_fixture('AAPL', 86400 * 10000, 86400 * 10030)
+        save_fixture(directory.name, 'AAPL', self.fixture)
+
+        self.server = ReplayServer(directory.name, seed=1).start()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+        upstream_settings = override_settings(UPSTREAM_CLIENT={
+            'BASE_URL': self.server.url,
+            'CONNECT_TIMEOUT': 1,
+            'READ_TIMEOUT': 1,
+            'MAX_RETRIES': 1,
+            'BACKOFF_FACTOR': 0,
+            'POOL_SIZE': 2,
+            'CIRCUIT_FAILURE_THRESHOLD': 100,
+            'CIRCUIT_RESET_TIMEOUT': 60,
+        })
+        upstream_settings.enable()
+        self.addCleanup(upstream_settings.disable)
+
+    def test_serves_the_requested_range(self):
+        history = parse_chart_response(query_historical_stock_data('AAPL', 86400 * 10007, 86400 * 10014))
+
+        self.assertEqual(history['timestamp'], [86400 * day + 52200 for day in range(10007, 10012)])
+        self.assertEqual(history['close'], self.fixture['close'][5:10])
+
+        with self.assertRaises(UpstreamError) as error:
+            query_historical_stock_data('MSFT', 86400 * 10007, 86400 * 10014)
+        self.assertEqual(error.exception.status_code, 404)
+
+    def test_injects_errors(self):
+        self.server.error_rate = 1
+
+        with self.assertRaises(UpstreamError) as error:
+            query_historical_stock_data('AAPL', 86400 * 10007, 86400 * 10014)
+        self.assertIn(error.exception.status_code, self.server.error_statuses)
+
+    def test_synthesizes_missing_tickers(self):
+        self.server.synthesize = True
+
+        history = parse_chart_response(query_historical_stock_data('MSFT', 86400 * 10007, 86400 * 10014))
+        self.assertEqual(history['timestamp'], [86400 * day + 52200 for day in range(10007, 10012)])
+
+
+class RangeCoalescerTests(SimpleTestCase):
+
+    def test_concurrent_fetches_are_shared(self):
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch(ticker, start, end, timeout):
+            calls.append((start, end))
+            release.wait(5)
+            return {'timestamp': list(range(start, end)), 'close': [float(t) for t in range(start, end)]}
+
+        coalescer = RangeCoalescer(slow_fetch)
+        results = {}
+        threads = [threading.Thread(target=lambda: results.setdefault('first', coalescer.get('AAPL', 0, 10)))]
+        threads[0].start()
+        while not calls:
+            threading.Event().wait(0.001)
+
+        threads += [threading.Thread(target=lambda: results.setdefault('covered', coalescer.get('AAPL', 2, 8))),
+                    threading.Thread(target=lambda: results.setdefault('overlapping', coalescer.get('AAPL', 5, 15)))]
+        for thread in threads[1:]:
+            thread.start()
+        threading.Event().wait(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(calls, [(0, 10), (10, 15)])
+        self.assertEqual(results['covered']['timestamp'], list(range(2, 8)))
+        self.assertEqual(results['overlapping']['close'], [float(t) for t in range(5, 15)])
+
+
+class IndexHistoryCacheTests(TestCase):
+
+    def test_slices_without_fetching(self):
+        cache = IndexHistoryCache(['^GSPC'])
+        with mock.patch.object(cache, 'refresh_in_background') as refresh_in_background:
+            self.assertIsNone(cache.get('^GSPC', HISTORY_START_EPOCH, HISTORY_START_EPOCH + 86400 * 10))
+        refresh_in_background.assert_called_once_with()
+
+        with mock.patch('base.utils.query_historical_stock_data', side_effect=fake_upstream) as upstream:
+            cache.refresh()
+            self.assertEqual(upstream.call_count, 1)
+
+            with mock.patch('base.price_store.index_cache', cache):
+                history = fetch_price_histories(['^GSPC'], HISTORY_START_EPOCH + 86400 * 100,
+                                                HISTORY_START_EPOCH + 86400 * 110)['^GSPC']
+            self.assertEqual(upstream.call_count, 1)
+
+        self.assertEqual(len(history['timestamp']), 10)
+        self.assertTrue((history['timestamp'] >= HISTORY_START_EPOCH + 86400 * 100).all())
+        self.assertIsNone(cache.get('^GSPC', HISTORY_START_EPOCH - 86400, HISTORY_START_EPOCH + 86400))
+
+    def test_failed_refresh_is_retried_after_a_backoff(self):
+        cache = IndexHistoryCache(['^GSPC'])
+
+        def get_and_wait():
+            self.assertIsNone(cache.get('^GSPC', HISTORY_START_EPOCH, HISTORY_START_EPOCH + 86400 * 10))
+            for _ in range(500):
+                if not cache._refreshing:
+                    return
+                time.sleep(0.01)
+            raise AssertionError('The refresh is still running')
+
+        with mock.patch.object(cache, 'refresh', side_effect=[UpstreamError('The upstream answered 503'), None]) \
+                as refresh, self.assertLogs('base.index_cache', 'ERROR'):
+            get_and_wait()
+            get_and_wait()
+            self.assertEqual(refresh.call_count, 1)
+
+            # Once the backoff has passed, the next lookup retries
+            cache._retry_at -= REFRESH_RETRY_DELAY
+            get_and_wait()
+            self.assertEqual(refresh.call_count, 2)
+        self.assertIsNone(cache._retry_at)
@@ -0,0 +1,134 @@
+import bisect
+import threading
+
+import numpy as np
+
+from .models import StockTicker, TickerUniverseVersion
+
+# The universe of the current worker process, rebuilt whenever a new version of the tickers is imported
+_universe = None
+_universe_lock = threading.Lock()
+
+
+class TickerUniverse:
+    """
+    An in-memory copy of the StockTicker table, sorted by first trade date so that the stocks that were already traded
+    at a given date are always a prefix of the arrays.
+
+    :param version: The id of the TickerUniverseVersion the universe was built from, or None if nothing was imported
+    :param tickers: A list of strings representing the tickers
+    :param company_names: A list of strings representing the company names, in the same order as the tickers
+    :param first_trade_dates: A sorted list of integers representing the first trade dates in epoch form
+    """
+
+    def __init__(self, version, tickers, company_names, first_trade_dates):
+        self.version = version
+        self.tickers = tickers
+        self.company_names = company_names
+        self.first_trade_dates = np.asarray(first_trade_dates, dtype=np.int64)
+
+        # Sorted search keys for the prefix search, each paired with the position of its stock in the arrays above
+        self.ticker_keys, self.ticker_positions = self._build_search_index(tickers)
+        self.name_keys, self.name_positions = self._build_search_index(company_names)
+
+    @staticmethod
+    def _build_search_index(values):
+        """
+        Sorts the lowercase values so that every value starting with a prefix forms a contiguous range.
+
+        :return: A tuple of the sorted list of keys and the array of the positions they come from
+        """
+        order = sorted(range(len(values)), key=lambda position: values[position].lower())
+        return [values[position].lower() for position in order], np.array(order, dtype=np.int64)
+
+    def count_eligible(self, start_date):
+        """
+        Counts the stocks that have a first trade date earlier than the start date with a single binary search.
+
+        :param start_date: A number representing the start date set by the user in epoch form
+        :return: An integer representing the number of stocks that are eligible
+        """
+        return int(np.searchsorted(self.first_trade_dates, start_date, side='left'))
+
+    def eligible(self, start_date):
+        """
+        Returns the stocks that have a first trade date earlier than the start date.
+
+        :param start_date: A number representing the start date set by the user in epoch form
+        :return: A list of (ticker, company name) tuples
+        """
+        count = self.count_eligible(start_date)
+        return list(zip(self.tickers[:count], self.company_names[:count]))
+
+    def search(self, term, start_date, limit):
+        """
+        Finds the eligible stocks whose ticker or company name starts with the term, ignoring case. Ticker matches are
+        ranked first, an exact ticker match before the longer tickers, followed by company name matches in
+        alphabetical order.
+
+        :param term: A string representing the text typed by the user
+        :param start_date: A number representing the start date set by the user in epoch form
+        :param limit: An integer representing the maximum number of stocks to return
+        :return: A list of (ticker, company name) tuples
+        """
+        term = term.strip().lower()
+        if not term or limit <= 0:
+            return []
+
+        count = self.count_eligible(start_date)
+
+        ticker_matches = self._prefix_matches(self.ticker_keys, self.ticker_positions, term, count)
+        ticker_matches = sorted(ticker_matches, key=lambda position: len(self.tickers[position]))[:limit]
+
+        positions = list(ticker_matches)
+        if len(positions) < limit:
+            seen = set(positions)
+            name_matches = self._prefix_matches(self.name_keys, self.name_positions, term, count)
+            positions += [position for position in name_matches if position not in seen][:limit - len(positions)]
+
+        return [(self.tickers[position], self.company_names[position]) for position in positions]
+
+    @staticmethod
+    def _prefix_matches(keys, positions, term, count):
+        """
+        Returns the positions of the keys starting with the term, in key order, keeping only the eligible stocks.
+        """
+        low = bisect.bisect_left(keys, term)
+        high = bisect.bisect_left(keys, term + '\uffff', low)
+        matches = positions[low:high]
+        return matches[matches < count].tolist()
+
+
+def load_ticker_universe(version):
+    """
+    Reads the StockTicker table into a TickerUniverse. The rows are read in first trade date order through its index.
+    Delisted tickers are left out, since their prices can no longer be requested.
+
+    :param version: The id of the TickerUniverseVersion that is being loaded
+    :return: A TickerUniverse
+    """
+    listed_tickers = StockTicker.objects.filter(delisted_date__isnull=True)
+    rows = list(listed_tickers.order_by('first_trade_date', 'ticker').values_list(
+        'ticker', 'company_name', 'first_trade_date'
+    ))
+    tickers, company_names, first_trade_dates = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+    return TickerUniverse(version, tickers, company_names, first_trade_dates)
+
+
+def get_ticker_universe():
+    """
+    Returns the universe of the current process, rebuilding it if another version of the tickers was imported since
+    it was built. Checking the version costs a single indexed query.
+
+    :return: A TickerUniverse
+    """
+    global _universe
+
+    version = TickerUniverseVersion.objects.order_by('-id').values_list('id', flat=True).first()
+    if _universe is not None and _universe.version == version:
+        return _universe
+
+    with _universe_lock:
+        if _universe is None or _universe.version != version:
+            _universe = load_ticker_universe(version)
+        return _universe
@@ -0,0 +1,349 @@
+import csv
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from bs4 import BeautifulSoup
+from django.conf import settings
+
+from .upstream import USER_AGENT_HEADERS, UpstreamError, get_upstream_client
+from .utils import read_stocks_csv
+
+# The pages of eoddata.com listing the stocks of the NYSE and NASDAQ exchanges, one per initial letter
+EXCHANGE_PAGE_URLS = [
+    url.format(letter=chr(ord('A') + i))
+    for url in ('https://eoddata.com/stocklist/NYSE/{letter}.htm', 'https://eoddata.com/stocklist/NASDAQ/{letter}.htm')
+    for i in range(26)
+]
+
+# The columns of the stocks.csv file
+csv_columns = ('company_name', 'ticker', 'first_trade_date', 'delisted_date')
+
+SECONDS_PER_DAY = 86400
+
+
+class UniverseBuildError(Exception):
+    """
+    Raised when some of the pages or tickers could not be fetched. The ones that were fetched are kept in the
+    checkpoint, so running the build again only retries the failed ones.
+
+    :param failures: A dictionary with key value pairs of Page or Ticker:Error message
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(f"{len(failures)} page(s) or ticker(s) could not be fetched")
+
+
+class RateLimiter:
+    """
+    Spaces out the requests sent to a site, across all the threads, so that no more than rate requests are started per
+    second.
+
+    :param rate: A number representing the maximum number of requests per second. 0 disables the limit
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks the calling thread until it is allowed to send its request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class Checkpoint:
+    """
+    Records the progress of a build on disk, so a build that is interrupted resumes where it stopped. Each step is kept
+    in its own file as one JSON object per line, appended as soon as an item is done.
+
+    :param directory: A string representing the directory holding the files of the checkpoint
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path(self, step):
+        return os.path.join(self.directory, f"{step}.jsonl")
+
+    def load(self, step):
+        """
+        Reads the items of a step that are done.
+
+        :param step: A string representing the name of the step
+        :return done: A dictionary with key value pairs of Key:Value for every recorded item
+        """
+        done = {}
+        if not os.path.exists(self.path(step)):
+            return done
+
+        with open(self.path(step)) as f:
+            for line in f:
+                # The last line is incomplete if the build was killed while writing it
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                done[item['key']] = item['value']
+        return done
+
+    def record(self, step, key, value):
+        """
+        Appends a done item to the file of a step.
+        """
+        line = json.dumps({'key': key, 'value': value}) + '\n'
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(step), 'a') as f:
+                f.write(line)
+
+    def clear(self):
+        """
+        Deletes the files of the checkpoint, so the next build starts from scratch.
+        """
+        with self._lock:
+            for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                if name.endswith('.jsonl'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+def extract_ticker_and_name(rows):
+    """
+    Extracts the ticker and name of the company from the rows of a listing page. When extracting the tickers and name,
+    it also excludes all stock tickers with . or -, and those longer than 4 characters.
+
+    :param rows: A list of BeautifulSoup objects representing the rows of the table
+    :return all_tickers: A set of (company name, ticker) tuples
+    """
+    all_tickers = set()
+
+    for row in rows:
+        company_ticker = row.contents[0].text
+        company_name = row.contents[1].text
+
+        if re.search(r'\.|-', company_ticker) or len(company_ticker) > 4:
+            continue
+        all_tickers.add((company_name, company_ticker))
+
+    return all_tickers
+
+
+def scrape_listing_page(session, url):
+    """
+    Scrapes a single listing page of eoddata.com.
+
+    :param session: A requests.Session
+    :param url: A string representing the url of the page
+    :return: A sorted list of [company name, ticker] lists
+    """
+    options = settings.UPSTREAM_CLIENT
+    page = session.get(url, timeout=(options['CONNECT_TIMEOUT'], options['READ_TIMEOUT']))
+    page.raise_for_status()
+
+    soup = BeautifulSoup(page.content, 'html.parser')
+    rows = soup.find_all('tr', {'class': 'ro'}) + soup.find_all('tr', {'class': 're'})
+    return sorted([company_name, ticker] for company_name, ticker in extract_ticker_and_name(rows))
+
+
+def query_first_trade_date(ticker):
+    """
+    Requests the first trade date of a ticker from the chart endpoint of Yahoo Finance.
+
+    :param ticker: A string that represents the specific ticker that is used
+    :return: An integer representing the first trade date in epoch form, 0 if it is unknown, or None if Yahoo Finance
+    does not know the ticker
+    :raises UpstreamError: If the request failed in a way that is worth retrying later
+    """
+    try:
+        data = get_upstream_client().chart(ticker, params={'range': '1d', 'interval': '1d'})
+    except UpstreamError as error:
+        # The retryable status codes are already retried by the client, any other client error is final
+        if error.status_code is not None and 400 <= error.status_code < 500:
+            return None
+        raise
+
+    try:
+        return data['chart']['result'][0]['meta']['firstTradeDate'] or 0
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def run_step(checkpoint, step, keys, work, max_workers, rate_limiter, log):
+    """
+    Runs work on every key that is not done yet in a thread pool, recording each result in the checkpoint as soon as
+    it is available.
+
+    :param checkpoint: A Checkpoint
+    :param step: A string representing the name of the step in the checkpoint
+    :param keys: A list of strings, the items of the step
+    :param work: A callable taking a key and returning a JSON serializable value
+    :param max_workers: An integer representing the number of threads
+    :param rate_limiter: A RateLimiter, waited on before every call to work
+    :param log: A callable taking a progress message
+    :return: A tuple of the dictionary of Key:Value of every item that is done and the dictionary of Key:Error message
+    of every item that failed
+    """
+    done = checkpoint.load(step)
+    remaining = [key for key in keys if key not in done]
+    log(f"{step}: {len(keys) - len(remaining)} of {len(keys)} already done")
+
+    def limited_work(key):
+        rate_limiter.wait()
+        return work(key)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"universe-{step}") as executor:
+        futures = {executor.submit(limited_work, key): key for key in remaining}
+        for count, future in enumerate(as_completed(futures), start=1):
+            key = futures[future]
+            try:
+                done[key] = future.result()
+            except Exception as error:
+                failures[key] = str(error) or error.__class__.__name__
+                continue
+
+            checkpoint.record(step, key, done[key])
+            if count % 100 == 0:
+                log(f"{step}: {count} of {len(remaining)} requested")
+
+    return {key: done[key] for key in keys if key in done}, failures
+
+
+def scrape_listings(checkpoint, max_workers, rate_limit, log=print):
+    """
+    Scrapes every listing page of eoddata.com concurrently.
+
+    :return listings: A dictionary with key value pairs of Ticker:Company name
+    :raises UniverseBuildError: If any of the pages could not be scraped
+    """
+    session = requests.Session()
+    session.headers.update(USER_AGENT_HEADERS)
+
+    pages, failures = run_step(checkpoint, 'pages', EXCHANGE_PAGE_URLS, lambda url: scrape_listing_page(session, url),
+                               max_workers, RateLimiter(rate_limit), log)
+    if failures:
+        raise UniverseBuildError(failures)
+
+    # A ticker listed under several names keeps the first one in alphabetical order
+    listings = {}
+    for company_name, ticker in sorted(row for rows in pages.values() for row in rows):
+        listings.setdefault(ticker, company_name)
+    return listings
+
+
+def fetch_first_trade_dates(tickers, checkpoint, max_workers, rate_limit, log=print):
+    """
+    Requests the first trade date of every ticker concurrently.
+
+    :param tickers: A list of strings representing the tickers
+    :return first_trade_dates: A dictionary with key value pairs of Ticker:First trade date, where the first trade date
+    is None for the tickers that Yahoo Finance does not know
+    :raises UniverseBuildError: If any of the requests failed
+    """
+    first_trade_dates, failures = run_step(checkpoint, 'first_trade_dates', tickers, query_first_trade_date,
+                                           max_workers, RateLimiter(rate_limit), log)
+    if failures:
+        raise UniverseBuildError(failures)
+    return first_trade_dates
+
+
+def write_stocks_csv(path, rows):
+    """
+    Writes the rows of the ticker universe into a csv file. The file is replaced at once, so a reader never sees a
+    partially written file.
+
+    :param path: A string representing the path of the csv file
+    :param rows: An iterable of (company name, ticker, first trade date, delisted date) tuples, where the delisted date
+    is None for the tickers that are still listed
+    :return: None
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(csv_columns)
+        writer.writerows(rows)
+    os.replace(temporary_path, path)
+
+
+def build_ticker_universe(path, checkpoint, max_workers, rate_limit, log=print):
+    """
+    Rebuilds the stocks.csv file from scratch: every listing page is scraped and the first trade date of every ticker
+    is requested, both concurrently under the rate limit. The checkpoint is cleared once the file is written.
+
+    :param path: A string representing the path of the csv file
+    :param checkpoint: A Checkpoint
+    :param max_workers: An integer representing the number of concurrent requests
+    :param rate_limit: A number representing the maximum number of requests per second sent to each site
+    :param log: A callable taking a progress message
+    :return: The number of tickers written
+    :raises UniverseBuildError: If anything could not be fetched, in which case the file is left untouched
+    """
+    listings = scrape_listings(checkpoint, max_workers, rate_limit, log)
+    first_trade_dates = fetch_first_trade_dates(sorted(listings), checkpoint, max_workers, rate_limit, log)
+
+    rows = [(listings[ticker], ticker, first_trade_date, None)
+            for ticker, first_trade_date in first_trade_dates.items() if first_trade_date is not None]
+    write_stocks_csv(path, rows)
+
+    checkpoint.clear()
+    return len(rows)
+
+
+def refresh_ticker_universe(path, checkpoint, max_workers, rate_limit, log=print):
+    """
+    Refreshes the stocks.csv file incrementally. The listings are scraped again and compared with the file, and only
+    the tickers that are new, now listed under another company name, or listed again after being delisted have their
+    first trade date requested, since it never changes for an existing listing. The tickers that are no longer listed
+    are kept and marked as delisted.
+
+    :param path: A string representing the path of the csv file
+    :param checkpoint: A Checkpoint
+    :param max_workers: An integer representing the number of concurrent requests
+    :param rate_limit: A number representing the maximum number of requests per second sent to each site
+    :param log: A callable taking a progress message
+    :return changes: A dictionary with the number of tickers that were 'added', 'changed' and 'delisted'
+    :raises UniverseBuildError: If anything could not be fetched, in which case the file is left untouched
+    """
+    listings = scrape_listings(checkpoint, max_workers, rate_limit, log)
+    existing_rows = {ticker: (company_name, ticker, first_trade_date, delisted_date)
+                     for company_name, ticker, first_trade_date, delisted_date in read_stocks_csv(path)}
+
+    queried_tickers = sorted(
+        ticker for ticker, company_name in listings.items()
+        if ticker not in existing_rows or existing_rows[ticker][0] != company_name or existing_rows[ticker][3]
+    )
+    first_trade_dates = fetch_first_trade_dates(queried_tickers, checkpoint, max_workers, rate_limit, log)
+
+    today = int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    changes = {'added': 0, 'changed': 0, 'delisted': 0}
+    rows = dict(existing_rows)
+
+    for ticker, first_trade_date in first_trade_dates.items():
+        # A ticker that Yahoo Finance does not know is only added once it does
+        if first_trade_date is None:
+            continue
+        changes['changed' if ticker in rows else 'added'] += 1
+        rows[ticker] = (listings[ticker], ticker, first_trade_date, None)
+
+    for ticker, (company_name, _, first_trade_date, delisted_date) in existing_rows.items():
+        if ticker not in listings and delisted_date is None:
+            changes['delisted'] += 1
+            rows[ticker] = (company_name, ticker, first_trade_date, today)
+
+    if any(changes.values()):
+        write_stocks_csv(path, [rows[ticker] for ticker in sorted(rows)])
+
+    checkpoint.clear()
+    return changes
@@ -0,0 +1,400 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+from .metrics import record_upstream_response, timed
+
+# The status codes after which a request is worth retrying
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Set the user agent headers to be able to send queries to Yahoo Finance
+USER_AGENT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/39.0.2171.95 Safari/537.36'
+}
+
+# The client shared by every thread of the process, so connections are kept alive between requests
+_upstream_client = None
+_upstream_client_lock = threading.RLock()
+
+# The asynchronous clients of the process, one per event loop since their connections belong to the loop
+_async_upstream_clients = weakref.WeakKeyDictionary()
+
+# Shared by the clients of the process, since they all talk to the same upstream
+_circuit_breaker = None
+
+
+class UpstreamError(Exception):
+    """
+    Raised when the upstream could not answer a request, after all the retries were used.
+
+    :param status_code: An integer representing the status code of the last response, or None if there was none
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    Raised without contacting the upstream while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to the upstream after several consecutive failures, so that requests fail fast instead of
+    waiting on a service that is down. Once reset_timeout seconds have passed, a single trial request is let through,
+    and the circuit closes again if it succeeds.
+
+    :param failure_threshold: An integer representing the number of consecutive failures that opens the circuit
+    :param reset_timeout: A number representing the seconds the circuit stays open before a trial request
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        :return: A boolean value that is True if a request can be sent to the upstream
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_in_progress or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class BaseUpstreamClient:
+    """
+    The settings shared by the blocking and the asynchronous clients of the Yahoo Finance chart endpoint. Connections
+    are pooled and kept alive, every request has a timeout, requests that fail with a connection error, a 429 or a 5xx
+    are retried with jittered exponential backoff, and a circuit breaker stops sending requests while the upstream
+    keeps failing.
+
+    :param base_url: A string representing the scheme and host of the upstream, e.g. https://query1.finance.yahoo.com
+    :param connect_timeout: A number representing the seconds to wait for a connection
+    :param read_timeout: A number representing the seconds to wait for the response
+    :param max_retries: An integer representing the number of times a failed request is retried
+    :param backoff_factor: A number representing the base delay in seconds between two attempts
+    :param pool_size: An integer representing the number of connections kept alive
+    :param circuit_breaker: A CircuitBreaker
+    """
+
+    def __init__(self, base_url, connect_timeout, read_timeout, max_retries, backoff_factor, pool_size,
+                 circuit_breaker):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.circuit_breaker = circuit_breaker
+
+    def backoff_delay(self, attempt, response=None):
+        """
+        Returns the seconds to wait before the next attempt, honouring the Retry-After header of a 429 or 503.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.read_timeout)
+        return self.backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class UpstreamClient(BaseUpstreamClient):
+    """
+    A blocking client for the Yahoo Finance chart endpoint, built on a requests session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.session = requests.Session()
+        self.session.headers.update(USER_AGENT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, path, params=None, timeout=None):
+        """
+        Sends a GET request to the upstream and returns the decoded JSON body of a successful response.
+
+        :param path: A string representing the path of the endpoint, e.g. /v8/finance/chart/AAPL
+        :param params: A dictionary of query parameters
+        :param timeout: A number representing the seconds to wait for the response, overriding read_timeout
+        :return: The decoded JSON body
+        :raises UpstreamError: If the request failed after all the retries, or the upstream answered with an error
+        """
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError('The upstream is unavailable, the circuit breaker is open')
+
+        # Every request let through records an outcome, or a trial request would keep the circuit open for good
+        try:
+            response = self.send(path, params, (self.connect_timeout, timeout or self.read_timeout))
+        except BaseException:
+            self.circuit_breaker.record_failure()
+            raise
+
+        # Any other answer means the upstream is up, even if the request itself was invalid
+        self.circuit_breaker.record_success()
+
+        if response.status_code >= 400:
+            raise UpstreamError(f"The upstream answered {response.status_code}: {error_description(response)}",
+                                status_code=response.status_code)
+        return response.json()
+
+    def send(self, path, params, timeouts):
+        """
+        Sends a GET request to the upstream, retrying it after a connection error, a timeout, a 429 or a 5xx.
+
+        :return response: The first response whose status code is not worth retrying
+        :raises UpstreamError: If the request failed after all the retries, or could not be sent
+        """
+        url = self.base_url + path
+        error = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff_delay(attempt - 1, response))
+
+            response = None
+            try:
+                with timed('upstream_request'):
+                    response = self.session.get(url, params=params, timeout=timeouts)
+            except (requests.ConnectionError, requests.Timeout) as request_error:
+                error = UpstreamError(f"{request_error.__class__.__name__} while requesting {path}")
+                continue
+            except requests.RequestException as request_error:
+                # Such as an invalid url or too many redirects, which a retry would not fix
+                raise UpstreamError(f"{request_error.__class__.__name__} while requesting {path}") from request_error
+            finally:
+                record_upstream_response('sync', response)
+
+            if response.status_code in RETRY_STATUS_CODES:
+                error = UpstreamError(f"The upstream answered {response.status_code} for {path}",
+                                      status_code=response.status_code)
+                continue
+            return response
+
+        raise error
+
+    def chart(self, ticker, params=None, timeout=None):
+        """
+        Requests the chart endpoint of a ticker.
+
+        :param ticker: A string that represents the specific ticker that is used
+        :param params: A dictionary of query parameters, such as period1, period2 and interval
+        :param timeout: A number representing the seconds to wait for the response
+        :return: A dictionary containing the server's response
+        """
+        return self.get_json(f"/v8/finance/chart/{ticker}", params=params, timeout=timeout)
+
+
+class AsyncUpstreamClient(BaseUpstreamClient):
+    """
+    An asynchronous client for the Yahoo Finance chart endpoint, built on an httpx.AsyncClient. A request waiting on
+    the upstream does not hold a thread, so a single event loop can wait on many of them. The client must only be used
+    from the event loop it was created in.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.client = httpx.AsyncClient(
+            headers=USER_AGENT_HEADERS,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        )
+
+    async def get_json(self, path, params=None, timeout=None):
+        """
+        Sends a GET request to the upstream and returns the decoded JSON body of a successful response. Behaves like
+        UpstreamClient.get_json, but waits without blocking the event loop.
+
+        :param path: A string representing the path of the endpoint, e.g. /v8/finance/chart/AAPL
+        :param params: A dictionary of query parameters
+        :param timeout: A number representing the seconds to wait for the response, overriding read_timeout
+        :return: The decoded JSON body
+        :raises UpstreamError: If the request failed after all the retries, or the upstream answered with an error
+        """
+        if not self.circuit_breaker.allow_request():
+            raise CircuitOpenError('The upstream is unavailable, the circuit breaker is open')
+
+        # Every request let through records an outcome, even when it is cancelled, or a trial request would keep the
+        # circuit open for good
+        try:
+            response = await self.send(path, params, httpx.Timeout(timeout or self.read_timeout,
+                                                                   connect=self.connect_timeout))
+        except BaseException:
+            self.circuit_breaker.record_failure()
+            raise
+
+        # Any other answer means the upstream is up, even if the request itself was invalid
+        self.circuit_breaker.record_success()
+
+        if response.status_code >= 400:
+            raise UpstreamError(f"The upstream answered {response.status_code}: {error_description(response)}",
+                                status_code=response.status_code)
+        return response.json()
+
+    async def send(self, path, params, timeouts):
+        """
+        Sends a GET request to the upstream, retrying it after a transport error, a 429 or a 5xx.
+
+        :return response: The first response whose status code is not worth retrying
+        :raises UpstreamError: If the request failed after all the retries, or could not be sent
+        """
+        url = self.base_url + path
+        error = None
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_delay(attempt - 1, response))
+
+            response = None
+            try:
+                with timed('upstream_request'):
+                    response = await self.client.get(url, params=params, timeout=timeouts)
+            except httpx.TransportError as request_error:
+                error = UpstreamError(f"{request_error.__class__.__name__} while requesting {path}")
+                continue
+            except (httpx.HTTPError, httpx.InvalidURL) as request_error:
+                # Such as too many redirects or an invalid url, which a retry would not fix
+                raise UpstreamError(f"{request_error.__class__.__name__} while requesting {path}") from request_error
+            finally:
+                record_upstream_response('async', response)
+
+            if response.status_code in RETRY_STATUS_CODES:
+                error = UpstreamError(f"The upstream answered {response.status_code} for {path}",
+                                      status_code=response.status_code)
+                continue
+            return response
+
+        raise error
+
+    async def chart(self, ticker, params=None, timeout=None):
+        """
+        Requests the chart endpoint of a ticker.
+
+        :param ticker: A string that represents the specific ticker that is used
+        :param params: A dictionary of query parameters, such as period1, period2 and interval
+        :param timeout: A number representing the seconds to wait for the response
+        :return: A dictionary containing the server's response
+        """
+        return await self.get_json(f"/v8/finance/chart/{ticker}", params=params, timeout=timeout)
+
+
+def error_description(response):
+    """
+    Extracts the error message of a failed chart response, falling back to the reason phrase of the status code.
+    """
+    try:
+        error = response.json()['chart']['error']
+        return error.get('description') or error.get('code')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        # requests names the reason phrase reason, and httpx names it reason_phrase
+        return getattr(response, 'reason', None) or getattr(response, 'reason_phrase', None)
+
+
+def get_circuit_breaker():
+    """
+    Returns the circuit breaker shared by the clients of the process, creating it from the UPSTREAM_CLIENT setting.
+
+    :return: A CircuitBreaker
+    """
+    global _circuit_breaker
+    with _upstream_client_lock:
+        if _circuit_breaker is None:
+            options = settings.UPSTREAM_CLIENT
+            _circuit_breaker = CircuitBreaker(options['CIRCUIT_FAILURE_THRESHOLD'], options['CIRCUIT_RESET_TIMEOUT'])
+    return _circuit_breaker
+
+
+def create_upstream_client(client_class=UpstreamClient):
+    """
+    Builds a client from the UPSTREAM_CLIENT setting.
+
+    :param client_class: Either UpstreamClient or AsyncUpstreamClient
+    :return: An instance of client_class
+    """
+    options = settings.UPSTREAM_CLIENT
+    return client_class(
+        base_url=options['BASE_URL'],
+        connect_timeout=options['CONNECT_TIMEOUT'],
+        read_timeout=options['READ_TIMEOUT'],
+        max_retries=options['MAX_RETRIES'],
+        backoff_factor=options['BACKOFF_FACTOR'],
+        pool_size=options['POOL_SIZE'],
+        circuit_breaker=get_circuit_breaker()
+    )
+
+
+def get_upstream_client():
+    """
+    Returns the upstream client of the process, creating it on first use.
+
+    :return: An UpstreamClient
+    """
+    global _upstream_client
+    if _upstream_client is None:
+        with _upstream_client_lock:
+            if _upstream_client is None:
+                _upstream_client = create_upstream_client()
+    return _upstream_client
+
+
+def get_async_upstream_client():
+    """
+    Returns the asynchronous upstream client of the running event loop, creating it on first use.
+
+    :return: An AsyncUpstreamClient
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_upstream_clients.get(loop)
+    if client is None:
+        client = _async_upstream_clients[loop] = create_upstream_client(AsyncUpstreamClient)
+    return client
+
+
+@receiver(setting_changed)
+def reset_upstream_client(setting=None, **kwargs):
+    """
+    Discards the upstream clients of the process, so the next request builds new ones from the current settings. Also
+    called whenever the UPSTREAM_CLIENT setting is overridden, e.g. by the tests.
+    """
+    global _upstream_client, _circuit_breaker
+    if setting not in (None, 'UPSTREAM_CLIENT'):
+        return
+    with _upstream_client_lock:
+        _upstream_client = None
+        _circuit_breaker = None
+        _async_upstream_clients.clear()
@@ -1,6 +1,6 @@
 from django.urls import path
 from .views import StockParameterFormView, StockSelectionView, ResultsView, autocomplete_stock_list, CustomLoginView, \
-    RegistrationView
+    RegistrationView, results_status, results_stream, metrics, profile_list, profile_detail, profile_download
 from django.contrib.auth.views import LogoutView
 
 urlpatterns = [
@@ -10,5 +10,11 @@ urlpatterns = [
     path('', StockParameterFormView.as_view(), name='index'),
     path('select/', StockSelectionView.as_view(), name='select_stock'),
     path('results/', ResultsView.as_view(), name='results'),
-    path('filtered_tickers/', autocomplete_stock_list, name='autocomplete')
+    path('results/status/<str:job_id>/', results_status, name='results_status'),
+    path('results/stream/', results_stream, name='results_stream'),
+    path('filtered_tickers/', autocomplete_stock_list, name='autocomplete'),
+    path('metrics/', metrics, name='metrics'),
+    path('profiles/', profile_list, name='profile_list'),
+    path('profiles/<str:profile_id>/', profile_detail, name='profile_detail'),
+    path('profiles/<str:profile_id>/<str:kind>/', profile_download, name='profile_download')
 ]
@@ -1,88 +1,129 @@
-import matplotlib.pyplot as plt
-
-plt.switch_backend('Agg')
-from io import BytesIO
-import base64
+import numpy as np
 import pandas as pd
-from .models import StockTicker
+from django.conf import settings
+from django.db import transaction
+from .models import StockTicker, TickerUniverseVersion
+from .alignment import align_price_histories
+from .indices import index_ticker_hash
+from .metrics import timed
+from .price_store import afetch_price_histories, fetch_price_histories
+from .upstream import get_async_upstream_client, get_upstream_client
 import os
 import datetime, time
-import requests
-
-index_ticker_hash = {
-    'S&P 500': '^GSPC',
-    'DJIA': '^DJI',
-    'NASDAQ-100': '^NDX'
-}
+import hashlib
 
-index_name_hash = {
-    'S&P 500': 'Standard & Poor\'s 500',
-    'DJIA': 'Dow Jones Industrial Average',
-    'NASDAQ-100': 'Nasdaq-100'
-}
+# The number of rows sent per query when the tickers are imported into the database
+TICKER_BATCH_SIZE = 500
 
 
-def add_tickers_to_db():
+def add_tickers_to_db(force=False, using='default'):
     """
-    Deletes all previous entries and add the rows of the stocks.csv file into the database.
+    Synchronizes the StockTicker table with the rows of the stocks.csv file. Nothing is written if the checksum of the
+    file matches the one of the last import, so the function is cheap to call repeatedly. Otherwise, the tickers that
+    are new or changed are upserted, and tickers that are no longer in the file are deleted, all in batches.
 
-    :return: None
+    :param force: A boolean value to determine whether the import should run even if the file has not changed
+    :param using: A string representing the alias of the database the tickers are written to
+    :return: A boolean value that is True if the table was written to
     """
     csv_path = os.path.join(os.path.dirname(__file__), 'stocks.csv')
-    tickers_df = pd.read_csv(csv_path)
-
-    StockTicker.objects.all().delete()
-    for index, row in tickers_df.iterrows():
-        _, _ = StockTicker.objects.get_or_create(
-            ticker=row['ticker'],
-            first_trade_date=row['first_trade_date'],
-            company_name=row['company_name']
+    with open(csv_path, 'rb') as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+
+    latest_version = TickerUniverseVersion.objects.using(using).order_by('-id').first()
+    if not force and latest_version is not None and latest_version.checksum == checksum:
+        return False
+
+    with timed('ticker_import'), transaction.atomic(using=using):
+        existing_tickers = StockTicker.objects.using(using).in_bulk(field_name='ticker')
+        upserted_tickers = []
+
+        for company_name, ticker, first_trade_date, delisted_date in read_stocks_csv(csv_path):
+            stock = existing_tickers.pop(ticker, None)
+            if stock is None or (stock.first_trade_date, stock.company_name, stock.delisted_date) != \
+                    (first_trade_date, company_name, delisted_date):
+                upserted_tickers.append(StockTicker(ticker=ticker, first_trade_date=first_trade_date,
+                                                    company_name=company_name, delisted_date=delisted_date))
+
+        # New and changed tickers are written with a single INSERT ... ON CONFLICT DO UPDATE per batch
+        StockTicker.objects.using(using).bulk_create(
+            upserted_tickers, batch_size=TICKER_BATCH_SIZE, update_conflicts=True, unique_fields=['ticker'],
+            update_fields=['first_trade_date', 'company_name', 'delisted_date']
         )
 
+        # The tickers left over are no longer listed in the file
+        StockTicker.objects.using(using).filter(ticker__in=list(existing_tickers)).delete()
+
+        TickerUniverseVersion.objects.using(using).create(checksum=checksum)
+
+    return True
 
-def filter_stock_by_start_date(start_date):
+
+def read_stocks_csv(csv_path):
     """
-    Filters out the stocks that have a first trade date that is greater than the start date set by the user
+    Reads the rows of a stocks.csv file. The delisted_date column is optional.
 
-    :param start_date: A string that represents the start date set by the user in the Stock Market Parameters page. The
-    format of the string is YYYY-MM-DD
-    :return filtered_stocks: A list of strings representing all the filtered stocks
+    :param csv_path: A string representing the path of the csv file
+    :return: A list of (company name, ticker, first trade date, delisted date) tuples, where the delisted date is None
+    for the tickers that are still listed
     """
-    filtered_stocks = []
-    stock_tickers = StockTicker.objects.all()
+    # Tickers such as NA would otherwise be read as missing values
+    tickers_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    delisted_dates = tickers_df['delisted_date'] if 'delisted_date' in tickers_df else [''] * len(tickers_df)
 
-    for stock in stock_tickers:
-        first_trade_date = stock.first_trade_date
-        if first_trade_date < start_date:
-            filtered_stocks.append((stock.ticker, stock.company_name))
-    return filtered_stocks
+    return [(company_name, ticker, int(first_trade_date), int(delisted_date) if delisted_date else None)
+            for company_name, ticker, first_trade_date, delisted_date in zip(tickers_df['company_name'],
+                                                                             tickers_df['ticker'],
+                                                                             tickers_df['first_trade_date'],
+                                                                             delisted_dates)]
 
 
-def query_historical_stock_data(stock_ticker, start_date, end_date):
+def query_historical_stock_data(stock_ticker, start_date, end_date, timeout=None):
     """
     Makes a request to the Yahoo Finance API for the historical stock data of the given stock. The time period for the
     historical stock data is defined by the start_date and end_date. The response to the server is then returned as
-    a dictionary.
+    a dictionary. The request goes through the shared upstream client, which pools connections and retries failures.
 
     :param stock_ticker: A string that represents the specific ticker that is used
-    :param start_date: A string that represents the start date set by the user in the Stock Market Parameters page. The
-    format of the string is YYYY-MM-DD
-    :param end_date: A string that represents the end date set by the user in the Stock Market Parameters page. The
-    format of the string is YYYY-MM-DD
+    :param start_date: An integer that represents the start of the time period in epoch form
+    :param end_date: An integer that represents the end of the time period in epoch form
+    :param timeout: The number of seconds to wait for the server. None uses the READ_TIMEOUT of UPSTREAM_CLIENT
     :return data: A dictionary containing the server's response
+    :raises UpstreamError: If the server could not be reached or answered with an error
     """
-    url = 'https://query1.finance.yahoo.com/v7/finance/chart/{stock_ticker}?period1={start_date}&period2={end_date}\
-    &interval=1d&events=history&includeAdjustedClose=true'
-    user_agent_headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko)\
-         Chrome/39.0.2171.95 Safari/537.36'}
+    data = get_upstream_client().chart(stock_ticker, params=chart_params(start_date, end_date), timeout=timeout)
+    return data
 
-    query_url = url.format(stock_ticker=stock_ticker, start_date=start_date, end_date=end_date)
 
-    response = requests.get(url=query_url, headers=user_agent_headers)
-    data = response.json()
+async def aquery_historical_stock_data(stock_ticker, start_date, end_date, timeout=None):
+    """
+    Makes the same request as query_historical_stock_data through the asynchronous upstream client of the running
+    event loop, so that waiting on the server does not block a thread.
+
+    :param stock_ticker: A string that represents the specific ticker that is used
+    :param start_date: An integer that represents the start of the time period in epoch form
+    :param end_date: An integer that represents the end of the time period in epoch form
+    :param timeout: The number of seconds to wait for the server. None uses the READ_TIMEOUT of UPSTREAM_CLIENT
+    :return data: A dictionary containing the server's response
+    :raises UpstreamError: If the server could not be reached or answered with an error
+    """
+    data = await get_async_upstream_client().chart(stock_ticker, params=chart_params(start_date, end_date),
+                                                   timeout=timeout)
     return data
 
+
+def chart_params(start_date, end_date):
+    """
+    Builds the query parameters requesting the daily history of a ticker between two dates in epoch form.
+    """
+    return {
+        'period1': start_date,
+        'period2': end_date,
+        'interval': '1d',
+        'events': 'history',
+        'includeAdjustedClose': 'true'
+    }
+
 def ticker_extractor(chosen_stock):
     """
     Extracts the ticker from the chosen_stock string.
@@ -106,20 +147,39 @@ def calculate_investment_fluctuations(stock_data, amount_invested):
     :param stock_data: The array of historical stock data
     :param amount_invested: An integer representing the amount invested in the given stock. This is defined by the
     user input in the Stock Selection page
-    :return stock_growth: A tuple of two integer lists containing the growth of the stock in terms of percentages in the
+    :return stock_growth: A tuple of two NumPy arrays containing the growth of the stock in terms of percentages in the
     first index, and raw dollars in the second index
     """
+    stock_data = np.asarray(stock_data, dtype=np.float64)
 
-    stock_growth_percentage = [(x / stock_data[0]) * 100 for x in stock_data]
+    stock_growth_percentage = (stock_data / stock_data[0]) * 100
 
     # The growth of the investment in dollars (based on amount invested)
-    stock_investment_growth = [(percentage * float(amount_invested)) / 100 for percentage in stock_growth_percentage]
+    stock_investment_growth = (stock_growth_percentage * float(amount_invested)) / 100
 
     stock_growth = (stock_growth_percentage, stock_investment_growth)
 
     return stock_growth
 
 
+def value_portfolio(price_matrix, amounts_invested):
+    """
+    Values every holding of the portfolio on every trading day. Each amount is converted into a number of shares at
+    the price of the first day, so the whole valuation is a single matrix-vector product.
+
+    :param price_matrix: A (days x tickers) matrix of prices, as returned by align_price_histories
+    :param amounts_invested: An array with the amount invested in each ticker, in the order of the columns
+    :return: A tuple of the (days x tickers) matrix of the value of each holding in dollars and the array of the total
+    value of the portfolio in dollars
+    """
+    shares = np.asarray(amounts_invested, dtype=np.float64) / price_matrix[0]
+
+    holdings_value = price_matrix * shares
+    portfolio_value = price_matrix @ shares
+
+    return holdings_value, portfolio_value
+
+
 def calculate_overall_stock_change(stock_data):
     """
     Calculates the overall growth of a stock, represented in percentages
@@ -166,109 +226,72 @@ def create_plotting_df(start_date, end_date, stock_portfolio, index):
 
     """
     index_ticker = index_ticker_hash[index]
-    amount_invested_index = 0
+    start_date_epoch, end_date_epoch = simulation_epochs(start_date, end_date)
 
-    start_date_datetime = datetime.datetime.strptime(start_date, '%Y-%m-%d')
-    start_date_epoch = int(time.mktime(start_date_datetime.timetuple()))
+    # Fetch every ticker and the index at once, the dataframe is only assembled after all of them have arrived
+    with timed('fetch'):
+        price_histories = fetch_price_histories(list(stock_portfolio) + [index_ticker], start_date_epoch,
+                                                end_date_epoch)
+    with timed('assemble'):
+        return assemble_plotting_df(price_histories, stock_portfolio, index_ticker)
 
-    end_date_datetime = datetime.datetime.strptime(end_date, '%Y-%m-%d')
-    end_date_epoch = int(time.mktime(end_date_datetime.timetuple()))
 
-    # Create an empty Series to save the dollar values of the user's portfolio. The ticker used is the first ticker of
-    # the stock portfolio to copy the TimeStamp index.
-    portfolio_and_index_tracker = pd.DataFrame()
+async def acreate_plotting_df(start_date, end_date, stock_portfolio, index):
+    """
+    Creates the same dataframe as create_plotting_df, fetching the historical data without blocking the event loop.
+    """
+    index_ticker = index_ticker_hash[index]
+    start_date_epoch, end_date_epoch = simulation_epochs(start_date, end_date)
 
-    for ticker in stock_portfolio:
-        stock_data = query_historical_stock_data(ticker, start_date_epoch, end_date_epoch)
-        amount_invested_stock = stock_portfolio[ticker]
-        amount_invested_index += stock_portfolio[ticker]
+    with timed('fetch'):
+        price_histories = await afetch_price_histories(list(stock_portfolio) + [index_ticker], start_date_epoch,
+                                                       end_date_epoch)
+    with timed('assemble'):
+        return assemble_plotting_df(price_histories, stock_portfolio, index_ticker)
 
-        # If the dataframe is empty, add the timestamp indices and create the default 4 columns
-        if portfolio_and_index_tracker.empty:
-            timestamp_epoch = stock_data['chart']['result'][0]['timestamp']
-            timestamp_datetime = [datetime.datetime.utcfromtimestamp(time).date() for time in timestamp_epoch]
 
-            portfolio_and_index_tracker = pd.DataFrame(0, index=timestamp_datetime,
-                                                       columns=['Portfolio Value', 'Index Value', 'Portfolio Growth',
-                                                                'Index Growth'])
+def simulation_epochs(start_date, end_date):
+    """
+    Converts the start and end dates set by the user in the format YYYY-MM-DD into epoch form.
 
-        historical_stock_data = stock_data['chart']['result'][0]['indicators']['quote'][0]['close']
-        stock_growth = calculate_investment_fluctuations(historical_stock_data, amount_invested_stock)
+    :return: A tuple of integers representing the start and end dates in epoch form
+    """
+    start_date_datetime = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    start_date_epoch = int(time.mktime(start_date_datetime.timetuple()))
 
-        for i in range(len(stock_growth[0])):
-            portfolio_and_index_tracker['Portfolio Value'][i] += stock_growth[1][i]
+    end_date_datetime = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    end_date_epoch = int(time.mktime(end_date_datetime.timetuple()))
 
-        # Add the individual stock fluctuations (in $) into the dataframe
-        portfolio_and_index_tracker[ticker] = stock_growth[1]
+    return start_date_epoch, end_date_epoch
 
-    for i in range(len(stock_growth[0])):
-        portfolio_and_index_tracker['Portfolio Growth'][i] = (portfolio_and_index_tracker['Portfolio Value'][i] /
-                                                              portfolio_and_index_tracker['Portfolio Value'][0]) * 100
 
-    # Historical price of the index
-    index_data = query_historical_stock_data(index_ticker, start_date_epoch, end_date_epoch)
-    historical_index_data = index_data['chart']['result'][0]['indicators']['quote'][0]['close']
+def assemble_plotting_df(price_histories, stock_portfolio, index_ticker):
+    """
+    Values the portfolio and the index on their shared trading calendar and assembles the dataframe returned by
+    create_plotting_df.
 
-    index_growth = calculate_investment_fluctuations(historical_index_data, amount_invested_index)
+    :param price_histories: A dictionary with key value pairs of Ticker:History, as returned by fetch_price_histories
+    :param stock_portfolio: A dictionary with key value pairs of Ticker:Investment amount
+    :param index_ticker: A string representing the ticker of the index
+    :return portfolio_and_index_tracker: A pandas dataframe, as returned by create_plotting_df
+    """
+    tickers = list(stock_portfolio)
+    amounts_invested = np.array([stock_portfolio[ticker] for ticker in tickers], dtype=np.float64)
 
-    portfolio_and_index_tracker['Index Value'] = index_growth[1]
-    portfolio_and_index_tracker['Index Growth'] = index_growth[0]
+    # The index is the last column of the matrix so that it shares the trading calendar of the portfolio
+    trading_days, price_matrix = align_price_histories(price_histories, tickers + [index_ticker],
+                                                       gap_policy=settings.PRICE_GAP_POLICY)
+    holdings_value, portfolio_value = value_portfolio(price_matrix[:, :-1], amounts_invested)
 
-    return portfolio_and_index_tracker
+    # The index is bought with the total amount of money invested in the portfolio
+    index_growth = calculate_investment_fluctuations(price_matrix[:, -1], amounts_invested.sum())
+    portfolio_growth = (portfolio_value / portfolio_value[0]) * 100
 
+    timestamp_datetime = pd.to_datetime(trading_days, unit='D').date
+    columns = np.column_stack([portfolio_value, index_growth[1], portfolio_growth, index_growth[0], holdings_value])
 
-def plot_stock_data(portfolio_and_index_tracker, index, portfolio_only=False, percentage=False):
-    """
-    Creates a plot for the data and returns a string of decoded bytes that represent the plotted graph as
-    a PNG image
+    portfolio_and_index_tracker = pd.DataFrame(columns, index=timestamp_datetime,
+                                               columns=['Portfolio Value', 'Index Value', 'Portfolio Growth',
+                                                        'Index Growth'] + tickers)
 
-    :param portfolio_and_index_tracker: A pandas dataframe returned by the create_plotting_df function
-    :param index: A string representing the index that is chosen by the user
-    :param portfolio_only: A boolean value to determine whether only the portfolio should be graphed or not. If False,
-    the graph will include both the portfolio and the index
-    :param percentage: A boolean value to determine whether the percentage should be graphed or not. If False,
-    the graph is plotted with regards to the dollar
-    :return graph: A string of decoded bytes that represent the graph as a PNG image
-    """
-    index_name = index_name_hash[index]
-
-    portfolio_tracker = portfolio_and_index_tracker.iloc[:, 4:].copy()
-
-    plt.figure(figsize=(10, 4))
-    plt.ticklabel_format(style='plain')
-
-    # Portfolio vs Index in dollars
-    if not portfolio_only and not percentage:
-        plt.plot(portfolio_and_index_tracker['Portfolio Value'], label="Portfolio")
-        plt.plot(portfolio_and_index_tracker['Index Value'], label=index_name)
-        plt.legend()
-
-    # Portfolio vs Index in percentage
-    elif not portfolio_only and percentage:
-        plt.plot(portfolio_and_index_tracker['Portfolio Growth'], label="Portfolio")
-        plt.plot(portfolio_and_index_tracker['Index Growth'], label=index_name)
-        plt.legend()
-
-    # Constituents of Portfolio in dollars
-    elif portfolio_only and not percentage:
-        for column in portfolio_tracker:
-            plt.plot(portfolio_tracker[column], label=column)
-        plt.legend()
-    # Constituents of Portfolio in percentage
-    else:
-        for column in portfolio_tracker:
-            percentage = portfolio_tracker[column].divide(portfolio_tracker[column][0]) * 100
-            plt.plot(percentage, label=column)
-        plt.legend()
-
-    buffer = BytesIO()
-    plt.savefig(buffer, format='png')
-    buffer.seek(0)
-    image_png = buffer.getvalue()
-    buffer.close()
-
-    # plt.savefig('graph.png')
-
-    graph = base64.b64encode(image_png)
-    graph = graph.decode('utf-8')
-    return graph
+    return portfolio_and_index_tracker
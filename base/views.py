@@ -1,25 +1,45 @@
 from django import forms
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
-from django.urls import reverse_lazy
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, JsonResponse, \
+    StreamingHttpResponse, FileResponse, Http404
+from django.template.loader import render_to_string
+from django.urls import reverse, reverse_lazy
+from django.views import View
 from django.views.generic.edit import FormView, CreateView, UpdateView
 from django.views.generic.list import ListView
 
-from django.contrib.auth.views import LoginView
+from django.contrib.auth.views import LoginView, redirect_to_login
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
 
 from .models import StockParameters, StockTicker
 from .forms import RegistrationForm, LoginForm, StockMarketParametersForm
-from .utils import plot_stock_data, add_tickers_to_db, filter_stock_by_start_date, ticker_extractor, \
-    create_plotting_df, calculate_investment_fluctuations, calculate_overall_stock_change
-
+from .utils import ticker_extractor
+from .price_store import PriceFetchError
+from .alignment import AlignmentError
+from .jobs import get_job_status, submit_results_job
+from .results import aget_results, chart_modes, error_messages, get_cached_results, get_results, iter_results
+from .universe import get_ticker_universe
+from .metrics import registry, timed
+from .profiling import list_profiles, profile_kinds, profile_path
+
+from asgiref.sync import sync_to_async
 import requests
 import yfinance as yf
 from datetime import datetime
+import hmac
+import json
+import os
 import time
 
+# Marks the places of the streamed Results page where the rows and the summary are inserted
+STREAM_MARKER = '<!-- stream -->'
+
 class CustomLoginView(LoginView):
     """
     Class to render the registration page. Inherits from the LoginView.
@@ -69,7 +89,8 @@ class StockParameterFormView(LoginRequiredMixin, CreateView):
     def post(self, request):
         """
         After the user submits the form, save the inputs as session variables to be used in the subsequent views.
-        Additionally, add all the tickers from the stocks.csv file into the database.
+        The tickers are imported into the database once by the import_tickers command (or after migrate), so the
+        ticker table is never rewritten here.
         """
         money = self.request.POST.get('money')
         start_date = self.request.POST.get('start_date')
@@ -82,8 +103,8 @@ class StockParameterFormView(LoginRequiredMixin, CreateView):
         self.request.session['end_date'] = end_date
         self.request.session['index'] = index
         self.request.session['portfolio'] = {}
-        super(StockParameterFormView, self).post(request)
-        add_tickers_to_db()
+        with timed('form_save'):
+            super(StockParameterFormView, self).post(request)
 
 
         return HttpResponseRedirect(f'/select/')
@@ -123,91 +144,216 @@ class StockSelectionView(LoginRequiredMixin, ListView):
 
     def get_context_data(self, **kwargs):
         """
-        Gets the start date input and uses that to filter out the list of stocks that are valid for that given
-        timeframe. The filtered list of stocks are then saved as a session variable.
+        The stocks that are valid for the chosen timeframe are resolved from the start date by the autocomplete
+        endpoint, so nothing besides the start date needs to be kept in the session.
         """
 
         context = super().get_context_data(**kwargs)
 
-        start_date = self.request.session['start_date']
-        start_date_epoch = time.mktime(datetime.strptime(start_date, "%Y-%m-%d").timetuple())
-
-        filtered_stocks = filter_stock_by_start_date(start_date_epoch)
-        context['filtered_stocks'] = filtered_stocks
-        self.request.session['filtered_stocks'] = filtered_stocks
+        # Sessions created before the filtered stocks were resolved on demand still carry the full list
+        self.request.session.pop('filtered_stocks', None)
 
         return context
 
-class ResultsView(LoginRequiredMixin, ListView):
+class ResultsView(View):
     """
-    Class to render the RESULTS page. Inherits from the ListView. Requires the user to be logged in
-    to access the view.
+    Class to render the RESULTS page. The view is asynchronous, so that under ASGI a worker can wait on the upstream for
+    many simulations at once. Requires the user to be logged in to access the view.
     """
-    model = StockParameters
-    context_object_name = 'user_input_data'
     template_name = 'base/results.html'
+    pending_template_name = 'base/results_pending.html'
 
-    def get_context_data(self, **kwargs):
-        """
-        Creates the graph and the data to be displayed in the Results page. The data is displayed in the form of a
-        table.
+    def get_simulation_inputs(self):
         """
-        context = super().get_context_data(**kwargs)
+        Reads the inputs of the simulation from the session. The user and the session are loaded from the database, so
+        this is run in a thread.
 
+        :return: A tuple of the start date, end date, index and portfolio, or None if the user is not logged in
+        """
+        if not self.request.user.is_authenticated:
+            return None
 
-        start_date = self.request.session['start_date']
-        end_date = self.request.session['end_date']
-        index = self.request.session['index']
-        stock_portfolio = self.request.session['portfolio']
+        session = self.request.session
+        return session['start_date'], session['end_date'], session['index'], dict(session['portfolio'])
 
-        plotting_df = create_plotting_df(start_date, end_date, stock_portfolio, index)
-        portfolio_historical_data = plotting_df['Portfolio Value'].values.tolist()
-        index_historical_data = plotting_df['Index Value'].values.tolist()
+    async def get(self, request, *args, **kwargs):
+        """
+        Creates the graph and the data to be displayed in the Results page. The data is displayed in the form of a
+        table. The results are served from the results cache when the same simulation was already run. In the job
+        mode (e.g. /results/?mode=async), a simulation that is not cached is computed by a background worker instead,
+        and a page polling its status is returned right away. The streaming mode (?mode=stream) redirects to the
+        progressive Results page.
+        """
+        simulation_inputs = await sync_to_async(self.get_simulation_inputs)()
+        if simulation_inputs is None:
+            return redirect_to_login(request.get_full_path())
+
+        start_date, end_date, index, stock_portfolio = simulation_inputs
+        context = {}
+        template_name = self.template_name
+
+        chart_mode = get_chart_mode(request)
+        results_mode = request.GET.get('mode', settings.RESULTS_MODE)
+
+        if results_mode == 'stream':
+            return HttpResponseRedirect(f"{reverse('results_stream')}?charts={chart_mode}")
+
+        if results_mode == 'async':
+            # The results cache and the job registry are blocking, so they are used in a thread
+            results = await sync_to_async(get_cached_results)(start_date, end_date, stock_portfolio, index,
+                                                              chart_mode)
+            if results is None:
+                template_name = self.pending_template_name
+                context['job_id'] = await sync_to_async(submit_results_job)(start_date, end_date, stock_portfolio,
+                                                                            index, chart_mode)
+            else:
+                context.update(results)
+        else:
+            # Under WSGI, every request runs in an event loop of its own, which the connections and the in-flight
+            # fetches of the asynchronous client would not outlive, so the blocking client shared by the process is used
+            if isinstance(request, ASGIRequest):
+                results = aget_results(start_date, end_date, stock_portfolio, index, chart_mode)
+            else:
+                results = sync_to_async(get_results)(start_date, end_date, stock_portfolio, index, chart_mode)
+
+            try:
+                context.update(await results)
+            except (PriceFetchError, AlignmentError) as error:
+                # Report every ticker that failed rather than only the first one
+                context['fetch_errors'] = error_messages(error)
+
+        with timed('template'):
+            return await sync_to_async(render)(request, template_name, context)
+
+def get_chart_mode(request):
+    """
+    Returns how the graphs of the Results page are drawn. They can be drawn by the browser instead of the server, e.g.
+    /results/?charts=client
+    """
+    chart_mode = request.GET.get('charts', settings.RESULTS_CHART_MODE)
+    if chart_mode not in chart_modes:
+        chart_mode = settings.RESULTS_CHART_MODE
+    return chart_mode
 
 
-        portfolio_result = calculate_overall_stock_change(portfolio_historical_data)
-        index_result = calculate_overall_stock_change(index_historical_data)
+@login_required
+def results_stream(request):
+    """
+    A function based view that sends the Results page progressively. The row of each stock is sent as soon as it is
+    valued, followed by the summary and the graphs once the whole simulation is done, so the page starts rendering
+    before the slowest ticker has arrived.
+    """
+    # Django 4.1 iterates streaming responses inside the event loop under ASGI, where the simulation cannot access the
+    # database, so the whole page is sent at once instead
+    if isinstance(request, ASGIRequest):
+        return HttpResponseRedirect(f"{reverse('results')}?mode=sync&charts={get_chart_mode(request)}")
+
+    start_date = request.session['start_date']
+    end_date = request.session['end_date']
+    index = request.session['index']
+    stock_portfolio = dict(request.session['portfolio'])
+    chart_mode = get_chart_mode(request)
+
+    # The page is split where the rows and the summary are inserted
+    page = render_to_string('base/results_stream.html', request=request)
+    page_head, page_middle, page_tail = page.split(STREAM_MARKER)
+
+    def stream_page():
+        yield page_head
+
+        context = {}
+        try:
+            for kind, value in iter_results(start_date, end_date, stock_portfolio, index, chart_mode):
+                if kind == 'stock':
+                    yield render_to_string('base/results_stock_row.html', {'stock': value})
+                else:
+                    context = value
+        except (PriceFetchError, AlignmentError) as error:
+            context = {'fetch_errors': error_messages(error)}
+
+        yield page_middle
+        yield render_to_string('base/results_stream_summary.html', context, request=request)
+        yield page_tail
+
+    response = StreamingHttpResponse(stream_page(), content_type='text/html; charset=utf-8')
+    # Ask reverse proxies such as nginx to pass the chunks on as they are sent
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def results_status(request, job_id):
+    """
+    A function based view that returns the status of a simulation computed in the background. This is polled by the
+    waiting page of the Results page.
+    """
+    return JsonResponse(get_job_status(job_id))
 
-        portfolio_df = plotting_df.iloc[:,4:]
-        individual_stocks = []
+def metrics(request):
+    """
+    A function based view that returns the timings and counters of the process in the Prometheus text format. Only
+    staff members, and scrapers that send the METRICS_TOKEN as a bearer token, can read it.
+    """
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    has_token = bool(settings.METRICS_TOKEN) and hmac.compare_digest(authorization.encode(),
+                                                                     f"Bearer {settings.METRICS_TOKEN}".encode())
+    if not has_token and not (request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-        for col in portfolio_df:
-            ticker = col
-            stock_historical_data = portfolio_df[col].values.tolist()
-            stock_result = calculate_overall_stock_change(stock_historical_data)
-            individual_stocks.append([ticker,
-                                     round(stock_historical_data[-1], 2),
-                                     stock_result[1],
-                                     stock_result[0]]
-                                    )
+def profile_links(profile_id):
+    return {kind: reverse('profile_download', args=[profile_id, kind]) for kind in profile_kinds}
 
-        portfolio_vs_index_raw = plot_stock_data(plotting_df, index)
-        portfolio_raw = plot_stock_data(plotting_df, index, portfolio_only=True)
 
-        # The graphs
-        context['portfolio_vs_index_raw'] = portfolio_vs_index_raw
-        context['portfolio_raw'] = portfolio_raw
+@staff_member_required
+def profile_list(request):
+    """
+    A function based view that returns the profiled requests, the most recent first, along with the urls of their files.
+    """
+    profiles = [{**profile, 'files': profile_links(profile['id'])} for profile in list_profiles(settings.PROFILE_DIR)]
+    return JsonResponse(profiles, safe=False)
 
-        # The data to be displayed
-        context['portfolio_change'] = portfolio_result
-        context['portfolio_value'] = round(portfolio_historical_data[-1], 2)
 
-        context['index_change'] = index_result
-        context['index_value'] = round(index_historical_data[-1], 2)
+@staff_member_required
+def profile_detail(request, profile_id):
+    """
+    A function based view that returns the request and the simulation inputs of a profile, and the urls of its files.
+    """
+    path = profile_path(settings.PROFILE_DIR, profile_id, 'meta')
+    if path is None or not os.path.exists(path):
+        raise Http404('No such profile')
+    with open(path, encoding='utf-8') as f:
+        return JsonResponse({**json.load(f), 'files': profile_links(profile_id)})
 
-        context['individual_stocks'] = individual_stocks
 
-        return context
+@staff_member_required
+def profile_download(request, profile_id, kind):
+    """
+    A function based view that downloads a file of a profile: the pstats file of cProfile, the collapsed stacks of the
+    sampler (for flamegraph.pl or speedscope), or the metadata.
+    """
+    path = profile_path(settings.PROFILE_DIR, profile_id, kind)
+    if path is None or not os.path.exists(path):
+        raise Http404('No such profile')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(path))
 
 # Define a function view that returns the stock tickers, rather than trying to overwrite StockSelectionView
 
-def autocomplete_stock_list(request):
+async def autocomplete_stock_list(request):
     """
-    A function based view that returns the list of filtered stock tickers. This is used for the autocomplete
-    functionality in the Stock Selection page.
+    A function based view that returns the stocks whose ticker or company name starts with the search term, limited to
+    the stocks that existed at the start date. This is used for the autocomplete functionality in the Stock Selection
+    page.
     """
     if 'term' in request.GET:
-        return JsonResponse(dict(request.session['filtered_stocks']))
-    return render(request, 'base/autocomplete_stock_list.html')
-
+        # The eligible stocks are derived from the start date and the shared ticker universe on every request. The
+        # session and the version of the universe are read from the database, in a thread
+        start_date = await sync_to_async(lambda: request.session['start_date'])()
+        start_date_epoch = time.mktime(datetime.strptime(start_date, "%Y-%m-%d").timetuple())
 
+        ticker_universe = await sync_to_async(get_ticker_universe)()
+        with timed('ticker_search'):
+            matches = ticker_universe.search(request.GET['term'], start_date_epoch,
+                                             settings.AUTOCOMPLETE_RESULT_LIMIT)
+        return JsonResponse([f"{ticker}: {company_name}" for ticker, company_name in matches], safe=False)
+    return await sync_to_async(render)(request, 'base/autocomplete_stock_list.html')
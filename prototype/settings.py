@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,11 +42,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'base.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'base.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -82,6 +85,58 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The results of the simulations are kept in their own cache. TIMEOUT is the number of seconds a result is kept, and
+# MAX_ENTRIES and CULL_FREQUENCY control the eviction once the cache is full.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'simulation-results',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,
+            'CULL_FREQUENCY': 4,
+        },
+    },
+}
+
+RESULTS_CACHE_ALIAS = 'results'
+
+# The number of seconds the results of a simulation running up to today or later are cached, since the prices of the
+# current day are still changing
+
+RESULTS_OPEN_WINDOW_TIMEOUT = 60 * 5
+
+# How the Results page is computed by default, either 'sync' (while the request waits), 'async' (by a pool of
+# RESULTS_JOB_WORKERS background threads while the page polls for the results), or 'stream' (while the page is sent
+# progressively, which needs a WSGI worker). It can be overridden with ?mode=
+# With several worker processes, the async mode needs the 'results' cache to be shared between them, e.g. with the
+# django.core.cache.backends.filebased.FileBasedCache backend.
+
+RESULTS_MODE = 'sync'
+
+RESULTS_JOB_WORKERS = 4
+
+# The number of seconds the errors of a simulation that failed in the background are kept for its waiting page
+
+RESULTS_JOB_FAILURE_TIMEOUT = 60 * 10
+
+# How the graphs of the Results page are drawn by default, either 'server' (PNG images rendered with matplotlib) or
+# 'client' (the series are sent as JSON and plotted by the browser). It can be overridden with ?charts=
+
+RESULTS_CHART_MODE = 'server'
+
+# The number of processes used to render the graphs of the Results page in parallel. With 0 or 1, the graphs are
+# rendered one after the other in the process handling the request
+
+CHART_RENDER_WORKERS = 2
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -120,6 +175,73 @@ LOGIN_URL = 'login'
 
 STATIC_URL = 'static/'
 
+# Upstream price fetching
+# PRICE_FETCH_MAX_WORKERS bounds the number of concurrent requests sent to Yahoo Finance by each worker process, and
+# PRICE_FETCH_TIMEOUT is the number of seconds to wait for the historical data of a single ticker.
+
+PRICE_FETCH_MAX_WORKERS = 8
+
+PRICE_FETCH_TIMEOUT = 10
+
+# The client used to request the Yahoo Finance chart endpoint. BASE_URL can point to a local stand-in server, such as
+# the one of the replay_upstream command, with the UPSTREAM_BASE_URL environment variable. Requests failing with a
+# connection error, a 429 or a 5xx are retried MAX_RETRIES times, waiting about BACKOFF_FACTOR * 2 ** attempt seconds
+# in between, and after CIRCUIT_FAILURE_THRESHOLD failed requests in a row no request is sent for
+# CIRCUIT_RESET_TIMEOUT seconds.
+
+UPSTREAM_CLIENT = {
+    'BASE_URL': os.environ.get('UPSTREAM_BASE_URL') or 'https://query1.finance.yahoo.com',
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'MAX_RETRIES': 2,
+    'BACKOFF_FACTOR': 0.5,
+    'POOL_SIZE': PRICE_FETCH_MAX_WORKERS,
+    'CIRCUIT_FAILURE_THRESHOLD': 5,
+    'CIRCUIT_RESET_TIMEOUT': 30,
+}
+
+# How the days on which a series has no price are handled when the series are merged onto one trading calendar. One of
+# 'ffill' (carry the last price forward), 'drop' (keep only the days every series traded), or 'raise'
+
+PRICE_GAP_POLICY = 'ffill'
+
+# The directory of the upstream responses saved by the record_upstream_fixtures command and served by the
+# replay_upstream command
+
+UPSTREAM_FIXTURE_DIR = BASE_DIR / 'upstream_fixtures'
+
+# The maximum number of stocks suggested by the autocomplete of the Stock Selection page
+
+AUTOCOMPLETE_RESULT_LIMIT = 10
+
+# Rebuilding the ticker universe with the build_ticker_universe command. UNIVERSE_BUILD_WORKERS is the number of
+# concurrent requests, UNIVERSE_BUILD_RATE_LIMIT the maximum number of requests per second sent to each site, and
+# the progress of a build is kept in UNIVERSE_BUILD_CHECKPOINT_DIR so an interrupted build can resume.
+
+UNIVERSE_BUILD_WORKERS = 8
+
+UNIVERSE_BUILD_RATE_LIMIT = 5
+
+UNIVERSE_BUILD_CHECKPOINT_DIR = BASE_DIR / 'universe_build'
+
+# The sessions are stored in the database, with their reads and writes timed as stages of the requests
+
+SESSION_ENGINE = 'base.sessions'
+
+# The bearer token a scraper sends in the Authorization header to read the metrics endpoint (/metrics/), which serves
+# the timings and counters of the process in the Prometheus text format. Staff members can read it without the token,
+# and only they can if no token is set. Each worker process has its own metrics
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Profiling a single request, which staff members ask for with ?profile=1 or an X-Profile: 1 header. The profiles are
+# kept in PROFILE_DIR and listed at /profiles/. PROFILE_SAMPLE_INTERVAL is the number of seconds between two samples of
+# the stacks of every thread
+
+PROFILE_DIR = BASE_DIR / 'profiles'
+
+PROFILE_SAMPLE_INTERVAL = 0.005
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 